@@ -1,11 +1,18 @@
 import streamlit as st
 import folium
-from folium import plugins
-import yaml
 import os
-import json
-import subprocess
+import sys
+from folium import plugins as folium_plugins
 from pathlib import Path
+from streamlit_folium import st_folium
+
+from src import anomalies as anomaly_store
+from src import jobs as pipeline_jobs
+from src import mapview
+from src import metrics as pipeline_metrics
+from src import state as pipeline_state
+from src import tiles
+from src import worker as pipeline_worker
 
 st.set_page_config(
     page_title="LiDAR Vélez-Málaga - Detección de Anomalías Arqueológicas",
@@ -13,185 +20,346 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Load configuration
-with open("config.yaml") as f:
-    config = yaml.safe_load(f)
+AREAS = pipeline_state.areas()
+MULTI_AOI = len(AREAS) > 1
+
+
+def area_layers(name):
+    """Tile layers of one AOI, prefixed with its name when there are several"""
+    paths = pipeline_state.paths(name)
+    return tiles.area_layers(paths["dem"], paths["deriv"], f"{name}." if MULTI_AOI else "")
+
+
+@st.cache_resource
+def warm_worker():
+    """Start the warm worker (src/worker.py) once per Streamlit process, without waiting
+
+    Jobs run in it once it has loaded its libraries, and as subprocesses until then.
+    """
+    return pipeline_worker.start(wait=0)
+
+
+@st.cache_resource
+def tile_server():
+    """Start the local raster tile server once per Streamlit process"""
+    layers = {k: v for block in AREAS for k, v in area_layers(block["name"]).items()}
+    try:
+        return tiles.serve(layers=layers)
+    except OSError:
+        # Port already taken, most likely by another app process serving the same tiles
+        return None
+
+
+def job_active(stage):
+    job = pipeline_jobs.latest(stage)
+    return bool(job) and job["status"] in pipeline_jobs.ACTIVE
+
+
+def _job_status(stage, ok_message, error_message):
+    """Progress, throughput and log tail of the latest job of a stage"""
+    job = pipeline_jobs.latest(stage)
+    if not job:
+        return None
+    status = job["status"]
+    if status == "queued":
+        st.info("🕒 En cola")
+    elif status in ("running", "cancelling"):
+        total = job["total"]
+        text = f"{job['done']}/{total} {job['unit']}" if total else "Iniciando..."
+        rate = pipeline_jobs.rate(job)
+        if rate:
+            text += f" · {rate:.2f}/s"
+        st.progress(job["done"] / total if total else 0.0, text=text)
+        if status == "cancelling":
+            st.caption("Cancelando...")
+        elif st.button("⏹️ Cancelar", key=f"cancel_{stage}", use_container_width=True):
+            pipeline_jobs.cancel(job["id"])
+    elif status == "done":
+        st.success(ok_message)
+    elif status == "cancelled":
+        st.warning("⏹️ Cancelado")
+    else:
+        st.error(error_message)
+    log = pipeline_jobs.tail(job["id"])
+    if log:
+        with st.expander("Ver detalles"):
+            st.code(log)
+    return status
+
+
+@st.fragment(run_every=2)
+def _job_live(stage, ok_message, error_message):
+    status = _job_status(stage, ok_message, error_message)
+    if status not in pipeline_jobs.ACTIVE:
+        # The job finished: rerun the whole page so stage status and map update
+        st.rerun(scope="app")
+
+
+def job_panel(stage, ok_message, error_message):
+    """Show the latest job of a stage, polling while it is queued or running
+
+    Jobs run in detached processes tracked in SQLite, so this picks them up
+    again after a rerun or a browser refresh.
+    """
+    if job_active(stage):
+        _job_live(stage, ok_message, error_message)
+    else:
+        _job_status(stage, ok_message, error_message)
+
+
+MAX_DETAILS = 100
+
+
+@st.cache_resource(max_entries=4)
+def load_anomalies(path, key):
+    """Parsed anomalies; key is the file's (mtime, size) so edits invalidate it
+
+    A resource cache hands back the same object instead of unpickling a copy
+    of every feature on each rerun; callers must not mutate it.
+    """
+    return mapview.load_anomalies(path)
+
+
+@st.cache_data(max_entries=8)
+def anomaly_summary(aoi, key):
+    """Current detections of aoi per type and the MAX_DETAILS best, queried from the store
+
+    key is the store's (mtime, size), so a new detection run invalidates it.
+    """
+    db = anomaly_store.AnomalyStore()
+    try:
+        counts = db.counts(aoi)
+        top = [anomaly_store.feature(r) for r in db.detections(aoi, limit=MAX_DETAILS)]
+        runs = len(db.runs(aoi))
+    finally:
+        db.close()
+    return {"counts": counts, "total": sum(counts.values()), "top": top, "runs": runs}
+
+
+@st.cache_resource(max_entries=4)
+def anomalies_file(path, key):
+    """Bytes of the exported GeoJSON for the download button"""
+    return Path(path).read_bytes()
+
+
+def current_anomalies(aoi):
+    """Current detections of aoi, from the store"""
+    db = anomaly_store.AnomalyStore()
+    try:
+        return [anomaly_store.feature(r) for r in db.detections(aoi)]
+    finally:
+        db.close()
+
+
+@st.cache_data(max_entries=8)
+def map_html(bbox, aoi, anomalies_key, tile_layers, roi=None,
+             changes_path=None, changes_key=None):
+    features = current_anomalies(aoi) if anomalies_key else ()
+    changes = load_anomalies(changes_path, changes_key)["features"] if changes_key else ()
+    return mapview.build_map(bbox, features, tile_layers, roi=roi, changes=changes)
+
+
+ROI_KEYS = ("roi_w", "roi_s", "roi_e", "roi_n")
+
+
+def roi_picker(bbox):
+    """Region of interest to limit the pipeline steps to, or None for the whole area
+
+    The box can be drawn as a rectangle on a small map or typed in; either
+    way it lives in session_state, so it survives reruns.
+    """
+    if not st.checkbox("Limitar los pasos a una región (ROI)", key="roi_on"):
+        return None
+    for key, value in zip(ROI_KEYS, bbox):
+        st.session_state.setdefault(key, float(value))
+
+    with st.expander("✏️ Dibujar rectángulo", expanded=False):
+        m = folium.Map(location=[(bbox[1] + bbox[3]) / 2, (bbox[0] + bbox[2]) / 2],
+                       zoom_start=11, tiles="OpenStreetMap")
+        folium.Rectangle(bounds=[[bbox[1], bbox[0]], [bbox[3], bbox[2]]],
+                         color="blue", fill=False, weight=2).add_to(m)
+        folium_plugins.Draw(
+            draw_options={"rectangle": True, "polyline": False, "polygon": False,
+                          "circle": False, "marker": False, "circlemarker": False},
+            edit_options={"edit": False},
+        ).add_to(m)
+        drawn = st_folium(m, height=250, use_container_width=True,
+                          returned_objects=["last_active_drawing"], key="roi_map")
+        shape = (drawn or {}).get("last_active_drawing")
+        if shape and shape.get("geometry", {}).get("type") == "Polygon":
+            lons, lats = zip(*shape["geometry"]["coordinates"][0])
+            drawn_roi = (min(lons), min(lats), max(lons), max(lats))
+            if drawn_roi != st.session_state.get("roi_drawn"):
+                # Set before the number inputs below are created this run
+                st.session_state["roi_drawn"] = drawn_roi
+                for key, value in zip(ROI_KEYS, drawn_roi):
+                    st.session_state[key] = round(value, 6)
+
+    c1, c2 = st.columns(2)
+    w = c1.number_input("Oeste", key="roi_w", format="%.6f")
+    e = c2.number_input("Este", key="roi_e", format="%.6f")
+    s = c1.number_input("Sur", key="roi_s", format="%.6f")
+    n = c2.number_input("Norte", key="roi_n", format="%.6f")
+    if w >= e or s >= n:
+        st.error("ROI no válida: Oeste < Este y Sur < Norte")
+        return None
+    st.caption("Los pasos solo leen y reescriben los tiles y bloques bajo la ROI")
+    return (w, s, e, n)
+
+
+TILE_LAYERS = {
+    "dem": "DEM",
+    "hillshade": "Hillshade 315°",
+    "hillshade_multi": "Hillshade multidireccional",
+    "svf": "Sky View Factor",
+    "dod": "Diferencia entre coberturas",
+}
 
 st.title("🗺️ LiDAR Vélez-Málaga")
 st.subheader("Detección de Anomalías Arqueológicas con IA")
+warm_worker()
 
 # Sidebar for pipeline controls
 with st.sidebar:
     st.header("⚙️ Pipeline de Procesamiento")
     
     st.markdown("### Configuración del Área")
-    st.write(f"**Nombre:** {config['aoi']['name']}")
-    bbox = config['aoi']['bbox']
+    names = [block["name"] for block in AREAS]
+    aoi_name = st.selectbox("Área de estudio", names) if MULTI_AOI else names[0]
+    aoi = pipeline_state.area(aoi_name)
+    paths = pipeline_state.paths(aoi_name)
+    st.write(f"**Nombre:** {aoi['name']}")
+    bbox = aoi['bbox']
     st.write(f"**Bounding Box:** W:{bbox[0]}, S:{bbox[1]}, E:{bbox[2]}, N:{bbox[3]}")
-    st.write(f"**Zona UTM:** {config['aoi']['utm_zone']}")
-    st.write(f"**Máx. descargas:** {config['aoi']['max_downloads']} tiles")
+    st.write(f"**Zona UTM:** {aoi['utm_zone']}")
+    st.write(f"**Máx. descargas:** {aoi['max_downloads']} tiles")
+
+    # Each AOI has its own jobs; the stage scripts pick the AOI from LIDAR_AOI
+    def job_key(stage):
+        return f"{aoi_name}/{stage}" if MULTI_AOI else stage
+    job_env = {"LIDAR_AOI": aoi_name}
+
+    if MULTI_AOI:
+        st.caption("Los tiles compartidos entre áreas se descargan y procesan una sola vez")
+        if st.button("▶️ Procesar todas las áreas", disabled=job_active("batch"), use_container_width=True):
+            pipeline_jobs.submit("batch", [sys.executable, "-m", "src", "batch"])
+        job_panel("batch", "✅ Todas las áreas procesadas", "❌ Error en alguna área")
+    roi = roi_picker(bbox)
+    roi_args = ["--roi", *map(str, roi)] if roi else []
     
     st.markdown("---")
     st.markdown("### 🔄 Pasos del Pipeline")
     
-    # Check status of each step
-    has_laz = len(list(Path("data/laz").glob("*.laz"))) > 0 if Path("data/laz").exists() else False
-    has_dem = Path("data/dem_velez.tif").exists()
-    has_hillshade = Path("data/deriv/hill_45.tif").exists()
-    has_svf = Path("data/deriv/svf.tif").exists()
-    has_anomalies = Path("outputs/anomalies.geojson").exists()
-    
+    # Check status of each step from the content-hashed manifest
+    stages = pipeline_state.status(name=aoi_name)
+    num_laz = len(list(Path(paths["laz"]).glob("*.laz"))) if Path(paths["laz"]).exists() else 0
+    has_laz = num_laz > 0
+    has_dem = Path(paths["dem"]).exists()
+    has_hillshade = Path(paths["deriv"], "hill_45.tif").exists()
+    has_svf = Path(paths["deriv"], "svf.tif").exists()
+    has_anomalies = Path(paths["anomalies"]).exists()
+    fresh = {stage: value == "fresh" for stage, value in stages.items()}
+
+    # Steps 1-3 overlapped: each tile's DEM starts while later tiles download
+    all_fresh = fresh["download"] and fresh["dem"] and fresh["deriv"]
+    if st.button("⚡ Descargar, generar DEM y derivadas en streaming", disabled=(all_fresh and not roi) or job_active(job_key("stream")), use_container_width=True):
+        pipeline_jobs.submit(job_key("stream"), [sys.executable, "-m", "src", "stream", *roi_args], env=job_env)
+    job_panel(job_key("stream"), "✅ Descarga, DEM y derivadas completados", "❌ Error en el pipeline en streaming")
+
     # Step 1: Download LAZ
     st.markdown("#### 1️⃣ Descargar LAZ")
     if has_laz:
-        num_laz = len(list(Path("data/laz").glob("*.laz")))
-        st.success(f"✓ {num_laz} archivos LAZ descargados")
+        if fresh["download"]:
+            st.success(f"✓ {num_laz} archivos LAZ descargados")
+        else:
+            st.warning(f"⚠ {num_laz} archivos LAZ, faltan tiles del área configurada")
     else:
         st.info("⏳ Archivos LAZ no descargados")
     
-    if st.button("📥 Descargar tiles LAZ", disabled=has_laz, use_container_width=True):
-        with st.spinner("Descargando tiles LAZ desde CNIG..."):
-            try:
-                result = subprocess.run(
-                    ["python", "src/download.py"],
-                    capture_output=True,
-                    text=True,
-                    timeout=600
-                )
-                if result.returncode == 0:
-                    st.success("✅ Descarga completada")
-                    if result.stdout:
-                        with st.expander("Ver detalles"):
-                            st.code(result.stdout)
-                    st.rerun()
-                else:
-                    st.error("❌ Error en la descarga")
-                    if result.stderr:
-                        st.code(result.stderr)
-                    if result.stdout:
-                        st.code(result.stdout)
-            except subprocess.TimeoutExpired:
-                st.error("⏱️ Tiempo de espera agotado (10 min)")
-            except Exception as e:
-                st.error(f"Error: {e}")
+    if st.button("📥 Descargar tiles LAZ", disabled=(fresh["download"] and not roi) or job_active(job_key("download")), use_container_width=True):
+        pipeline_jobs.submit(job_key("download"), [sys.executable, "-m", "src", "download", *roi_args], env=job_env)
+    job_panel(job_key("download"), "✅ Descarga completada", "❌ Error en la descarga")
     
     # Step 2: Generate DEM
     st.markdown("#### 2️⃣ Generar DEM")
-    if has_dem:
+    if has_dem and fresh["dem"]:
         st.success("✓ DEM generado")
+    elif has_dem:
+        st.warning("⚠ DEM desactualizado: solo se regenerarán los tiles modificados")
     else:
         st.info("⏳ DEM no generado")
     
-    if st.button("🏔️ Generar DEM (requiere PDAL)", disabled=not has_laz or has_dem, use_container_width=True):
-        with st.spinner("Generando DEM desde archivos LAZ... (puede tardar varios minutos)"):
-            try:
-                # Try PDAL pipeline
-                result = subprocess.run(
-                    ["pdal", "pipeline", "pipelines/laz2dem.json"],
-                    capture_output=True,
-                    text=True,
-                    timeout=600
-                )
-                if result.returncode == 0:
-                    st.success("✅ DEM generado con PDAL")
-                    if result.stdout:
-                        with st.expander("Ver detalles"):
-                            st.code(result.stdout)
-                    st.rerun()
-                else:
-                    st.error("❌ Error ejecutando PDAL")
-                    if result.stderr:
-                        st.code(result.stderr)
-                    if result.stdout:
-                        st.code(result.stdout)
-            except FileNotFoundError:
-                st.error("⚠️ PDAL no está instalado en este entorno")
-                st.info("💡 PDAL es necesario para procesar archivos LAZ. Instala PDAL para continuar.")
-            except subprocess.TimeoutExpired:
-                st.error("⏱️ Tiempo de espera agotado (10 min)")
-            except Exception as e:
-                st.error(f"Error: {e}")
+    if st.button("🏔️ Generar DEM (requiere PDAL)", disabled=not has_laz or (fresh["dem"] and not roi) or job_active(job_key("dem")), use_container_width=True):
+        # One PDAL pipeline per tile, then mosaic
+        pipeline_jobs.submit(job_key("dem"), [sys.executable, "-m", "src", "dem", *roi_args], env=job_env)
+    job_panel(job_key("dem"), "✅ DEM generado con PDAL", "❌ Error generando el DEM con PDAL")
     
     # Step 3: Process derivatives
     st.markdown("#### 3️⃣ Calcular Derivadas")
-    if has_hillshade and has_svf:
+    if has_hillshade and has_svf and fresh["deriv"]:
         st.success("✓ Hillshade y SVF calculados")
+    elif has_hillshade and has_svf:
+        st.warning("⚠ Derivadas desactualizadas: solo se recalcularán los bloques modificados")
     else:
         st.info("⏳ Derivadas no calculadas")
     
-    if st.button("📐 Calcular Hillshade y SVF", disabled=not has_dem or (has_hillshade and has_svf), use_container_width=True):
-        with st.spinner("Calculando hillshade y Sky View Factor..."):
-            try:
-                result = subprocess.run(
-                    ["python", "src/process.py"],
-                    capture_output=True,
-                    text=True,
-                    timeout=300
-                )
-                if result.returncode == 0:
-                    st.success("✅ Derivadas calculadas")
-                    if result.stdout:
-                        with st.expander("Ver detalles"):
-                            st.code(result.stdout)
-                    st.rerun()
-                else:
-                    st.error("❌ Error calculando derivadas")
-                    if result.stderr:
-                        st.code(result.stderr)
-                    if result.stdout:
-                        st.code(result.stdout)
-            except subprocess.TimeoutExpired:
-                st.error("⏱️ Tiempo de espera agotado (5 min)")
-            except Exception as e:
-                st.error(f"Error: {e}")
+    if st.button("📐 Calcular Hillshade, SVF y relieve", disabled=not has_dem or (fresh["deriv"] and not roi) or job_active(job_key("deriv")), use_container_width=True):
+        pipeline_jobs.submit(job_key("deriv"), [sys.executable, "-m", "src", "deriv", *roi_args], env=job_env)
+    job_panel(job_key("deriv"), "✅ Derivadas calculadas", "❌ Error calculando derivadas")
     
     # Step 4: AI Detection
     st.markdown("#### 4️⃣ Detección con IA")
-    if has_anomalies:
+    if has_anomalies and fresh["detect"]:
         st.success("✓ Anomalías detectadas")
+    elif has_anomalies:
+        st.warning("⚠ Anomalías calculadas sobre derivadas anteriores")
     else:
         st.info("⏳ Detección no realizada")
     
-    if st.button("🤖 Detectar Anomalías (Gemini)", disabled=not has_dem or has_anomalies, use_container_width=True):
+    if st.button("🤖 Detectar Anomalías (Gemini)", disabled=not has_dem or (fresh["detect"] and not roi) or job_active(job_key("detect")), use_container_width=True):
         if not os.environ.get("GEMINI_API_KEY"):
             st.error("⚠️ Se requiere GEMINI_API_KEY")
             st.info("Configura tu API key de Gemini para usar esta función")
         else:
-            with st.spinner("Analizando terreno con Gemini AI... (puede tardar 30-60 segundos)"):
-                try:
-                    result = subprocess.run(
-                        ["python", "src/detect.py"],
-                        capture_output=True,
-                        text=True,
-                        timeout=120
-                    )
-                    if result.returncode == 0:
-                        st.success("✅ Anomalías detectadas por IA")
-                        if result.stdout:
-                            with st.expander("Ver detalles"):
-                                st.code(result.stdout)
-                        st.rerun()
-                    else:
-                        st.error("❌ Error en detección con IA")
-                        if result.stderr:
-                            st.code(result.stderr)
-                        if result.stdout:
-                            st.code(result.stdout)
-                except subprocess.TimeoutExpired:
-                    st.error("⏱️ Tiempo de espera agotado (2 min)")
-                except Exception as e:
-                    st.error(f"Error: {e}")
-    
+            pipeline_jobs.submit(job_key("detect"), [sys.executable, "-m", "src", "detect", *roi_args], env=job_env)
+    job_panel(job_key("detect"), "✅ Anomalías detectadas por IA", "❌ Error en detección con IA")
+
+    # Step 5: Change against an earlier coverage, when one is configured
+    before = pipeline_state.settings("change").get("before")
+    if before:
+        st.markdown("#### 5️⃣ Cambios entre coberturas")
+        if Path(paths["changes"]).exists():
+            st.success(f"✓ Cambios respecto a {before} calculados")
+        else:
+            st.info(f"⏳ Sin comparar con la cobertura {before}")
+        if st.button(f"🔀 Comparar con {before}", disabled=job_active(job_key("change")), use_container_width=True):
+            # Downloads and rasterises the earlier coverage first if needed
+            pipeline_jobs.submit(job_key("change"), [sys.executable, "-m", "src", "change"], env=job_env)
+        job_panel(job_key("change"), "✅ Diferencia entre coberturas calculada", "❌ Error comparando coberturas")
+
     st.markdown("---")
     
     # Reset button
     if st.button("🔄 Reiniciar Pipeline", use_container_width=True):
         if st.checkbox("Confirmar reinicio (eliminará datos procesados)"):
             import shutil
-            for path in ["data/laz", "data/deriv", "outputs"]:
+            # This AOI's jobs only; other AOIs' jobs keep running
+            for stage in ("stream", "download", "dem", "deriv", "detect", "change"):
+                job = pipeline_jobs.latest(job_key(stage))
+                if job:
+                    pipeline_jobs.cancel(job["id"])
+            # Only this AOI's files: tiles in the shared store stay for other AOIs
+            for path in [paths["laz"], os.path.dirname(paths["vrt"]), paths["deriv"], paths["outputs"]]:
                 if Path(path).exists():
                     shutil.rmtree(path)
-            Path("data/dem_velez.tif").unlink(missing_ok=True)
+            Path(paths["dem"]).unlink(missing_ok=True)
+            Path(paths["manifest"]).unlink(missing_ok=True)
+            # Its runs in the shared anomaly store too, or the map keeps showing them
+            db = anomaly_store.AnomalyStore()
+            try:
+                db.remove_aoi(aoi_name)
+            finally:
+                db.close()
             st.success("Pipeline reiniciado")
             st.rerun()
 
@@ -201,97 +369,56 @@ col1, col2 = st.columns([2, 1])
 with col1:
     st.markdown("### 🗺️ Mapa de Anomalías")
     
-    # Create base map
-    center_lat = (bbox[1] + bbox[3]) / 2
-    center_lon = (bbox[0] + bbox[2]) / 2
-    
-    m = folium.Map(
-        location=[center_lat, center_lon],
-        zoom_start=12,
-        tiles="OpenStreetMap"
+    # Map HTML is cached on the anomalies file and the available raster layers,
+    # so reruns triggered by other widgets do not redraw every marker
+    tile_server()
+    tile_url = os.environ.get("LIDAR_TILE_URL", f"http://127.0.0.1:{tiles.PORT}")
+    prefix = f"{aoi_name}." if MULTI_AOI else ""
+    tile_layers = tuple(
+        (f"{tile_url}/{layer}/{{z}}/{{x}}/{{y}}.png", TILE_LAYERS.get(layer[len(prefix):], layer),
+         layer == f"{prefix}hillshade")
+        for layer in tiles.available_layers(area_layers(aoi_name))
     )
-    
-    # Add bounding box rectangle
-    folium.Rectangle(
-        bounds=[[bbox[1], bbox[0]], [bbox[3], bbox[2]]],
-        color="blue",
-        fill=False,
-        weight=2,
-        popup="Área de Estudio"
-    ).add_to(m)
-    
-    # Load and display anomalies if available
-    if has_anomalies:
-        try:
-            with open("outputs/anomalies.geojson", "r", encoding="utf-8") as f:
-                geojson_data = json.load(f)
-            
-            # Add markers for each anomaly
-            for feature in geojson_data.get("features", []):
-                coords = feature["geometry"]["coordinates"]
-                props = feature["properties"]
-                
-                # Color coding by type
-                color_map = {
-                    "muro": "red",
-                    "túmulo": "orange",
-                    "fossa": "purple",
-                    "camino": "green"
-                }
-                color = color_map.get(props.get("tipo", ""), "blue")
-                
-                # Create popup content
-                popup_html = f"""
-                <b>Tipo:</b> {props.get('tipo', 'N/A')}<br>
-                <b>Confianza:</b> {props.get('score', 0):.2f}<br>
-                <b>Justificación:</b> {props.get('justificacion', 'N/A')}
-                """
-                
-                folium.CircleMarker(
-                    location=[coords[1], coords[0]],
-                    radius=8,
-                    color=color,
-                    fill=True,
-                    fillColor=color,
-                    fillOpacity=0.6,
-                    popup=folium.Popup(popup_html, max_width=300)
-                ).add_to(m)
-            
-            # Add layer control
-            folium.LayerControl().add_to(m)
-            
-        except Exception as e:
-            st.error(f"Error cargando GeoJSON: {e}")
+    # The store holds every run; anomalies.geojson from before it is imported once
+    anomalies_key = mapview.file_key(anomaly_store.STORE_DB)
+    anomalies = None
+    try:
+        if anomalies_key:
+            anomalies = anomaly_summary(aoi_name, anomalies_key)
+        if has_anomalies and not (anomalies and anomalies["runs"]):
+            db = anomaly_store.AnomalyStore()
+            db.import_geojson(paths["anomalies"], aoi_name)
+            db.close()
+            anomalies_key = mapview.file_key(anomaly_store.STORE_DB)
+            anomalies = anomaly_summary(aoi_name, anomalies_key)
+    except Exception as e:
+        st.error(f"Error cargando las anomalías: {e}")
     
     # Display map
-    st.components.v1.html(m._repr_html_(), height=600)
+    map_key = anomalies_key if anomalies and anomalies["total"] else None
+    changes_key = mapview.file_key(paths["changes"])
+    st.components.v1.html(map_html(tuple(bbox), aoi_name, map_key, tile_layers, roi,
+                                   paths["changes"], changes_key), height=600)
 
 with col2:
     st.markdown("### 📊 Resultados")
     
-    if has_anomalies:
+    if anomalies and anomalies["total"]:
         try:
-            with open("outputs/anomalies.geojson", "r", encoding="utf-8") as f:
-                geojson_data = json.load(f)
-            
-            features = geojson_data.get("features", [])
-            st.metric("Anomalías Detectadas", len(features))
-            
-            # Count by type
-            types = {}
-            for feature in features:
-                tipo = feature["properties"].get("tipo", "desconocido")
-                types[tipo] = types.get(tipo, 0) + 1
+            total = anomalies["total"]
+            st.metric("Anomalías Detectadas", total)
             
             st.markdown("#### Por Tipo:")
-            for tipo, count in types.items():
+            for tipo, count in anomalies["counts"].items():
                 st.write(f"**{tipo.capitalize()}:** {count}")
             
             st.markdown("---")
             
-            # List all anomalies
+            # List the highest-scoring anomalies; the full set is in the download
             st.markdown("#### Detalles:")
-            for i, feature in enumerate(features, 1):
+            if total > MAX_DETAILS:
+                st.caption(f"Mostrando las {MAX_DETAILS} de mayor confianza de {total}")
+            for i, feature in enumerate(anomalies["top"], 1):
                 props = feature["properties"]
                 coords = feature["geometry"]["coordinates"]
                 
@@ -302,18 +429,18 @@ with col2:
             st.markdown("---")
             
             # Download button
-            geojson_str = json.dumps(geojson_data, indent=2, ensure_ascii=False)
-            st.download_button(
-                label="📥 Descargar GeoJSON",
-                data=geojson_str,
-                file_name="velez_anomalies.geojson",
-                mime="application/json",
-                use_container_width=True
-            )
+            if has_anomalies:
+                st.download_button(
+                    label="📥 Descargar GeoJSON",
+                    data=anomalies_file(paths["anomalies"], mapview.file_key(paths["anomalies"])),
+                    file_name="velez_anomalies.geojson",
+                    mime="application/json",
+                    use_container_width=True
+                )
         
         except Exception as e:
             st.error(f"Error: {e}")
-    else:
+    elif not has_anomalies:
         st.info("No hay anomalías detectadas todavía. Completa el pipeline para detectarlas.")
         
         st.markdown("---")
@@ -329,6 +456,54 @@ with col2:
         - Análisis con IA (Gemini)
         """)
 
+@st.cache_data(max_entries=2)
+def load_metrics(key):
+    """Run log records; key is the log's (mtime, size)"""
+    return pipeline_metrics.load()
+
+
+# Per-run timings from data/metrics/runs.jsonl
+metrics_key = mapview.file_key(pipeline_metrics.RUN_LOG)
+if metrics_key:
+    with st.expander("⏱️ Rendimiento del pipeline", expanded=False):
+        import pandas as pd
+
+        records = load_metrics(metrics_key)
+        runs = pd.DataFrame(pipeline_metrics.stage_runs(records))
+        if MULTI_AOI:
+            runs = runs[runs["aoi"] == aoi_name]
+        if runs.empty:
+            st.info("Todavía no hay ejecuciones registradas para esta área.")
+        else:
+            units = dict(zip(runs["stage"], runs["unit"]))
+            for (stage, _), (cost, median, change, slow) in pipeline_metrics.regressions(
+                    runs.to_dict("records")).items():
+                if slow:
+                    st.warning(f"⚠️ {stage}: {cost:.3g} s/{units[stage]} frente a una mediana de "
+                               f"{median:.3g} ({change:+.0%}) en las últimas ejecuciones")
+
+            runs["inicio"] = pd.to_datetime(runs["started"], unit="s")
+            st.markdown("#### Tiempo por etapa (s)")
+            st.bar_chart(runs.tail(40), x="inicio", y="wall", color="stage")
+
+            table = runs.tail(20).iloc[::-1][
+                ["inicio", "stage", "ok", "wall", "cpu", "rss_mb", "read_mb", "written_mb",
+                 "units", "unit", "rate", "commit"]]
+            st.dataframe(table.rename(columns={
+                "stage": "etapa", "wall": "tiempo (s)", "cpu": "CPU (s)", "rss_mb": "RSS máx. (MB)",
+                "read_mb": "leído (MB)", "written_mb": "escrito (MB)", "units": "unidades",
+                "unit": "unidad", "rate": "unidades/s"}), hide_index=True, use_container_width=True)
+
+            # Slowest tiles, layers or chips of the latest run of a stage
+            stage = st.selectbox("Detalle de la etapa", sorted(runs["stage"].unique()))
+            last = runs[runs["stage"] == stage].iloc[-1]
+            items = pd.DataFrame([r for r in records if r.get("kind") == "item"
+                                  and r["run"] == last["run"] and r["stage"] == stage])
+            if not items.empty and "seconds" in items:
+                st.dataframe(items.drop(columns=["kind", "run", "stage"])
+                             .sort_values("seconds", ascending=False).head(25),
+                             hide_index=True, use_container_width=True)
+
 # Footer
 st.markdown("---")
 st.markdown(
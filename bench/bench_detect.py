@@ -0,0 +1,71 @@
+"""Benchmark tiled anomaly detection against the local Gemini stub.
+
+Usage: python bench/bench_detect.py [rows] [latency_s]
+
+Builds a synthetic DEM with its hillshade and SVF in a temporary directory,
+starts bench/stub_gemini.py in-process, and runs detect_tiled() at several
+concurrency levels, reporting chips per second. Each run starts with an empty
+response cache and sends every chip (no pre-screen shortlist), so every
+run makes the same model calls.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, HERE)
+
+import cache  # noqa: E402
+import stub_gemini  # noqa: E402
+from bench_svf import synthetic_dem  # noqa: E402
+
+PORT = 8089
+
+
+async def run(detect, concurrency):
+    """Seconds for one detect_tiled() run, and the requests the stub answered"""
+    shutil.rmtree(os.path.dirname(cache.CACHE_DB), ignore_errors=True)
+    runner = await stub_gemini.start(PORT, latency=LATENCY)
+    try:
+        t0 = time.perf_counter()
+        await detect.detect_tiled(concurrency=concurrency, per_minute=100000, top_k=0)
+        return time.perf_counter() - t0, runner.app["stats"]["requests"]
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    global LATENCY
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    os.environ.update(GEMINI_API_KEY="stub", GEMINI_BASE_URL=f"http://127.0.0.1:{PORT}")
+    config = os.path.join(HERE, "..", "config.yaml")
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(config, tmp)
+        os.chdir(tmp)
+        os.makedirs("data", exist_ok=True)
+        import detect
+        import process
+
+        synthetic_dem("data/dem_velez.tif", rows, rows)
+        process.hill_multi("data/dem_velez.tif", azimuths=(45,), combined=False)
+        process.svf("data/dem_velez.tif")
+
+        chips = len(list(detect.iter_chips()))
+        results = []
+        for concurrency in (1, 4, 16):
+            dt, sent = asyncio.run(run(detect, concurrency))
+            if sent != chips:
+                sys.exit(f"✗ Concurrency {concurrency} sent {sent} of {chips} chips to the stub")
+            results.append((concurrency, dt))
+        print(f"\n{chips} chips of {detect.settings()['chip_size']}px, stub latency {LATENCY}s")
+        for concurrency, dt in results:
+            print(f"  concurrency {concurrency:2d}: {dt:6.2f} s  {chips / dt:6.2f} chips/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark tile index queries over a synthetic national index.
+
+Usage: python bench/bench_index.py [cell_degrees]
+
+Builds a grid of tiles covering peninsular Spain (0.02° cells by default,
+~250k tiles), zips it like the CNIG index, and compares
+parsing the zipped file with a full intersects() scan against the cached
+GeoParquet index with STRtree queries. Runs in a temporary directory.
+"""
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import geopandas as gpd
+import numpy as np
+from shapely import box as boxes
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+SPAIN = (-9.4, 36.0, 3.4, 43.8)
+QUERIES = [(-4.25, 36.70, -4.00, 36.85), (-3.80, 40.30, -3.60, 40.50), (2.00, 41.30, 2.25, 41.45)]
+
+
+def synthetic_index(path, cell):
+    """Write a zipped index of cell x cell tiles in EPSG:25830"""
+    xs = np.arange(SPAIN[0], SPAIN[2], cell)
+    ys = np.arange(SPAIN[1], SPAIN[3], cell)
+    gx, gy = np.meshgrid(xs, ys)
+    gx, gy = gx.ravel(), gy.ravel()
+    idx = gpd.GeoDataFrame(
+        {"HOJA": [f"T{i:07d}" for i in range(len(gx))],
+         "URL_DESCARGA": [f"http://localhost/laz/T{i:07d}.laz" for i in range(len(gx))]},
+        geometry=boxes(gx, gy, gx + cell, gy + cell), crs=4326,
+    ).to_crs(25830)
+    idx.to_file("index.gpkg")
+    with zipfile.ZipFile(path, "w") as z:
+        z.write("index.gpkg")
+    return len(idx)
+
+
+def timed(label, fn, repeat=1):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    dt = (time.perf_counter() - t0) / repeat
+    print(f"  {label:<56} {dt * 1000:10.1f} ms")
+    return result
+
+
+def main():
+    cell = float(sys.argv[1]) if len(sys.argv) > 1 else 0.02
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        import tileindex
+
+        n = synthetic_index("index.zip", cell)
+        url = f"file://{tmp}/index.zip"
+        print(f"Synthetic national index: {n} tiles")
+
+        print("Before (zipped index + full scan):")
+        idx = timed("read_file + to_crs(4326)", lambda: gpd.read_file("index.zip").to_crs(4326))
+        for bbox in QUERIES:
+            timed(f"intersects scan {bbox}", lambda: idx[idx.intersects(box(*bbox))])
+
+        print("After (GeoParquet cache + STRtree):")
+        timed("first run: fetch, reproject, cache", lambda: tileindex.load("bench", url))
+        tileindex._loaded.clear()
+        cached = timed("new process: load cached parquet", lambda: tileindex.load("bench", url))
+        timed("build STRtree", lambda: cached.sindex)
+        for bbox in QUERIES:
+            hits = timed(f"STRtree query {bbox}", lambda: tileindex.query(cached, bbox), 20)
+            assert list(hits.HOJA) == list(idx[idx.intersects(box(*bbox))].HOJA)
+        timed("repeated load + query (warm)",
+              lambda: tileindex.query(tileindex.load("bench", url), QUERIES[0]), 20)
+        for bbox in QUERIES:
+            hits = timed(f"new process: tiles_for {bbox}", lambda: tileindex.tiles_for(bbox, "bench", url), 5)
+            assert list(hits.HOJA) == list(idx[idx.intersects(box(*bbox))].HOJA)
+
+
+if __name__ == "__main__":
+    main()
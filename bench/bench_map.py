@@ -0,0 +1,99 @@
+"""Benchmark map rerun latency against the number of anomalies.
+
+Usage: python bench/bench_map.py [counts...]
+
+For each feature count, writes a synthetic anomalies GeoJSON and times
+three ways of producing the map HTML on a Streamlit rerun:
+
+  uncached  what app.py used to do on every rerun: parse the file twice
+            and build one CircleMarker per feature
+  cold      first rerun after the file changes: one parse, markers
+            clustered above mapview.CLUSTER_THRESHOLD
+  warm      any other rerun: stat the file and return the cached HTML
+            (including the pickle round trip st.cache_data does on a hit)
+
+Runs in a temporary directory.
+"""
+import json
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+
+import folium
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import mapview
+
+BBOX = (-4.20, 36.70, -4.00, 36.85)
+COUNTS = (10, 100, 1000, 5000, 20000)
+
+
+def synthetic_anomalies(path, n, seed=0):
+    rng = random.Random(seed)
+    features = [{
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [rng.uniform(BBOX[0], BBOX[2]),
+                                                      rng.uniform(BBOX[1], BBOX[3])]},
+        "properties": {"tipo": rng.choice(list(mapview.COLOR_MAP) + ["otro"]),
+                       "score": rng.random(),
+                       "justificacion": "Anomalía sintética de prueba"},
+    } for _ in range(n)]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f, ensure_ascii=False)
+
+
+def uncached(path):
+    """The previous per-rerun path in app.py"""
+    m = folium.Map(location=[(BBOX[1] + BBOX[3]) / 2, (BBOX[0] + BBOX[2]) / 2],
+                   zoom_start=12, tiles="OpenStreetMap")
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    for feature in data["features"]:
+        lon, lat = feature["geometry"]["coordinates"]
+        props = feature["properties"]
+        color = {"muro": "red", "túmulo": "orange", "fossa": "purple",
+                 "camino": "green"}.get(props["tipo"], "blue")
+        folium.CircleMarker(location=[lat, lon], radius=8, color=color, fill=True,
+                            fillColor=color, fillOpacity=0.6,
+                            popup=folium.Popup(mapview._popup(props), max_width=300)).add_to(m)
+    html = m._repr_html_()
+    with open(path, encoding="utf-8") as f:
+        json.load(f)  # results column parsed it again
+    return html
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t)
+    return best, out
+
+
+def main(counts):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "anomalies.geojson")
+        print(f"{'features':>9} {'uncached':>10} {'cold':>10} {'warm':>10} {'html MB':>9}")
+        for n in counts:
+            synthetic_anomalies(path, n)
+            repeat = 3 if n <= 5000 else 1
+            t_old, _ = timed(lambda: uncached(path), repeat)
+
+            def cold():
+                data = mapview.load_anomalies(path)
+                return mapview.build_map(BBOX, data["features"])
+
+            t_cold, html = timed(cold, repeat)
+            cache = {mapview.file_key(path): pickle.dumps(html)}
+            t_warm, _ = timed(lambda: pickle.loads(cache[mapview.file_key(path)]), 20)
+            print(f"{n:>9} {t_old * 1000:>8.1f}ms {t_cold * 1000:>8.1f}ms "
+                  f"{t_warm * 1000:>8.2f}ms {len(html) / 1e6:>9.2f}")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or COUNTS)
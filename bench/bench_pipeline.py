@@ -0,0 +1,271 @@
+"""Benchmark every pipeline stage offline on synthetic fixtures.
+
+Usage: python bench/bench_pipeline.py [--sizes 1000 2000] [--tiles 3] [--stages ...]
+       python bench/bench_pipeline.py --compare     # last two runs, without running
+
+In a temporary directory, writes the fixtures of bench/fixtures.py (LAZ
+tiles with planted mounds, walls and ditches, their tile index, and DEMs of
+each size), then times:
+
+  index      tile index query (tileindex.tiles_for) on the fixture index
+  download   download.py against a local HTTP server holding the LAZ tiles
+  ingest     LAZ header and sample indexing from scratch
+  dem        dem.py with PDAL (skipped when pdal is not on PATH)
+  stream     stream.py: download and DEM again from scratch, overlapped,
+             against the sum of the two stages above
+  hillshade, svf, relief, preview, prescreen, detect
+             per DEM size; the pre-screen also reports how many planted
+             features it found, and detection runs against bench/stub_gemini.py
+
+Each stage is measured with metrics.stage() (wall, CPU, peak RSS, I/O,
+throughput) and appended to bench/results/pipeline.jsonl with the git
+commit, so runs can be compared: the end of each run prints every stage
+against the previous run and flags those more than metrics.REGRESSION
+slower per unit. Needs no network and no GPU.
+"""
+import argparse
+import asyncio
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, HERE)
+
+import fixtures  # noqa: E402
+import metrics  # noqa: E402
+import stub_gemini  # noqa: E402
+
+RESULTS = os.path.join(HERE, "results", "pipeline.jsonl")
+STAGES = ("index", "download", "ingest", "dem", "stream", "hillshade", "svf", "relief", "preview",
+          "prescreen", "detect")
+LAZ_PORT, GEMINI_PORT = 8090, 8089
+
+
+def write_config(bbox, tiles):
+    """The repo's config.yaml with the AOI moved onto the fixtures"""
+    with open(os.path.join(ROOT, "config.yaml")) as f:
+        cfg = yaml.safe_load(f)
+    cfg.pop("aois", None)
+    cfg["aoi"] = {"name": "bench", "bbox": bbox, "utm_zone": 30, "max_downloads": tiles,
+                  "laz_version": "bench"}
+    cfg.setdefault("detect", {})["requests_per_minute"] = 100000
+    with open("config.yaml", "w") as f:
+        yaml.safe_dump(cfg, f, allow_unicode=True)
+
+
+def fresh(*paths):
+    """Remove outputs so the next stage does all of its work"""
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def run_laz_stages(args, stages, tiles, bbox):
+    import dem
+    import download
+    import ingest
+    import state
+    import store
+    import stream
+    import tileindex
+
+    tileindex.INDEX_URLS["bench"] = f"file://{os.path.abspath('fixtures/index.zip')}"
+    paths = state.paths()
+
+    if "index" in stages:
+        tileindex.refresh("bench")    # build the Parquet cache outside the timing
+        with metrics.stage("index", "queries", RESULTS):
+            for _ in range(20):
+                hits = tileindex.tiles_for(bbox, "bench")
+            metrics.count(20)
+        assert len(hits) == len(tiles), f"index query found {len(hits)} of {len(tiles)} tiles"
+
+    if "download" in stages:
+        async def fetch():
+            runner = await fixtures.serve("fixtures/laz", LAZ_PORT, args.bandwidth)
+            try:
+                await download.main()
+            finally:
+                await runner.cleanup()
+
+        with metrics.stage("download", "tiles", RESULTS):
+            asyncio.run(fetch())
+
+    if "ingest" in stages:
+        fresh(paths["index"])
+        with metrics.stage("ingest", "tiles", RESULTS):
+            indexed, _ = ingest.ingest()
+            metrics.count(indexed)
+
+    if "dem" in stages:
+        if not shutil.which("pdal"):
+            print("⚠ pdal not found on PATH, skipping the DEM stage")
+        elif not os.listdir(paths["laz"]):
+            print("⚠ No LAZ tiles downloaded, skipping the DEM stage")
+        else:
+            with metrics.stage("dem", "tiles", RESULTS) as run:
+                run["ok"] = dem.build_dem()
+
+    if "stream" in stages:
+        if not shutil.which("pdal"):
+            print("⚠ pdal not found on PATH, skipping the streaming stage")
+            return
+        fresh(paths["laz"], store.STORE, paths["index"], paths["manifest"], paths["dem"])
+        os.makedirs(store.DEM_STORE, exist_ok=True)
+
+        async def streamed():
+            runner = await fixtures.serve("fixtures/laz", LAZ_PORT, args.bandwidth)
+            try:
+                return await stream.stream()
+            finally:
+                await runner.cleanup()
+
+        with metrics.stage("stream", "tiles", RESULTS) as run:
+            keys, fetching, rasterising, failed = asyncio.run(streamed())
+            run["ok"] = dem.build_dem() and not failed
+            run["units"] = len(keys)
+        print(f"✓ Streamed in {run['wall']:.1f}s; downloads took {fetching:.1f}s "
+              f"and PDAL {rasterising:.1f}s of worker time")
+
+
+def run_raster_stages(args, stages, size):
+    import detect
+    import prescreen
+    import process
+    import state
+
+    paths = state.paths()
+    dem_path, deriv_dir = paths["dem"], paths["deriv"]
+    fresh(paths["manifest"], deriv_dir, "data/cache/responses.sqlite")
+    os.makedirs(deriv_dir, exist_ok=True)
+    features = fixtures.write_dem(dem_path, size, size)
+    print(f"\n=== DEM {size}x{size} ({size * size / 1e6:.1f} Mpx) ===")
+
+    if "hillshade" in stages or "detect" in stages:
+        with metrics.stage(f"hillshade@{size}", "Mpx", RESULTS):
+            process.hill_multi(dem_path)
+    if "svf" in stages or "detect" in stages:
+        with metrics.stage(f"svf@{size}", "Mpx", RESULTS):
+            process.svf(dem_path)
+    if "relief" in stages:
+        with metrics.stage(f"relief@{size}", "Mpx", RESULTS):
+            process.relief(dem_path)
+    if "preview" in stages:
+        with metrics.stage(f"preview@{size}", "images", RESULTS):
+            for layer in (dem_path, f"{deriv_dir}/hill_multi.tif", f"{deriv_dir}/svf.tif"):
+                if os.path.exists(layer):
+                    name = os.path.splitext(os.path.basename(layer))[0]
+                    detect.create_preview_image(layer, f"preview_{name}.jpg")
+                    metrics.count(1)
+    if "prescreen" in stages:
+        with metrics.stage(f"prescreen@{size}", "chips", RESULTS):
+            cfg = detect.settings()
+            chips = prescreen.candidates(size=cfg["chip_size"], overlap=cfg["chip_overlap"])
+        found = [f for _, _, cands in chips for f in cands]
+        near = [min(math.hypot(f["x"] - p["x"], f["y"] - p["y"]) for f in found) < 15
+                for p in features] if found else []
+        print(f"✓ Pre-screen found {sum(near)} of {len(features)} planted features "
+              f"with {len(found)} candidates")
+    if "detect" in stages:
+        async def run():
+            runner = await stub_gemini.start(GEMINI_PORT, latency=args.latency)
+            try:
+                return await detect.detect_tiled(concurrency=args.concurrency,
+                                                  per_minute=100000)
+            finally:
+                await runner.cleanup()
+
+        with metrics.stage(f"detect@{size}", "chips", RESULTS) as rec:
+            rec["ok"] = asyncio.run(run())
+
+
+def compare(records=None):
+    """Print the latest run's stages against the run before it"""
+    runs = metrics.stage_runs(records if records is not None else metrics.load(RESULTS))
+    ids = list(dict.fromkeys(r["run"] for r in runs))
+    if not ids:
+        print("No benchmark runs recorded yet")
+        return
+    latest = [r for r in runs if r["run"] == ids[-1]]
+    before = {r["stage"]: r for r in runs if len(ids) > 1 and r["run"] == ids[-2]}
+    print(f"\nRun {ids[-1]} (commit {latest[0].get('commit') or '?'})"
+          + (f" vs {ids[-2]} (commit {next(iter(before.values())).get('commit') or '?'})"
+             if before else ""))
+    slow = 0
+    for r in latest:
+        cost = r["wall"] / r["units"] if r.get("units") else None
+        line = (f"  {r['stage']:<16} {'✓' if r['ok'] else '✗'} {r['wall']:8.2f} s "
+                f"{r['cpu']:8.2f} s CPU {r['rss_mb']:7.0f} MB")
+        if r.get("rate"):
+            line += f" {r['rate']:9.2f} {r['unit']}/s"
+        prev = before.get(r["stage"])
+        if cost and prev and prev.get("units"):
+            change = cost / (prev["wall"] / prev["units"]) - 1
+            line += f"  {change:+6.0%}"
+            if change > metrics.REGRESSION:
+                line += " ⚠"
+                slow += 1
+        print(line)
+    if before:
+        print(f"⚠ {slow} stages slower than the previous run" if slow
+              else "✅ No stage slower than the previous run")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of every pipeline stage")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 2000],
+                        help="DEM sizes (pixels per side) for the raster stages")
+    parser.add_argument("--tiles", type=int, default=3, help="LAZ tiles per side")
+    parser.add_argument("--tile-size", type=float, default=200.0, help="LAZ tile side (m)")
+    parser.add_argument("--density", type=float, default=4.0, help="LAZ points per m²")
+    parser.add_argument("--bandwidth", type=float,
+                        help="cap each LAZ download at this many MB/s (default: no cap)")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub model latency (s)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--compare", action="store_true",
+                        help="only compare the last two recorded runs")
+    args = parser.parse_args()
+    if args.compare:
+        compare()
+        return
+
+    # One run id for all the stages of this run
+    os.environ.setdefault("LIDAR_RUN_ID", f"bench-{time.strftime('%Y%m%dT%H%M%S')}")
+    os.environ.update(GEMINI_API_KEY="stub", GEMINI_BASE_URL=f"http://127.0.0.1:{GEMINI_PORT}")
+    print(f"{os.cpu_count()} cores, results in {RESULTS}")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        shutil.copytree(os.path.join(ROOT, "pipelines"), "pipelines")
+        tiles = fixtures.tile_grid(args.tiles, args.tiles, args.tile_size)
+        bbox = fixtures.lonlat_bbox(tiles)
+        write_config(bbox, len(tiles))
+
+        t0 = time.perf_counter()
+        paths, features = fixtures.write_laz_tiles("fixtures/laz", args.tiles, args.tiles,
+                                                   args.tile_size, args.density)
+        fixtures.write_index("fixtures/index.zip", tiles, f"http://127.0.0.1:{LAZ_PORT}")
+        print(f"Fixtures: {len(paths)} LAZ tiles ({args.density:g} pts/m², "
+              f"{len(features)} planted features) in {time.perf_counter() - t0:.1f}s")
+
+        stages = set(args.stages)
+        run_laz_stages(args, stages, tiles, bbox)
+        if stages & {"hillshade", "svf", "relief", "preview", "prescreen", "detect"}:
+            for size in args.sizes:
+                run_raster_stages(args, stages, size)
+        os.chdir(ROOT)
+    compare()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Benchmark the fused relief pass against one pass per layer.
+
+Usage: python bench/bench_relief.py [rows] [cols]
+
+Runs process.relief() once with every layer, then once per layer as if
+each were its own derivative, on a synthetic DEM in a temporary
+directory, and reports seconds and megapixels per second for both.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bench_svf import synthetic_dem  # noqa: E402
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    cols = int(sys.argv[2]) if len(sys.argv) > 2 else rows
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        import process
+
+        synthetic_dem("dem.tif", rows, cols)
+        mpix = rows * cols / 1e6
+        cfg = process.relief_settings()
+        print(f"Synthetic DEM {rows}x{cols} ({mpix:.1f} Mpx), {os.cpu_count()} cores")
+
+        t0 = time.perf_counter()
+        process.relief("dem.tif", "fused.tif", cfg=cfg)
+        fused = time.perf_counter() - t0
+
+        separate = 0.0
+        groups = [[layer] for layer in cfg["layers"] if not layer.startswith("openness")]
+        groups.append([layer for layer in cfg["layers"] if layer.startswith("openness")])
+        for layers in groups:
+            t0 = time.perf_counter()
+            process.relief("dem.tif", f"{layers[0]}.tif", cfg=dict(cfg, layers=layers))
+            dt = time.perf_counter() - t0
+            separate += dt
+            print(f"  {'+'.join(layers):<28} {dt:6.2f} s")
+
+        print(f"One pass per layer: {separate:6.2f} s  {mpix / separate:6.2f} Mpx/s")
+        print(f"Fused pass:         {fused:6.2f} s  {mpix / fused:6.2f} Mpx/s "
+              f"({separate / fused:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Benchmark how long the pipeline commands take to start.
+
+Usage: python bench/bench_startup.py [--ref REV] [--repeat 5] [commands...]
+
+For each command, times `<command> --help`, which imports the script and
+parses its arguments without doing any work:
+
+  ref       python src/<script>.py at git revision REV (e.g. HEAD~1), for
+            comparison with the scripts as they were
+  script    python src/<script>.py as it is now
+  imports   the part of `script` spent importing, from python -X importtime,
+            with the heaviest top-level imports
+  worker    the same command run by the warm worker (src/worker.py) the
+            job runner uses: no interpreter start, libraries preloaded
+
+plus `python -m src` listing the commands. Runs in a temporary directory
+with a copy of config.yaml, so nothing is written under data/.
+"""
+import argparse
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SRC = os.path.join(ROOT, "src")
+sys.path.insert(0, SRC)
+
+import cli
+import worker
+
+COMMANDS = ("download", "dem", "stream", "deriv", "detect", "change", "anomalies", "batch")
+
+_IMPORT = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| (\S.*)$")
+
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def time_script(src, script, repeat):
+    """Median wall seconds of script --help, import seconds and the heaviest top-level imports"""
+    walls, imports = [], []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        r = subprocess.run([sys.executable, "-X", "importtime", os.path.join(src, script), "--help"],
+                           capture_output=True, text=True)
+        walls.append(time.perf_counter() - t0)
+        if r.returncode != 0:
+            raise RuntimeError(f"{script} --help failed:\n{r.stderr[-2000:]}")
+        top = [(int(m[1]) / 1e6, m[2]) for m in map(_IMPORT.match, r.stderr.splitlines()) if m]
+        imports.append((sum(t for t, _ in top), sorted(top, reverse=True)[:3]))
+    return _median(walls), _median(imports)
+
+
+def time_worker(script, repeat):
+    walls = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        remote = worker.spawn([sys.executable, os.path.join(SRC, script), "--help"])
+        for _ in remote.stdout:
+            pass
+        if remote.wait() != 0:
+            raise RuntimeError(f"{script} --help failed in the worker")
+        walls.append(time.perf_counter() - t0)
+    return _median(walls)
+
+
+def _timed(cmd, cwd):
+    t0 = time.perf_counter()
+    subprocess.run(cmd, cwd=cwd, capture_output=True, check=True)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("commands", nargs="*", default=COMMANDS,
+                        help=f"default: {' '.join(COMMANDS)}")
+    parser.add_argument("--ref", help="also time the scripts at this git revision")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    unknown = set(args.commands) - set(cli.COMMANDS)
+    if unknown:
+        parser.error(f"unknown commands: {', '.join(sorted(unknown))}")
+
+    tmp = tempfile.mkdtemp(prefix="bench_startup_")
+    cwd = os.getcwd()
+    pid = None
+    try:
+        shutil.copy(os.path.join(ROOT, "config.yaml"), tmp)
+        shutil.copytree(os.path.join(ROOT, "pipelines"), os.path.join(tmp, "pipelines"))
+        ref_src = None
+        if args.ref:
+            archive = subprocess.run(["git", "-C", ROOT, "archive", args.ref, "src"],
+                                     capture_output=True, check=True).stdout
+            os.makedirs(os.path.join(tmp, "ref"))
+            subprocess.run(["tar", "-x", "-C", os.path.join(tmp, "ref")], input=archive, check=True)
+            ref_src = os.path.join(tmp, "ref", "src")
+        os.chdir(tmp)
+
+        t0 = time.perf_counter()
+        pid = worker.start(wait=60)
+        if pid is None:
+            raise RuntimeError("the worker did not start; see data/jobs/worker.log")
+        print(f"Worker up in {time.perf_counter() - t0:.1f}s (libraries loaded once)\n")
+
+        listing = _median([_timed([sys.executable, "-m", "src"], ROOT)
+                           for _ in range(args.repeat)])
+        print(f"python -m src (command list): {listing:.2f}s\n")
+
+        print(f"{'command':<10} {'ref s':>7} {'script s':>9} {'imports s':>10} {'worker s':>9}  "
+              f"heaviest imports")
+        for name in args.commands:
+            script = cli.COMMANDS[name][0]
+            ref = f"{time_script(ref_src, script, args.repeat)[0]:7.2f}" \
+                if ref_src and os.path.exists(os.path.join(ref_src, script)) else f"{'-':>7}"
+            wall, (imports, top) = time_script(SRC, script, args.repeat)
+            warm = time_worker(script, args.repeat)
+            print(f"{name:<10} {ref} {wall:9.2f} {imports:10.2f} {warm:9.2f}  "
+                  + ", ".join(f"{mod} {t:.2f}" for t, mod in top))
+    finally:
+        if pid:
+            os.kill(pid, signal.SIGTERM)
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Benchmark the horizon SVF kernel on a synthetic DEM.
+
+Usage: python bench/bench_svf.py [rows] [cols]
+
+Reports megapixels per second for 8, 16 and 32 directions. Runs in a
+temporary directory, so nothing is written to data/.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def synthetic_dem(path, rows, cols):
+    """Write a smooth, rolling DEM with some micro-relief noise"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:rows, 0:cols]
+    z = 100 + 20 * np.sin(x / 150) + 15 * np.cos(y / 90) + rng.normal(0, 0.2, (rows, cols))
+    profile = dict(driver="GTiff", width=cols, height=rows, count=1, dtype="float32",
+                   crs="EPSG:25830", transform=from_origin(400000, 4080000, 1, 1),
+                   tiled=True, blockxsize=256, blockysize=256, compress="zstd")
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(z.astype("float32"), 1)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    cols = int(sys.argv[2]) if len(sys.argv) > 2 else rows
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        import process
+
+        synthetic_dem("dem.tif", rows, cols)
+        mpix = rows * cols / 1e6
+        print(f"Synthetic DEM {rows}x{cols} ({mpix:.1f} Mpx), {os.cpu_count()} cores")
+        for directions in (8, 16, 32):
+            t0 = time.perf_counter()
+            process.svf("dem.tif", "svf.tif", directions=directions)
+            dt = time.perf_counter() - t0
+            print(f"  {directions:2d} directions: {dt:6.2f} s  {mpix / dt:6.2f} Mpx/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Deterministic synthetic terrain for the benchmarks.
+
+Rolling hills in EPSG:25830 near Vélez-Málaga with planted archaeological
+features (mounds, walls and ditches), written as a DEM raster, as LAZ tiles
+of ground and vegetation points, and as a zipped tile index like the CNIG
+one whose download URLs point at a local HTTP server. The same seed always
+gives the same files, so benchmark runs on different days or machines
+measure the same work.
+
+    python bench/fixtures.py out/        # write a fixture set to out/
+"""
+import asyncio
+import json
+import os
+import sys
+import zipfile
+
+import geopandas as gpd
+import laspy
+import numpy as np
+import rasterio
+import rasterio.windows
+from aiohttp import web
+from pyproj import CRS, Transformer
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+ORIGIN = (400000.0, 4080000.0)    # top-left corner, EPSG:25830
+EPSG = 25830
+GROUND, VEGETATION = 2, 5
+
+
+def plant_features(width, height, seed=0, per_km2=40):
+    """Mounds, walls and ditches scattered over a width x height m extent
+
+    Returns a list of dicts in map coordinates: mounds have a centre,
+    radius and height, walls and ditches two endpoints, a width and a
+    height (negative for ditches).
+    """
+    rng = np.random.default_rng(seed)
+    x0, y1 = ORIGIN
+    n = max(3, round(per_km2 * width * height / 1e6))
+    features = []
+    for i in range(n):
+        kind = ("túmulo", "muro", "fossa")[i % 3]
+        cx = x0 + rng.uniform(0.05, 0.95) * width
+        cy = y1 - rng.uniform(0.05, 0.95) * height
+        if kind == "túmulo":
+            features.append({"tipo": kind, "x": cx, "y": cy,
+                             "radius": float(rng.uniform(4, 12)),
+                             "height": float(rng.uniform(0.5, 1.5))})
+            continue
+        length, angle = rng.uniform(20, 80), rng.uniform(0, np.pi)
+        dx, dy = np.cos(angle) * length / 2, np.sin(angle) * length / 2
+        features.append({"tipo": kind, "x": cx, "y": cy,
+                         "line": [[cx - dx, cy - dy], [cx + dx, cy + dy]],
+                         "width": 1.0 if kind == "muro" else 2.5,
+                         "height": 0.6 if kind == "muro" else -0.8})
+    return features
+
+
+def _reach(f):
+    """Distance from a feature's centre beyond which it does not change the ground"""
+    if "radius" in f:
+        return 3 * f["radius"]
+    return f["width"] + np.hypot(*np.subtract(*f["line"])) / 2
+
+
+def _relief(f, x, y):
+    """Height a feature adds at x, y"""
+    if "radius" in f:
+        d2 = ((x - f["x"]) ** 2 + (y - f["y"]) ** 2) / f["radius"] ** 2
+        return f["height"] * np.exp(-2 * d2)
+    (ax, ay), (bx, by) = f["line"]
+    ex, ey = bx - ax, by - ay
+    t = np.clip(((x - ax) * ex + (y - ay) * ey) / (ex * ex + ey * ey), 0, 1)
+    d = np.hypot(x - (ax + t * ex), y - (ay + t * ey))
+    return f["height"] * np.clip(1 - d / f["width"], 0, 1)
+
+
+def terrain(x, y, features=(), seed=0):
+    """Ground elevation at map coordinates x, y (arrays) with the features planted"""
+    rng = np.random.default_rng(seed)
+    phases = rng.uniform(0, 2 * np.pi, 4)
+    u, v = x - ORIGIN[0], ORIGIN[1] - y
+    z = (100 + 20 * np.sin(u / 150 + phases[0]) + 15 * np.cos(v / 90 + phases[1])
+         + 3 * np.sin((u + v) / 37 + phases[2]) * np.cos((u - v) / 53 + phases[3]))
+    for f in features:
+        reach = _reach(f)
+        near = (np.abs(x - f["x"]) < reach) & (np.abs(y - f["y"]) < reach)
+        z[near] += _relief(f, x[near], y[near])
+    return z
+
+
+def write_features(path, features):
+    """Planted features as a lon/lat GeoJSON FeatureCollection of points"""
+    to_wgs84 = Transformer.from_crs(EPSG, 4326, always_xy=True)
+    out = []
+    for f in features:
+        lon, lat = to_wgs84.transform(f["x"], f["y"])
+        out.append({"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                    "properties": {k: v for k, v in f.items() if k not in ("x", "y")}})
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump({"type": "FeatureCollection", "features": out}, fh, ensure_ascii=False)
+
+
+def write_dem(path, rows, cols, res=1.0, seed=0, features=None):
+    """Write a rows x cols DEM at res m/pixel; returns the planted features"""
+    if features is None:
+        features = plant_features(cols * res, rows * res, seed)
+    profile = dict(driver="GTiff", width=cols, height=rows, count=1, dtype="float32",
+                   crs=f"EPSG:{EPSG}", transform=from_origin(*ORIGIN, res, res), nodata=-9999,
+                   tiled=True, blockxsize=256, blockysize=256, compress="zstd", bigtiff="IF_SAFER")
+    with rasterio.open(path, "w", **profile) as dst:
+        # A band of rows at a time keeps memory flat for large fixtures
+        step = 1024
+        xs = ORIGIN[0] + (np.arange(cols) + 0.5) * res
+        for r0 in range(0, rows, step):
+            r1 = min(rows, r0 + step)
+            ys = ORIGIN[1] - (np.arange(r0, r1) + 0.5) * res
+            gx, gy = np.meshgrid(xs, ys)
+            z = terrain(gx, gy, (), seed)
+            # On a grid each feature only needs the rows and columns it reaches
+            for f in features:
+                reach = _reach(f)
+                c0, c1 = np.searchsorted(xs, [f["x"] - reach, f["x"] + reach])
+                r0f, r1f = np.searchsorted(-ys, [-(f["y"] + reach), -(f["y"] - reach)])
+                if c1 > c0 and r1f > r0f:
+                    sub = np.s_[r0f:r1f, c0:c1]
+                    z[sub] += _relief(f, gx[sub], gy[sub])
+            z = z.astype("float32")
+            dst.write(z, 1, window=rasterio.windows.Window(0, r0, cols, r1 - r0))
+    return features
+
+
+def tile_grid(nx, ny, size):
+    """(name, bounds) of an nx x ny grid of size m tiles from ORIGIN"""
+    x0, y1 = ORIGIN
+    return [(f"BENCH_{i:02d}_{j:02d}",
+             (x0 + i * size, y1 - (j + 1) * size, x0 + (i + 1) * size, y1 - j * size))
+            for j in range(ny) for i in range(nx)]
+
+
+def write_laz_tiles(out_dir, nx=3, ny=3, size=200.0, density=4.0, seed=0, features=None,
+                    vegetation=0.2):
+    """Write nx x ny LAZ tiles of classified ground and vegetation points
+
+    density is points per m²; a vegetation fraction of the points sits 1-12 m
+    above the ground. Returns (paths, features).
+    """
+    if features is None:
+        features = plant_features(nx * size, ny * size, seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for t, (name, (minx, miny, maxx, maxy)) in enumerate(tile_grid(nx, ny, size)):
+        rng = np.random.default_rng([seed, t])
+        n = int(density * (maxx - minx) * (maxy - miny))
+        x = rng.uniform(minx, maxx, n)
+        y = rng.uniform(miny, maxy, n)
+        z = terrain(x, y, features, seed) + rng.normal(0, 0.03, n)
+        veg = rng.random(n) < vegetation
+        z[veg] += rng.uniform(1, 12, veg.sum())
+        order = np.lexsort((x, np.round(y)))    # scan-line order, like a real flight strip
+
+        header = laspy.LasHeader(point_format=6, version="1.4")
+        header.offsets = [minx, miny, 0.0]
+        header.scales = [0.01, 0.01, 0.01]
+        header.add_crs(CRS.from_epsg(EPSG))
+        las = laspy.LasData(header)
+        las.x, las.y, las.z = x[order], y[order], z[order]
+        las.classification = np.where(veg, VEGETATION, GROUND).astype(np.uint8)[order]
+        las.return_number = np.ones(n, dtype=np.uint8)
+        las.number_of_returns = np.ones(n, dtype=np.uint8)
+        path = f"{out_dir}/{name}.laz"
+        las.write(path, laz_backend=laspy.LazBackend.Lazrs)
+        paths.append(path)
+    return paths, features
+
+
+def write_index(path, tiles, base_url):
+    """Zipped tile index (HOJA, URL_DESCARGA, footprint) like the CNIG one"""
+    idx = gpd.GeoDataFrame(
+        {"HOJA": [name for name, _ in tiles],
+         "URL_DESCARGA": [f"{base_url}/{name}.laz" for name, _ in tiles]},
+        geometry=[box(*bounds) for _, bounds in tiles], crs=EPSG,
+    )
+    gpkg = f"{os.path.splitext(path)[0]}.gpkg"
+    idx.to_file(gpkg)
+    with zipfile.ZipFile(path, "w") as z:
+        z.write(gpkg, os.path.basename(gpkg))
+    os.remove(gpkg)
+    return path
+
+
+def lonlat_bbox(tiles, inset=5.0):
+    """W, S, E, N of the tiles' extent in lon/lat, inset by a few metres"""
+    minx = min(b[0] for _, b in tiles) + inset
+    miny = min(b[1] for _, b in tiles) + inset
+    maxx = max(b[2] for _, b in tiles) - inset
+    maxy = max(b[3] for _, b in tiles) - inset
+    to_wgs84 = Transformer.from_crs(EPSG, 4326, always_xy=True)
+    return list(to_wgs84.transform_bounds(minx, miny, maxx, maxy))
+
+
+async def serve(directory, port, mb_per_s=None, drop_after=None, ranges=True):
+    """Serve the files in directory over HTTP (with Range support); returns the runner
+
+    Stand-ins for a bad link: mb_per_s caps the rate of each response,
+    drop_after closes the connection after that many bytes of each response
+    body, and ranges=False ignores Range headers and always sends the whole
+    file with 200, as some servers do.
+    """
+    app = web.Application()
+    if mb_per_s or drop_after or not ranges:
+        async def flaky(request):
+            path = os.path.join(directory, os.path.basename(request.match_info["name"]))
+            if not os.path.isfile(path):
+                raise web.HTTPNotFound()
+            size = os.path.getsize(path)
+            start = 0
+            if ranges and request.http_range.start is not None:
+                start = request.http_range.start
+                if start >= size:
+                    raise web.HTTPRequestRangeNotSatisfiable(
+                        headers={"Content-Range": f"bytes */{size}"})
+            headers = {"Content-Length": str(size - start)}
+            if start:
+                headers["Content-Range"] = f"bytes {start}-{size - 1}/{size}"
+            resp = web.StreamResponse(status=206 if start else 200, headers=headers)
+            await resp.prepare(request)
+            sent = 0
+            with open(path, "rb") as f:
+                f.seek(start)
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    if drop_after is not None and sent + len(chunk) > drop_after:
+                        await resp.write(chunk[:drop_after - sent])
+                        request.transport.close()
+                        return resp
+                    await resp.write(chunk)
+                    sent += len(chunk)
+                    if mb_per_s:
+                        await asyncio.sleep(len(chunk) / (mb_per_s * 1e6))
+            await resp.write_eof()
+            return resp
+
+        app.router.add_get("/{name}", flaky)
+    else:
+        app.router.add_static("/", directory)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    out = sys.argv[1] if len(sys.argv) > 1 else "fixtures"
+    os.makedirs(out, exist_ok=True)
+    feats = write_dem(f"{out}/dem.tif", 2000, 2000)
+    write_features(f"{out}/features.geojson", feats)
+    laz, _ = write_laz_tiles(f"{out}/laz")
+    write_index(f"{out}/index.zip", tile_grid(3, 3, 200.0), "http://127.0.0.1:8090")
+    print(f"✅ Fixtures in {out}/: dem.tif (2000x2000), {len(laz)} LAZ tiles, "
+          f"{len(feats)} planted features")
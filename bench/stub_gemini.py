@@ -0,0 +1,77 @@
+"""Local stand-in for the Gemini generateContent endpoint.
+
+Usage: python bench/stub_gemini.py [--port 8089] [--latency 0.5] [--error-rate 0.1]
+
+Point the pipeline at it with
+    GEMINI_API_KEY=stub GEMINI_BASE_URL=http://127.0.0.1:8089 python src/detect.py
+
+For every request it decodes the last image (the SVF chip), reports its
+darkest pixel as a "túmulo" and, with --error-rate, answers some requests
+with HTTP 429 to exercise the client's retries. Responses are deterministic
+for a given image.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import random
+
+import numpy as np
+from aiohttp import web
+from PIL import Image
+
+
+def detections_for(image_bytes):
+    """One deterministic detection at the darkest pixel of the image"""
+    arr = np.asarray(Image.open(io.BytesIO(image_bytes)).convert("L"), dtype="float32")
+    row, col = np.unravel_index(np.argmin(arr), arr.shape)
+    score = round(1 - float(arr[row, col]) / 255, 3)
+    return {"features": [{"pixel": [int(col), int(row)], "tipo": "túmulo", "score": score,
+                          "justificacion": "stub: píxel más oscuro del SVF"}]}
+
+
+def make_app(latency=0.0, error_rate=0.0, seed=0):
+    rng = random.Random(seed)
+    stats = {"requests": 0, "errors": 0}
+
+    async def generate(request):
+        stats["requests"] += 1
+        if rng.random() < error_rate:
+            stats["errors"] += 1
+            return web.json_response(
+                {"error": {"code": 429, "message": "stub rate limit", "status": "RESOURCE_EXHAUSTED"}},
+                status=429)
+        body = await request.json()
+        parts = body["contents"][0]["parts"] if body.get("contents") else []
+        images = [p["inlineData"]["data"] for p in parts if "inlineData" in p]
+        if latency:
+            await asyncio.sleep(latency)
+        result = detections_for(base64.urlsafe_b64decode(images[-1])) if images else {"features": []}
+        return web.json_response({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": json.dumps(result)}]},
+                            "finishReason": "STOP"}],
+        })
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/{version}/models/{model}:generateContent", generate)
+    app["stats"] = stats
+    return app
+
+
+async def start(port=8089, **kwargs):
+    """Start the stub in the running event loop; returns the runner to clean up"""
+    app = make_app(**kwargs)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Gemini stub server")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency, args.error_rate), host="127.0.0.1", port=args.port)
@@ -0,0 +1,9 @@
+"""python -m src <command> [args]: see cli.py"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cli
+
+raise SystemExit(cli.main())
@@ -0,0 +1,300 @@
+"""Append-only store of anomaly detections, across runs and AOIs.
+
+Every detection run adds its detections to data/anomalies.sqlite with
+a unique run id (the metrics log's run id plus a random suffix), AOI,
+model, chip, type and score; nothing is overwritten, and a run id is
+never reused; only resetting an AOI's pipeline deletes its runs
+(remove_aoi()). Type and score queries go through B-tree indexes and
+bounding-box queries through an R*Tree over lon/lat, so the app counts,
+ranks and maps the detections of one AOI without reading them all.
+
+The current detections of an AOI are those of its latest full run plus
+any later ROI runs, each of which replaces the detections inside its
+box. clusters() groups detections of one type from any number of runs
+that lie within a few metres of each other, which shows the anomalies
+that recur across runs and models. export() writes GeoJSON one feature at
+a time; detect.py still leaves the current set in outputs/anomalies.geojson.
+
+    python src/anomalies.py                        # runs and counts per AOI
+    python src/anomalies.py --clusters             # anomalies seen by more than one run
+    python src/anomalies.py --export out.geojson --min-score 0.6 --tipo túmulo
+    python src/anomalies.py --import outputs/anomalies.geojson   # an older file as a run
+"""
+import argparse
+import json
+import math
+import os
+import sqlite3
+import time
+import uuid
+
+STORE_DB = "data/anomalies.sqlite"
+CLUSTER_M = 10.0
+M_PER_DEG = 111_320.0
+
+# Properties with their own column; anything else the model returns goes to props
+COLUMNS = ("tipo", "score", "chip", "justificacion")
+
+
+def feature(row):
+    """A stored detection as a GeoJSON Point feature"""
+    props = {"tipo": row["tipo"], "score": row["score"], "justificacion": row["justificacion"],
+             "chip": row["chip"], "run": row["run"], "model": row["model"]}
+    props.update(json.loads(row["props"] or "{}"))
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [row["lon"], row["lat"]]},
+            "properties": {k: v for k, v in props.items() if v is not None}}
+
+
+def write_geojson(path, features):
+    """Write features to path as a FeatureCollection without holding them in memory
+
+    The file is written under a temporary name and renamed, so readers
+    never see half of it. Returns the number of features.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    n = 0
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        for feat in features:
+            f.write(",\n" if n else "\n")
+            f.write(json.dumps(feat, ensure_ascii=False))
+            n += 1
+        f.write("\n]}\n")
+    os.replace(tmp, path)
+    return n
+
+
+def new_run_id(prefix=None):
+    """Run id unique across processes: prefix (default: the time) and a random suffix"""
+    return f"{prefix or time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+class AnomalyStore:
+    def __init__(self, path=STORE_DB):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            " run TEXT, aoi TEXT, model TEXT, prompt TEXT, started REAL, detections INTEGER,"
+            " roi_w REAL, roi_s REAL, roi_e REAL, roi_n REAL, PRIMARY KEY (run, aoi));"
+            "CREATE TABLE IF NOT EXISTS anomalies ("
+            " id INTEGER PRIMARY KEY, run TEXT, aoi TEXT, model TEXT, chip TEXT, tipo TEXT,"
+            " score REAL, lon REAL, lat REAL, justificacion TEXT, props TEXT);"
+            "CREATE INDEX IF NOT EXISTS anomalies_tipo ON anomalies (aoi, tipo, score);"
+            "CREATE INDEX IF NOT EXISTS anomalies_score ON anomalies (aoi, score);"
+            "CREATE INDEX IF NOT EXISTS anomalies_run ON anomalies (run, aoi);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS anomalies_rtree"
+            " USING rtree(id, min_lon, max_lon, min_lat, max_lat);"
+        )
+
+    def add_run(self, run, aoi, model, features, roi=None, prompt=None):
+        """Append one run's GeoJSON Point features; returns how many were stored
+
+        Raises ValueError if the run is already stored for aoi: runs are
+        never replaced, so each one needs a new id (new_run_id()).
+        """
+        rows = []
+        for feat in features:
+            lon, lat = feat["geometry"]["coordinates"][:2]
+            props = dict(feat.get("properties") or {})
+            values = [props.pop(k, None) for k in COLUMNS]
+            values[0] = values[0] or "desconocido"
+            values[1] = float(values[1] or 0)
+            rows.append((run, aoi, model, values[2], values[0], values[1], float(lon), float(lat),
+                         values[3], json.dumps(props, ensure_ascii=False) if props else None))
+        with self.db:
+            try:
+                self.db.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (run, aoi, model, prompt, time.time(), len(rows),
+                                 *(roi or [None] * 4)))
+            except sqlite3.IntegrityError:
+                raise ValueError(f"run {run} is already stored for {aoi}") from None
+            self.db.executemany(
+                "INSERT INTO anomalies (run, aoi, model, chip, tipo, score, lon, lat,"
+                " justificacion, props) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT INTO anomalies_rtree SELECT id, lon, lon, lat, lat "
+                            "FROM anomalies WHERE run = ? AND aoi = ?", (run, aoi))
+        return len(rows)
+
+    def import_geojson(self, path, aoi, model=None):
+        """Add a GeoJSON file of detections, such as one from before the store, as a run"""
+        with open(path, encoding="utf-8") as f:
+            feats = json.load(f).get("features", [])
+        run = new_run_id(f"import-{time.strftime('%Y%m%dT%H%M%S')}")
+        return run, self.add_run(run, aoi, model, feats)
+
+    def remove_aoi(self, aoi):
+        """Delete every run and detection of aoi, as when its pipeline is reset
+
+        Returns the number of runs deleted.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM anomalies_rtree WHERE id IN "
+                            "(SELECT id FROM anomalies WHERE aoi = ?)", (aoi,))
+            self.db.execute("DELETE FROM anomalies WHERE aoi = ?", (aoi,))
+            return self.db.execute("DELETE FROM runs WHERE aoi = ?", (aoi,)).rowcount
+
+    def runs(self, aoi=None):
+        """Runs, newest first, as dicts"""
+        where, params = ("WHERE aoi = ?", (aoi,)) if aoi else ("", ())
+        return [dict(r) for r in self.db.execute(
+            f"SELECT * FROM runs {where} ORDER BY started DESC", params)]
+
+    def _query(self, aoi, bbox=None, tipo=None, min_score=None, current=True):
+        """FROM and WHERE clauses, with parameters, of one AOI's detections"""
+        # CROSS JOIN keeps SQLite from scanning the R*Tree once per row
+        sql = ["FROM anomalies a"]
+        where, params = ["a.aoi = ?"], [aoi]
+        if bbox:
+            sql = ["FROM anomalies_rtree t CROSS JOIN anomalies a ON a.id = t.id"]
+            where.append("t.min_lon >= ? AND t.max_lon <= ? AND t.min_lat >= ? AND t.max_lat <= ?")
+            params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if tipo:
+            where.append("a.tipo = ?")
+            params.append(tipo)
+        if min_score is not None:
+            where.append("a.score >= ?")
+            params.append(min_score)
+        if current:
+            # The latest full run, and later ROI runs replacing what lies in their box;
+            # runs are few, so they are resolved here rather than per row in SQL
+            runs = self.runs(aoi)[::-1]
+            full = max((i for i, r in enumerate(runs) if r["roi_w"] is None), default=0)
+            runs = runs[full:]
+            where.append(f"a.run IN ({', '.join('?' * len(runs)) or 'NULL'})")
+            params += [r["run"] for r in runs]
+            for i, q in enumerate(runs):
+                if q["roi_w"] is not None and i:
+                    where.append(f"NOT (a.run IN ({', '.join('?' * i)}) AND a.lon BETWEEN ? AND ?"
+                                 f" AND a.lat BETWEEN ? AND ?)")
+                    params += [r["run"] for r in runs[:i]]
+                    params += [q["roi_w"], q["roi_e"], q["roi_s"], q["roi_n"]]
+        return " ".join(sql) + " WHERE " + " AND ".join(where), params
+
+    def detections(self, aoi, bbox=None, tipo=None, min_score=None, limit=None, current=True):
+        """Rows of an AOI's detections, best score first, read as they are iterated
+
+        current=False includes every run, not only the current set.
+        """
+        clause, params = self._query(aoi, bbox, tipo, min_score, current)
+        sql = f"SELECT a.* {clause} ORDER BY a.score DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return self.db.execute(sql, params)
+
+    def counts(self, aoi, current=True):
+        """Detections per type"""
+        clause, params = self._query(aoi, current=current)
+        return dict(self.db.execute(
+            f"SELECT a.tipo, COUNT(*) {clause} GROUP BY a.tipo ORDER BY COUNT(*) DESC", params))
+
+    def export(self, path, aoi, **query):
+        """Stream an AOI's detections (see detections()) to a GeoJSON file"""
+        return write_geojson(path, map(feature, self.detections(aoi, **query)))
+
+    def clusters(self, aoi, dist=CLUSTER_M, current=False):
+        """Detections of the same type within dist metres of each other, across runs
+
+        Returns dicts with the type, best score, score-weighted position,
+        number of detections and of distinct runs, most recurrent first.
+        """
+        clause, params = self._query(aoi, current=current)
+        lat = self.db.execute(f"SELECT MAX(ABS(a.lat)) {clause}", params).fetchone()[0]
+        if lat is None:
+            return []
+        # Boxes wide enough at the AOI's highest latitude; exact distances below
+        dlat = dist / M_PER_DEG
+        dlon = dist / (M_PER_DEG * max(math.cos(math.radians(lat)), 1e-6))
+        rows = {r["id"]: r for r in self.db.execute(f"SELECT a.* {clause}", params)}
+        parent = {i: i for i in rows}
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        pairs = self.db.execute(
+            f"SELECT a.id, b.id FROM (SELECT a.* {clause}) a"
+            f" CROSS JOIN anomalies_rtree t CROSS JOIN anomalies b ON b.id = t.id"
+            f" WHERE t.min_lon <= a.lon + ? AND t.max_lon >= a.lon - ?"
+            f" AND t.min_lat <= a.lat + ? AND t.max_lat >= a.lat - ?"
+            f" AND b.id > a.id AND b.aoi = a.aoi AND b.tipo = a.tipo",
+            params + [dlon, dlon, dlat, dlat])
+        for i, j in pairs:
+            if j not in rows:
+                continue
+            a, b = rows[i], rows[j]
+            dx = (a["lon"] - b["lon"]) * M_PER_DEG * math.cos(math.radians(a["lat"]))
+            dy = (a["lat"] - b["lat"]) * M_PER_DEG
+            if math.hypot(dx, dy) < dist:
+                parent[root(j)] = root(i)
+
+        groups = {}
+        for i in rows:
+            groups.setdefault(root(i), []).append(rows[i])
+        out = []
+        for members in groups.values():
+            weights = [m["score"] or 1e-6 for m in members]
+            total = sum(weights)
+            out.append({"tipo": members[0]["tipo"],
+                        "lon": sum(m["lon"] * w for m, w in zip(members, weights)) / total,
+                        "lat": sum(m["lat"] * w for m, w in zip(members, weights)) / total,
+                        "score": max(m["score"] for m in members),
+                        "detections": len(members), "runs": len({m["run"] for m in members}),
+                        "ids": sorted(m["id"] for m in members)})
+        out.sort(key=lambda c: (-c["runs"], -c["score"]))
+        return out
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    import state
+
+    parser = argparse.ArgumentParser(description="Query the anomaly store")
+    parser.add_argument("--aoi", help="AOI name (default: $LIDAR_AOI, else the first one)")
+    parser.add_argument("--clusters", action="store_true",
+                        help="group detections of all runs within --dist metres")
+    parser.add_argument("--dist", type=float, default=CLUSTER_M)
+    parser.add_argument("--export", metavar="PATH", help="write the current detections as GeoJSON")
+    parser.add_argument("--min-score", type=float)
+    parser.add_argument("--tipo")
+    parser.add_argument("--bbox", nargs=4, type=float, metavar=("W", "S", "E", "N"))
+    parser.add_argument("--import", dest="import_path", metavar="PATH",
+                        help="add a GeoJSON file of detections as a run of its own")
+    args = parser.parse_args()
+    aoi = state.area(args.aoi)["name"]
+    store = AnomalyStore()
+
+    if args.import_path:
+        run, n = store.import_geojson(args.import_path, aoi)
+        print(f"✅ {n} detections imported from {args.import_path} as run {run}")
+    elif args.export:
+        t0 = time.perf_counter()
+        n = store.export(args.export, aoi, bbox=args.bbox, tipo=args.tipo,
+                         min_score=args.min_score)
+        print(f"✅ {n} detections written to {args.export} in {time.perf_counter() - t0:.2f}s")
+    elif args.clusters:
+        t0 = time.perf_counter()
+        groups = store.clusters(aoi, args.dist)
+        recurring = [c for c in groups if c["runs"] > 1]
+        print(f"✓ {len(groups)} clusters within {args.dist:g} m in "
+              f"{time.perf_counter() - t0:.2f}s, {len(recurring)} seen by more than one run")
+        for c in recurring[:20]:
+            print(f"  {c['tipo']:<12} {c['lat']:.6f}, {c['lon']:.6f}  score {c['score']:.2f}  "
+                  f"{c['detections']} detections in {c['runs']} runs")
+    else:
+        for r in store.runs(aoi):
+            roi = f"  ROI {r['roi_w']:.4f},{r['roi_s']:.4f},{r['roi_e']:.4f},{r['roi_n']:.4f}" \
+                if r["roi_w"] is not None else ""
+            print(f"  {r['run']:<36} {time.strftime('%Y-%m-%d %H:%M', time.localtime(r['started']))}"
+                  f"  {r['model'] or '-':<16} {r['detections']:>6} detections{roi}")
+        counts = store.counts(aoi)
+        print(f"✓ {sum(counts.values())} current detections in {aoi}: "
+              + (", ".join(f"{n} {t}" for t, n in counts.items()) or "none"))
+    store.close()
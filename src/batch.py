@@ -0,0 +1,102 @@
+"""Run the pipeline for several areas of interest.
+
+Each stage runs for every AOI before the next stage starts, as one
+process per AOI with LIDAR_AOI set, so a LAZ or DEM tile shared by
+overlapping AOIs is downloaded, classified and rasterised for the first
+AOI and taken from the shared store (store.py) for the others. An AOI
+whose stage fails is dropped from the later stages; the others go on.
+
+    python src/batch.py                          # every AOI, every stage
+    python src/batch.py --aoi nerja frigiliana --stages download dem
+    python src/batch.py --gc                     # delete unreferenced store files
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import jobs
+import state
+import store
+import worker
+
+SCRIPTS = {
+    "download": "download.py",
+    "dem": "dem.py",
+    "deriv": "process.py",
+    "detect": "detect.py",
+}
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_stage(stage, name, epoch=None):
+    """Run one stage script for one AOI (and coverage); True if it exited cleanly
+
+    In the warm worker (worker.py) if it is up, else as a subprocess.
+    """
+    env = dict(os.environ, LIDAR_AOI=name)
+    if epoch:
+        env["LIDAR_EPOCH"] = epoch
+    return worker.call([sys.executable, f"{SRC}/{SCRIPTS[stage]}"], env) == 0
+
+
+def referenced():
+    """Every file the AOIs use from the store: LAZ links and recorded DEM tiles"""
+    paths = []
+    epochs = [None, state.settings("change").get("before")]
+    for block in state.areas():
+        for epoch in epochs:
+            p = state.paths(block["name"], epoch=epoch)
+            paths += glob.glob(f"{p['laz']}/*.laz")
+            manifest = state.Manifest(p["manifest"])
+            paths += [out for item in manifest.items("dem").values() for out in item["outputs"]]
+    return paths
+
+
+def batch(names=None, stages=state.STAGES):
+    """Run stages for the named AOIs (default: all); returns {name: failed stage or None}"""
+    names = names or [block["name"] for block in state.areas()]
+    for name in names:
+        state.area(name)
+    stages = [s for s in state.STAGES if s in stages]
+    # One run id in the metrics log (metrics.py) for every stage of the batch
+    os.environ.setdefault("LIDAR_RUN_ID", f"batch-{time.strftime('%Y%m%dT%H%M%S')}")
+    failed = {name: None for name in names}
+    steps, done = len(names) * len(stages), 0
+    for stage in stages:
+        for name in names:
+            done += 1
+            if failed[name]:
+                continue
+            print(f"=== {stage} · {name} ({done}/{steps}) ===", flush=True)
+            t0 = time.perf_counter()
+            if run_stage(stage, name):
+                print(f"✓ {stage} · {name} in {time.perf_counter() - t0:.1f}s", flush=True)
+            else:
+                failed[name] = stage
+                print(f"✗ {stage} failed for {name}; skipping its later stages", flush=True)
+            jobs.progress(done, steps, "steps")
+
+    for name in names:
+        s = state.status(name=name)
+        print(f"  {name:<24} " + "  ".join(f"{k}: {v}" for k, v in s.items())
+              + (f"  ✗ {failed[name]}" if failed[name] else ""))
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline for several AOIs")
+    parser.add_argument("--aoi", nargs="+", help="AOI names from config.yaml (default: all)")
+    parser.add_argument("--stages", nargs="+", choices=state.STAGES, default=state.STAGES)
+    parser.add_argument("--gc", action="store_true",
+                        help="delete store files no AOI refers to, then exit")
+    args = parser.parse_args()
+    if args.gc:
+        files, size = store.gc(referenced())
+        print(f"✅ Removed {files} unreferenced store files ({size / 1e6:.1f} MB)")
+        raise SystemExit(0)
+    failed = batch(args.aoi, args.stages)
+    ok = not any(failed.values())
+    print("✅ Batch complete" if ok else f"⚠ {sum(map(bool, failed.values()))} AOIs failed")
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,232 @@
+"""Block-wise raster helpers shared by the derivative stages.
+
+Large DEMs do not fit in memory, so derivatives are computed one window at a
+time. Each window is read with a halo of extra pixels so that neighbourhood
+filters see the same context they would see on the whole array.
+"""
+import math
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+# Output windows are multiples of the output tile size so every block write
+# lands on whole tiles of the tiled GeoTIFF.
+TILE = 256
+BLOCK = 1024
+
+
+def block_size(src, target=BLOCK):
+    """Pick a window size aligned to the internal tiles of src, close to target"""
+    bh, bw = src.block_shapes[0]
+    if bw >= src.width:
+        # Striped file: no tile grid to follow, use the output tile grid
+        return max(TILE, target // TILE * TILE)
+    step = max(bh, bw, TILE)
+    return max(step, target // step * step)
+
+
+def grid_windows(transform, width, height, block=BLOCK):
+    """Yield windows of at most block x block pixels covering the raster, on a map grid
+
+    Block edges fall on multiples of block pixels from the CRS origin, so a
+    block keeps its map position (and its identity in the state manifest)
+    when the raster's extent grows or shrinks.
+    """
+    col0 = -int(round(transform.c / transform.a)) % block
+    row0 = int(round(transform.f / -transform.e)) % block
+    cols = sorted({0, *range(col0, width, block), width})
+    rows = sorted({0, *range(row0, height, block), height})
+    for r0, r1 in zip(rows, rows[1:]):
+        for c0, c1 in zip(cols, cols[1:]):
+            yield Window(c0, r0, c1 - c0, r1 - r0)
+
+
+def roi_window(src, roi):
+    """Pixel window of src covering roi (W, S, E, N in lon/lat), or None if they do not overlap"""
+    bounds = transform_bounds("EPSG:4326", src.crs, *roi)
+    win = from_bounds(*bounds, transform=src.transform)
+    col0 = max(0, math.floor(win.col_off))
+    row0 = max(0, math.floor(win.row_off))
+    col1 = min(src.width, math.ceil(win.col_off + win.width))
+    row1 = min(src.height, math.ceil(win.row_off + win.height))
+    if col1 <= col0 or row1 <= row0:
+        return None
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+def overlaps(a, b):
+    """True if windows a and b share at least one pixel"""
+    return (a.col_off < b.col_off + b.width and b.col_off < a.col_off + a.width
+            and a.row_off < b.row_off + b.height and b.row_off < a.row_off + a.height)
+
+
+def chip_windows(area, size, overlap):
+    """Overlapping size x size windows covering area, clipped to it"""
+    step = size - overlap
+    rows = range(int(area.row_off), int(area.row_off + max(area.height - overlap, 1)), step)
+    cols = range(int(area.col_off), int(area.col_off + max(area.width - overlap, 1)), step)
+    return [Window(col, row, size, size).intersection(area) for row in rows for col in cols]
+
+
+def chip_core(win, area, overlap):
+    """Part of a chip from chip_windows() that no neighbour owns: half of each shared overlap
+
+    The cores of all chips tile the area without gaps or overlap, so a
+    feature found in several chips can be kept only by the chip whose core
+    holds its centre. Returns (row0, col0, row1, col1) in pixels.
+    """
+    half = overlap // 2
+    row0 = win.row_off + (half if win.row_off > area.row_off else 0)
+    col0 = win.col_off + (half if win.col_off > area.col_off else 0)
+    row1 = win.row_off + win.height
+    col1 = win.col_off + win.width
+    row1 -= overlap - half if row1 < area.row_off + area.height else 0
+    col1 -= overlap - half if col1 < area.col_off + area.width else 0
+    return row0, col0, row1, col1
+
+
+def halo_window(win, halo, width, height):
+    """Expand win by halo pixels on each side, clipped to the raster bounds.
+
+    Returns the window to read and the (rows, cols) slices that cut the
+    original window back out of the array read with it.
+    """
+    col0 = max(0, win.col_off - halo)
+    row0 = max(0, win.row_off - halo)
+    col1 = min(width, win.col_off + win.width + halo)
+    row1 = min(height, win.row_off + win.height + halo)
+    read_win = Window(col0, row0, col1 - col0, row1 - row0)
+    core = (slice(win.row_off - row0, win.row_off - row0 + win.height),
+            slice(win.col_off - col0, win.col_off - col0 + win.width))
+    return read_win, core
+
+
+def tiled_profile(profile, **updates):
+    """Copy a raster profile as a compressed, tiled GeoTIFF profile"""
+    out = profile.copy()
+    out.update(
+        driver="GTiff",
+        tiled=True,
+        blockxsize=TILE,
+        blockysize=TILE,
+        compress="zstd",
+        BIGTIFF="IF_SAFER",
+    )
+    out.update(updates)
+    return out
+
+
+def build_overviews(path, resampling=Resampling.average):
+    """Rebuild the internal overview pyramid of a tiled GeoTIFF
+
+    Levels halve the resolution until the coarsest one fits in a single
+    tile, so a map viewer at any zoom reads at most a few tiles. Overviews
+    are rebuilt in place after the blocks change, keeping the file writable
+    block by block instead of re-copying it to a strict COG layout.
+    """
+    with rasterio.open(path, "r+") as dst:
+        factors, f = [], 2
+        while max(dst.width, dst.height) / (f // 2) > TILE:
+            factors.append(f)
+            f *= 2
+        if factors:
+            dst.build_overviews(factors, resampling)
+            dst.update_tags(ns="rio_overview", resampling=resampling.name)
+
+
+def read_padded(src, win, halo, band=1):
+    """Read win plus a halo as float32, with NaN outside the raster and at nodata.
+
+    The returned array always has shape (height + 2*halo, width + 2*halo), so
+    kernels can index the halo without caring about raster edges.
+    """
+    read_win, core = halo_window(win, halo, src.width, src.height)
+    arr = src.read(band, window=read_win).astype("float32")
+    if src.nodata is not None:
+        arr[arr == src.nodata] = np.nan
+    pad = ((halo - core[0].start, halo - (arr.shape[0] - core[0].stop)),
+           (halo - core[1].start, halo - (arr.shape[1] - core[1].stop)))
+    return np.pad(arr, pad, constant_values=np.nan)
+
+
+def summed_area(a):
+    """Summed-area table of a with a leading row and column of zeros"""
+    table = np.zeros((a.shape[0] + 1, a.shape[1] + 1), dtype="float64")
+    np.cumsum(np.cumsum(a, axis=0, dtype="float64"), axis=1, out=table[1:, 1:])
+    return table
+
+
+def box_sum(table, r):
+    """Sum over the (2r + 1)² window around every pixel from a summed-area table
+
+    Windows are clipped at the array edges; the cost does not depend on r.
+    """
+    h, w = table.shape[0] - 1, table.shape[1] - 1
+    r0 = np.clip(np.arange(h) - r, 0, h)[:, None]
+    r1 = np.clip(np.arange(h) + r + 1, 0, h)[:, None]
+    c0 = np.clip(np.arange(w) - r, 0, w)[None, :]
+    c1 = np.clip(np.arange(w) + r + 1, 0, w)[None, :]
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+
+def box_mean(a, r, tables=None):
+    """NaN-aware mean of a over (2r + 1)² windows
+
+    tables is (summed_area(values with NaN as 0), summed_area(valid mask)) if already built.
+    """
+    if tables is None:
+        valid = ~np.isnan(a)
+        tables = (summed_area(np.where(valid, a, 0)), summed_area(valid))
+    count = box_sum(tables[1], r)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Where the window has no data the value sums leave rounding residue
+        return np.where(count > 0, box_sum(tables[0], r) / count, np.nan)
+
+
+def map_blocks(fn, jobs, workers=None):
+    """Run fn(*job) for each job in a process pool, yielding (job, result).
+
+    Results come back in submission order and at most 2 * workers blocks are
+    in flight, so the caller can write each result as it arrives without the
+    pool racing ahead and holding the whole raster in memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    jobs = iter(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append((job, pool.submit(fn, *job)))
+            if len(pending) >= 2 * workers:
+                job, fut = pending.popleft()
+                yield job, fut.result()
+        while pending:
+            job, fut = pending.popleft()
+            yield job, fut.result()
+
+
+def scratch_dir():
+    """Temporary directory for uncompressed block scratch, in RAM (/dev/shm) where there is one"""
+    return tempfile.TemporaryDirectory(prefix="blocks-",
+                                       dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+
+def run_scratch(fn, path, pad, halo, *args):
+    """Worker: fn(arr, *args) on the block saved at path, returning (result, seconds)
+
+    The block was saved with pad pixels of halo (np.save); it is memory-mapped
+    rather than copied, and cut down to the halo <= pad that fn expects.
+    """
+    t0 = time.perf_counter()
+    arr = np.asarray(np.load(path, mmap_mode="r"))
+    cut = pad - halo
+    if cut:
+        arr = arr[cut:arr.shape[0] - cut, cut:arr.shape[1] - cut]
+    return fn(arr, *args), time.perf_counter() - t0
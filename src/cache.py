@@ -0,0 +1,88 @@
+"""Persistent cache of model responses, keyed by what was sent.
+
+The key is the sha256 of the image bytes, the prompt text and the model
+name, so an unchanged chip is never sent twice while any change to its
+pixels, the prompt or the model is a miss. Values are the parsed JSON
+returned by the model. Entries expire after max_age seconds and the least
+recently used ones are dropped once the cache grows past max_bytes.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+CACHE_DB = "data/cache/responses.sqlite"
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_DB, max_bytes=512 * 1024 * 1024, max_age=30 * 86400):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, value TEXT, size INTEGER,"
+            " created REAL, used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(images, prompt, model):
+        h = hashlib.sha256()
+        for part in (model, prompt, *images):
+            data = part.encode() if isinstance(part, str) else part
+            h.update(len(data).to_bytes(8, "little"))
+            h.update(data)
+        return h.hexdigest()
+
+    def get(self, key):
+        """Cached value for key, or None; counts the lookup as a hit or a miss"""
+        row = self.db.execute(
+            "SELECT value FROM responses WHERE key = ? AND created > ?",
+            (key, time.time() - self.max_age),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.db:
+            self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, model, value):
+        blob = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, blob, len(blob), now, now),
+            )
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones down to max_bytes"""
+        with self.db:
+            self.db.execute("DELETE FROM responses WHERE created <= ?",
+                            (time.time() - self.max_age,))
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                doomed, freed = [], 0
+                for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY used"):
+                    if freed >= excess:
+                        break
+                    doomed.append((key,))
+                    freed += size
+                self.db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0
+        return f"cache {self.hits}/{lookups} hits ({rate:.0f}%)"
+
+    def close(self):
+        self.evict()
+        self.db.close()
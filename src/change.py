@@ -0,0 +1,248 @@
+"""Change detection between two PNOA-LiDAR coverages of an AOI.
+
+Recent earthworks and looting pits show up as elevation changes between
+coverages. `change.before` in config.yaml names the laz_version of the
+earlier one; its tiles are downloaded and rasterised by the usual stage
+scripts run with LIDAR_EPOCH set (see state.py), into epochs/<version>/,
+with the same pipeline and so on the same snapped grid. The current
+coverage is the AOI's own DEM.
+
+The DEM of difference (current minus earlier) is computed block by block
+across a process pool. The earlier DEM is read through a WarpedVRT on the
+current grid, which comes down to a windowed read when the two already
+line up. A difference counts only beyond the minimum level of detection
+
+    LoD = z * sqrt(sigma_before² + sigma_after²) * (1 + slope_factor * tan(slope))
+
+with z the two-sided normal quantile of the confidence level: on steep
+ground a small horizontal offset between the coverages shifts the
+elevation as well. Each worker also polygonises the significant regions
+of its block, and regions cut by block edges are merged at the end, so
+memory holds a few blocks plus the changed polygons whatever the size of
+the area.
+
+Writes the difference and level of detection as the two bands of
+dod.tif in the derivatives directory, and outputs/changes.geojson with
+one polygon per changed region: its area, volume, and mean and largest
+change.
+
+    python src/change.py                 # build the earlier DEM if needed, then compare
+    python src/change.py --no-build      # compare the DEMs as they are
+"""
+import argparse
+import json
+import math
+import os
+import time
+from statistics import NormalDist
+
+import numpy as np
+import rasterio
+from pyproj import Transformer
+from rasterio import features
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import bounds as window_bounds
+from scipy import ndimage
+from shapely import STRtree
+from shapely.geometry import mapping, shape
+from shapely.ops import transform as transform_geom
+from shapely.ops import unary_union
+
+import blocks
+import jobs
+import metrics
+import state
+from batch import run_stage
+
+# Error model and filters; config.yaml's `change:` section overrides them
+CHANGE = {
+    "before": None,            # laz_version of the earlier coverage
+    "sigma_before_m": 0.15,    # vertical RMSE of each coverage
+    "sigma_after_m": 0.10,
+    "confidence": 0.95,        # of the level of detection
+    "slope_factor": 1.0,       # LoD grows by this times tan(slope)
+    "min_area_m2": 10.0,       # smaller changed regions are dropped
+}
+GAIN, LOSS = "relleno", "excavación"
+
+
+def settings():
+    return dict(CHANGE, **state.settings("change"))
+
+
+def base_lod(cfg):
+    """Level of detection on flat ground, in metres"""
+    z = NormalDist().inv_cdf(0.5 + cfg["confidence"] / 2)
+    return z * math.hypot(cfg["sigma_before_m"], cfg["sigma_after_m"])
+
+
+def _regions(dz, sign, transform):
+    """(geometry, sign, pixels, sum of dz, largest |dz|) of each connected changed region"""
+    regions = []
+    for s in (1, -1):
+        labels, n = ndimage.label(sign == s)
+        if not n:
+            continue
+        flat = labels.ravel()
+        pixels = np.bincount(flat, minlength=n + 1)
+        total = np.bincount(flat, weights=dz.ravel(), minlength=n + 1)
+        extreme = ndimage.maximum(np.abs(dz), labels, np.arange(n + 1))
+        for geom, i in features.shapes(labels, mask=labels > 0, transform=transform):
+            i = int(i)
+            regions.append((geom, s, int(pixels[i]), float(total[i]), float(extreme[i])))
+    return regions
+
+
+def _dod_block(after, before, win, lod, slope_factor):
+    """Worker: difference, level of detection and changed regions of one block"""
+    with rasterio.open(after) as a, rasterio.open(before) as b, \
+            WarpedVRT(b, crs=a.crs, transform=a.transform, width=a.width, height=a.height,
+                      resampling=Resampling.bilinear) as vb:
+        za = blocks.read_padded(a, win, 1)
+        zb = blocks.read_padded(vb, win, 0)
+        res = a.res[0]
+        transform = a.window_transform(win)
+    gy, gx = np.gradient(za, res)
+    tan = np.nan_to_num(np.hypot(gx, gy)[1:-1, 1:-1])
+    dz = za[1:-1, 1:-1] - zb
+    level = (lod * (1 + slope_factor * tan)).astype("float32")
+    with np.errstate(invalid="ignore"):
+        sign = np.where(np.abs(dz) > level, np.sign(dz), 0).astype("int8")
+    labelled = _regions(np.nan_to_num(dz), sign, transform)
+    return np.stack([dz, level]), labelled
+
+
+def merge(pieces):
+    """Join the pieces of regions cut by block edges, adding up their statistics"""
+    merged = []
+    for s in (1, -1):
+        group = [p for p in pieces if p[1] == s]
+        if not group:
+            continue
+        geoms = [p[0] for p in group]
+        tree = STRtree(geoms)
+        union = unary_union(geoms)
+        for part in getattr(union, "geoms", [union]):
+            # Pieces touching the part only at a corner are not in it
+            idx = [i for i in tree.query(part, predicate="intersects")
+                   if part.contains(geoms[i].representative_point())]
+            merged.append((part, s, sum(group[i][2] for i in idx),
+                           sum(group[i][3] for i in idx), max(group[i][4] for i in idx)))
+    return merged
+
+
+def to_geojson(regions, crs, res, min_area):
+    """Changed regions of at least min_area m² as a lon/lat GeoJSON FeatureCollection"""
+    to_wgs84 = Transformer.from_crs(crs, "EPSG:4326", always_xy=True).transform
+    out = []
+    for geom, s, pixels, total, extreme in regions:
+        area = pixels * res * res
+        if area < min_area:
+            continue
+        out.append({"type": "Feature",
+                    "geometry": mapping(transform_geom(to_wgs84, geom)),
+                    "properties": {"tipo": GAIN if s > 0 else LOSS,
+                                   "area_m2": round(area, 1),
+                                   "volumen_m3": round(total * res * res, 2),
+                                   "dz_medio_m": round(total / pixels, 3),
+                                   "dz_max_m": round(s * extreme, 3)}})
+    out.sort(key=lambda f: -abs(f["properties"]["volumen_m3"]))
+    return {"type": "FeatureCollection", "features": out}
+
+
+def dem_of_difference(after, before, out=None, output=None, cfg=None, block=None, workers=None):
+    """Difference after - before on the grid of after, and its changed regions as GeoJSON
+
+    out (the difference raster) and output (the regions) default to the
+    AOI's dod.tif and changes.geojson. Returns the number of changed regions
+    written.
+    """
+    paths = state.paths()
+    out = out or f"{paths['deriv']}/dod.tif"
+    output = output or paths["changes"]
+    cfg = cfg or settings()
+    lod = base_lod(cfg)
+    with rasterio.open(after) as src:
+        size = block or blocks.block_size(src)
+        windows = list(blocks.grid_windows(src.transform, src.width, src.height, size))
+        profile = dict(driver="GTiff", width=src.width, height=src.height, count=2,
+                       dtype="float32", crs=src.crs, transform=src.transform, nodata=np.nan,
+                       tiled=True, blockxsize=blocks.TILE, blockysize=blocks.TILE,
+                       compress="zstd", bigtiff="IF_SAFER")
+        crs, res = src.crs, src.res[0]
+    print(f"DEM of difference over {len(windows)} blocks "
+          f"(level of detection {lod:.2f} m on flat ground)...")
+
+    t0 = time.perf_counter()
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    regions, edge = [], []
+    with rasterio.open(out, "w", **profile) as dst:
+        dst.descriptions = ("dod", "lod")
+        work = ((after, before, win, lod, cfg["slope_factor"]) for win in windows)
+        for i, ((_, _, win, _, _), (arr, found)) in enumerate(
+                blocks.map_blocks(_dod_block, work, workers), 1):
+            dst.write(arr, window=win)
+            x0, y0, x1, y1 = window_bounds(win, profile["transform"])
+            for geom, *stats in found:
+                poly = shape(geom)
+                bx0, by0, bx1, by1 = poly.bounds
+                # Only regions reaching the block's edge can continue in the next block
+                cut = min(bx0 - x0, by0 - y0, x1 - bx1, y1 - by1) < res / 2
+                (edge if cut else regions).append((poly, *stats))
+            metrics.count(win.width * win.height / 1e6)
+            jobs.progress(i, len(windows), "blocks")
+    blocks.build_overviews(out)
+    regions += merge(edge)
+
+    result = to_geojson(regions, crs, res, cfg["min_area_m2"])
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    found = result["features"]
+    dt = time.perf_counter() - t0
+    mpx = profile["width"] * profile["height"] / 1e6
+    gains = sum(f["properties"]["tipo"] == GAIN for f in found)
+    print(f"✓ {mpx:.1f} Mpx in {dt:.1f}s ({mpx / dt:.1f} Mpx/s)")
+    print(f"✓ {len(found)} changed regions of at least {cfg['min_area_m2']:g} m²: "
+          f"{gains} raised ({GAIN}), {len(found) - gains} lowered ({LOSS})")
+    print(f"✅ DEM of difference written to {out}, changes to {output}")
+    return len(found)
+
+
+def build(before, name=None):
+    """Bring the DEMs of both coverages up to date with the stage scripts; True if they are"""
+    name = name or state.area()["name"]
+    for epoch in (before, None):
+        status = state.status(name=name, epoch=epoch)
+        for stage in ("download", "dem"):
+            if status[stage] == "fresh":
+                continue
+            print(f"=== {stage} · {epoch or state.area(name)['laz_version']} ===", flush=True)
+            if not run_stage(stage, name, epoch):
+                print(f"✗ {stage} failed for laz_version {epoch}")
+                return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEM of difference against an earlier coverage")
+    parser.add_argument("--before", help="laz_version of the earlier coverage (default change.before)")
+    parser.add_argument("--no-build", action="store_true",
+                        help="compare the existing DEMs without downloading or rebuilding them")
+    args = parser.parse_args()
+    cfg = settings()
+    before = args.before or cfg["before"]
+    if not before:
+        print("✗ No earlier coverage: set change.before in config.yaml or pass --before")
+        raise SystemExit(1)
+    after_dem, before_dem = state.paths()["dem"], state.paths(epoch=before)["dem"]
+    with metrics.stage("change", "Mpx") as run:
+        if not args.no_build and not build(before):
+            run["ok"] = False
+        elif not (os.path.exists(after_dem) and os.path.exists(before_dem)):
+            print(f"✗ Missing DEM: {after_dem if not os.path.exists(after_dem) else before_dem}")
+            run["ok"] = False
+        else:
+            dem_of_difference(after_dem, before_dem, cfg=cfg)
+    raise SystemExit(0 if run["ok"] else 1)
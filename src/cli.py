@@ -0,0 +1,81 @@
+"""Single entry point for the pipeline commands.
+
+    python -m src                       # list the commands
+    python -m src dem --roi W S E N     # same as python src/dem.py --roi W S E N
+    python -m src worker                # warm worker for the job runner (worker.py)
+
+Each command is one of the scripts in this directory, run exactly as
+`python src/<script>.py` would run it, but only the script asked for is
+imported: listing the commands loads no geospatial library, and the stage
+modules import google.genai, geopandas, laspy and scipy where they use
+them. `alias lidar="python -m src"` gives a `lidar` command.
+"""
+import os
+import runpy
+import sys
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+COMMANDS = {
+    "download": ("download.py", "download the AOI's LAZ tiles"),
+    "ingest": ("ingest.py", "index LAZ headers: bounds, density, classes, corrupt tiles"),
+    "dem": ("dem.py", "DEM tiles with PDAL and their mosaic"),
+    "stream": ("stream.py", "download and DEM overlapped, tile by tile"),
+    "deriv": ("process.py", "hillshade, SVF and relief layers"),
+    "prescreen": ("prescreen.py", "local pre-screen of the detection chips"),
+    "detect": ("detect.py", "anomaly detection with Gemini"),
+    "change": ("change.py", "DEM of difference against an earlier coverage"),
+    "anomalies": ("anomalies.py", "query and export the anomaly store"),
+    "batch": ("batch.py", "every stage for several AOIs"),
+    "tiles": ("tiles.py", "XYZ tile server of the rasters"),
+    "metrics": ("metrics.py", "last runs per stage, with regressions"),
+    "jobs": ("jobs.py", "last background job per stage"),
+    "worker": ("worker.py", "warm worker that runs jobs without a fresh interpreter"),
+}
+
+
+def usage():
+    print("usage: python -m src <command> [args]    (--help after a command for its options)\n")
+    for name, (script, text) in COMMANDS.items():
+        print(f"  {name:<10} {text}")
+
+
+def resolve(cmd, cwd=None):
+    """(script path, args) of a command line that runs a script of this directory
+
+    Accepts [python, src/<script>.py, *args] and [python, -m, src, <command>,
+    *args], with relative paths taken from cwd; returns None for anything else.
+    """
+    if len(cmd) < 2 or not os.path.basename(cmd[0]).startswith("python"):
+        return None
+    if cmd[1:3] == ["-m", "src"] and len(cmd) > 3 and cmd[3] in COMMANDS:
+        return os.path.join(SRC, COMMANDS[cmd[3]][0]), list(cmd[4:])
+    path = os.path.abspath(os.path.join(cwd or os.getcwd(), cmd[1]))
+    if os.path.dirname(path) == SRC and path.endswith(".py") and os.path.exists(path):
+        return path, list(cmd[2:])
+    return None
+
+
+def run_script(path, args=()):
+    """Run a script as __main__ in this process, with the sys.argv and sys.path it expects"""
+    sys.argv = [path, *args]
+    if sys.path[0] != SRC:
+        sys.path.insert(0, SRC)
+    runpy.run_path(path, run_name="__main__")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help"):
+        usage()
+        return 0
+    if argv[0] not in COMMANDS:
+        print(f"✗ Unknown command {argv[0]!r}")
+        usage()
+        return 2
+    run_script(os.path.join(SRC, COMMANDS[argv[0]][0]), argv[1:])
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,323 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from xml.sax.saxutils import escape
+
+import rasterio
+import rasterio.shutil
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+import ingest
+import metrics
+import state
+import store
+from jobs import progress as job_progress
+
+PIPELINE = "pipelines/laz2dem.json"
+
+# Points borrowed from neighbouring tiles so SMRF and IDW see across edges
+BUFFER = 20.0
+
+
+
+def load_template(path=PIPELINE):
+    """Load laz2dem.json and split it into filter stages and writer options"""
+    with open(path) as f:
+        stages = json.load(f)["pipeline"]
+    filters = [s for s in stages if s["type"].startswith("filters.")]
+    writer = next(s for s in stages if s["type"] == "writers.gdal")
+    return filters, writer
+
+
+def snap_bounds(b, resolution):
+    snap = lambda v: round(v / resolution) * resolution  # noqa: E731
+    return snap(b["minx"]), snap(b["miny"]), snap(b["maxx"]), snap(b["maxy"])
+
+
+def tile_bounds(laz, resolution):
+    """Read a tile's extent from its header, snapped to the output grid
+
+    Taken from the LAZ index when it is current for the file, otherwise
+    from `pdal info`.
+    """
+    row = ingest.lookup(laz)
+    if row and row["ok"]:
+        return snap_bounds(row, resolution)
+    result = subprocess.run(["pdal", "info", "--summary", laz],
+                            capture_output=True, text=True, check=True)
+    return snap_bounds(json.loads(result.stdout)["summary"]["bounds"], resolution)
+
+
+def neighbours(bounds, tiles, buffer=BUFFER):
+    """Tiles whose extent intersects bounds grown by buffer"""
+    minx, miny, maxx, maxy = bounds
+    return [path for path, (x0, y0, x1, y1) in tiles.items()
+            if x0 < maxx + buffer and x1 > minx - buffer
+            and y0 < maxy + buffer and y1 > miny - buffer]
+
+
+def tile_pipeline(laz, bounds, sources, filters, writer, out, buffer=BUFFER):
+    """PDAL pipeline for one tile: read it plus its neighbours, crop to the
+    buffered extent, classify, and rasterise only the tile's own extent"""
+    minx, miny, maxx, maxy = bounds
+    res = writer["resolution"]
+    stages = [{"type": "readers.las", "filename": src} for src in sources]
+    stages.append({
+        "type": "filters.crop",
+        "bounds": f"([{minx - buffer}, {maxx + buffer}], [{miny - buffer}, {maxy + buffer}])",
+    })
+    stages += filters
+    stages.append(dict(
+        writer,
+        filename=out,
+        origin_x=minx,
+        origin_y=miny,
+        width=int(round((maxx - minx) / res)),
+        height=int(round((maxy - miny) / res)),
+    ))
+    return {"pipeline": stages}
+
+
+def tile_name(laz):
+    return os.path.splitext(os.path.basename(laz))[0]
+
+
+def build_tile(laz, bounds, sources, filters, writer, out):
+    """Run the PDAL pipeline for one tile into out, unless the store already has it"""
+    if os.path.exists(out):
+        metrics.item(tile_name(laz), cached=True)
+        return out
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    tmp = store.partial(out)
+    pipeline = tile_pipeline(laz, bounds, sources, filters, writer, tmp)
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(["pdal", "pipeline", "--stdin"], stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    proc.stdin.write(json.dumps(pipeline))
+    proc.stdin.close()
+    stderr = proc.stderr.read()
+    proc.stderr.close()
+    # wait4 rather than wait: the rusage is this PDAL run's own, whatever
+    # the other worker threads are doing
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise RuntimeError(stderr.strip() or f"pdal exited with {proc.returncode}")
+    store.publish(tmp, out)
+    metrics.count(1)
+    metrics.item(tile_name(laz), seconds=round(time.perf_counter() - t0, 3),
+                 cpu=round(usage.ru_utime + usage.ru_stime, 3),
+                 rss_mb=round(usage.ru_maxrss / 1024, 1),
+                 mb=round(os.path.getsize(out) / 1e6, 2))
+    return out
+
+
+def build_vrt(tile_paths, vrt=None):
+    """Write a VRT mosaic of per-tile GeoTIFFs that share one grid (default: the AOI's)"""
+    vrt = vrt or state.paths()["vrt"]
+    os.makedirs(os.path.dirname(vrt) or ".", exist_ok=True)
+    metas = []
+    for path in tile_paths:
+        with rasterio.open(path) as src:
+            metas.append((path, src.width, src.height, src.transform, src.crs,
+                          src.dtypes[0], src.nodata))
+    _, _, _, t0, crs, dtype, nodata = metas[0]
+    res = t0.a
+    minx = min(t.c for _, _, _, t, *_ in metas)
+    maxy = max(t.f for _, _, _, t, *_ in metas)
+    maxx = max(t.c + w * res for _, w, _, t, *_ in metas)
+    miny = min(t.f - h * res for _, _, h, t, *_ in metas)
+    width = int(round((maxx - minx) / res))
+    height = int(round((maxy - miny) / res))
+    gdal_type = {"float32": "Float32", "float64": "Float64"}.get(dtype, "Float64")
+    nodata_xml = f"<NoDataValue>{nodata}</NoDataValue>" if nodata is not None else ""
+
+    sources = []
+    for path, w, h, t, *_ in metas:
+        xoff = int(round((t.c - minx) / res))
+        yoff = int(round((maxy - t.f) / res))
+        rel = os.path.relpath(path, os.path.dirname(vrt))
+        sources.append(
+            f'<ComplexSource><SourceFilename relativeToVRT="1">{escape(rel)}</SourceFilename>'
+            f"<SourceBand>1</SourceBand>"
+            f'<SrcRect xOff="0" yOff="0" xSize="{w}" ySize="{h}"/>'
+            f'<DstRect xOff="{xoff}" yOff="{yoff}" xSize="{w}" ySize="{h}"/>'
+            + (f"<NODATA>{nodata}</NODATA>" if nodata is not None else "")
+            + "</ComplexSource>"
+        )
+    xml = (
+        f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">'
+        f"<SRS>{escape(crs.to_wkt()) if crs else ''}</SRS>"
+        f"<GeoTransform>{minx}, {res}, 0, {maxy}, 0, {-res}</GeoTransform>"
+        f'<VRTRasterBand dataType="{gdal_type}" band="1">{nodata_xml}'
+        + "".join(sources)
+        + "</VRTRasterBand></VRTDataset>"
+    )
+    with open(vrt, "w") as f:
+        f.write(xml)
+    return vrt
+
+
+def roi_bounds(roi, laz_files):
+    """roi (W, S, E, N in lon/lat) in the CRS of the LAZ tiles, from the index"""
+    crs = next((r["crs"] for r in ingest.tiles("ok AND crs IS NOT NULL")
+                if r["path"] in laz_files), None)
+    if crs is None:
+        raise ValueError("the LAZ index has no CRS for these tiles")
+    return transform_bounds("EPSG:4326", crs, *roi)
+
+
+def patch_mosaic(tile_paths, dem=None):
+    """Write rebuilt tiles into the existing mosaic (default: the AOI's DEM) in place
+
+    Returns False, writing nothing, if any tile is not inside the mosaic on
+    its grid; the caller then rebuilds the whole mosaic instead.
+    """
+    dem = dem or state.paths()["dem"]
+    if not os.path.exists(dem):
+        return False
+    with ExitStack() as stack:
+        dst = stack.enter_context(rasterio.open(dem, "r+", IGNORE_COG_LAYOUT_BREAK="YES"))
+        updates = []
+        for path in tile_paths:
+            src = stack.enter_context(rasterio.open(path))
+            win = from_bounds(*src.bounds, transform=dst.transform)
+            col, row = round(win.col_off), round(win.row_off)
+            if (src.res != dst.res or abs(win.col_off - col) > 1e-6
+                    or abs(win.row_off - row) > 1e-6 or col < 0 or row < 0
+                    or col + src.width > dst.width or row + src.height > dst.height):
+                return False
+            updates.append((src, Window(col, row, src.width, src.height)))
+        for src, win in updates:
+            dst.write(src.read(1), 1, window=win)
+    return True
+
+
+def build_dem(laz_dir=None, workers=None, manifest=None, roi=None):
+    """Build the DEM with one PDAL pipeline per LAZ tile and mosaic the result
+
+    Only tiles whose own points, neighbours' points or pipeline changed since
+    the last run (per the state manifest) are rebuilt. With roi (W, S, E, N
+    in lon/lat) only the out-of-date tiles under it are rebuilt and patched
+    into the existing mosaic, and the stage is left unsealed. laz_dir
+    defaults to the AOI's.
+    """
+    paths = state.paths()
+    laz_dir, dem = laz_dir or paths["laz"], paths["dem"]
+    laz_files = sorted(glob.glob(f"{laz_dir}/*.laz"))
+    if not laz_files:
+        print(f"✗ No LAZ files found in {laz_dir}")
+        return False
+
+    manifest = manifest or state.Manifest()
+    ingest.ingest(laz_dir, manifest=manifest)
+    corrupt = {r["path"]: r["error"] for r in ingest.tiles("NOT ok")}
+    params = state.stage_params("dem")
+    filters, writer = load_template()
+    res = writer["resolution"]
+    items = manifest.items("dem")
+
+    tiles, hashes = {}, {}
+    for laz in laz_files:
+        if laz in corrupt:
+            print(f"✗ Skipping corrupt tile {os.path.basename(laz)}: {corrupt[laz]}")
+            continue
+        hashes[laz] = manifest.file_hash(laz)
+        item = items.get(tile_name(laz))
+        if item and item.get("laz_sha") == hashes[laz]:
+            tiles[laz] = tuple(item["bounds"])
+            continue
+        try:
+            tiles[laz] = tile_bounds(laz, res)
+        except (subprocess.CalledProcessError, KeyError, ValueError) as e:
+            print(f"✗ Skipping unreadable tile {os.path.basename(laz)}: {e}")
+
+    removed = manifest.prune("dem", keep={tile_name(laz) for laz in tiles})
+    for item in removed.values():
+        for path in item["outputs"]:
+            # Store tiles may be shared with other AOIs; store.gc() cleans them up
+            if os.path.exists(path) and not store.contains(path):
+                os.remove(path)
+
+    area = roi_bounds(roi, laz_files) if roi else None
+    jobs = {}
+    for laz, bounds in tiles.items():
+        if area and not neighbours(area, {laz: bounds}, buffer=0):
+            continue
+        sources = neighbours(bounds, tiles)
+        d = state.digest(params, BUFFER, bounds, sorted(hashes[s] for s in sources))
+        if manifest.stale("dem", tile_name(laz), d):
+            jobs[laz] = (bounds, sources, d)
+
+    workers = workers or os.cpu_count() or 1
+    shared = sum(os.path.exists(store.dem_tile(d)) for _, _, d in jobs.values())
+    print(f"Building DEM: {len(jobs)} of {len(tiles)} tiles out of date "
+          f"({shared} already in the shared store), {workers} workers...")
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(build_tile, laz, bounds, sources, filters, writer, store.dem_tile(d)): laz
+            for laz, (bounds, sources, d) in jobs.items()
+        }
+        for done, fut in enumerate(as_completed(futures), 1):
+            laz = futures[fut]
+            bounds, _, d = jobs[laz]
+            try:
+                out = fut.result()
+                manifest.record("dem", tile_name(laz), d, [out],
+                                bounds=list(bounds), laz_sha=hashes[laz])
+                print(f"✓ DEM tile {os.path.basename(laz)} ({done}/{len(jobs)})")
+            except Exception as e:
+                items.pop(tile_name(laz), None)
+                failed.append(os.path.basename(laz))
+                print(f"✗ Error building DEM tile {os.path.basename(laz)}: {e}")
+            job_progress(done, len(jobs), "tiles")
+
+    built = sorted(p for item in items.values() for p in item["outputs"])
+    if not built:
+        manifest.save()
+        print("✗ No DEM tiles were built")
+        return False
+
+    stage = manifest.stage("dem")
+    rebuilt = [items[tile_name(laz)]["outputs"][0] for laz in jobs
+               if tile_name(laz) in items]
+    if roi and not removed and patch_mosaic(rebuilt, dem):
+        # The overview pyramid and COG layout are restored by the next full run
+        stage["patched"] = stage.get("patched", False) or bool(rebuilt)
+        print(f"✅ {len(rebuilt)} DEM tiles patched into {dem}")
+    elif jobs or removed or stage.get("patched") or not os.path.exists(dem):
+        vrt = build_vrt(built, paths["vrt"])
+        rasterio.shutil.copy(vrt, dem, driver="COG", compress="zstd", bigtiff="IF_SAFER")
+        stage["patched"] = False
+        print(f"✅ DEM mosaic written to {dem} ({len(built)} tiles)")
+    else:
+        print(f"✅ DEM up to date ({len(built)} tiles)")
+
+    stage["mosaic"] = dem
+    if roi:
+        manifest.save()
+        return not failed
+    upstream = state.laz_digest(manifest, laz_dir) if not failed else None
+    manifest.finish("dem", upstream=upstream, params=params)
+    if failed:
+        print(f"⚠ {len(failed)} tiles failed: {', '.join(failed)}")
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the DEM from the LAZ tiles with PDAL")
+    parser.add_argument("--roi", nargs=4, type=float, metavar=("W", "S", "E", "N"),
+                        help="only rebuild the tiles under this lon/lat box")
+    args = parser.parse_args()
+    with metrics.stage("dem", "tiles") as run:
+        run["ok"] = build_dem(roi=args.roi)
+    raise SystemExit(0 if run["ok"] else 1)
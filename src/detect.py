@@ -1,12 +1,27 @@
+import argparse
+import asyncio
+import io
+import math
 import os
-import yaml
+import random
+import threading
+import time
 import json
+from collections import namedtuple
+from contextlib import ExitStack
 from PIL import Image
 import rasterio
+from rasterio.enums import Resampling
 from rasterio.plot import reshape_as_image
+from rasterio.windows import Window
 import numpy as np
-from google import genai
-from google.genai import types
+
+import blocks
+import jobs
+import metrics
+import state
+from anomalies import AnomalyStore, new_run_id
+from cache import ResponseCache
 
 # IMPORTANT: KEEP THIS COMMENT
 # Follow these instructions when using this blueprint:
@@ -15,26 +30,133 @@ from google.genai import types
 # - Sometimes the google genai SDK has occasional type errors. You might need to run to validate, at time.  
 # The SDK was recently renamed from google-generativeai to google-genai. This file reflects the new name and the new APIs.
 
-with open("config.yaml") as f:
-    C = yaml.safe_load(f)
+# google.genai and prescreen (scipy) take seconds to import; they are
+# imported where they are used, so --help and the app's imports stay fast
+
+# Defaults; config.yaml's `detect:` section overrides them. Like the AOI and
+# its paths, they are read when used, not at import, so the warm worker
+# sees config.yaml as it is when each job starts
+DETECT = {
+    "model": "gemini-2.5-pro",
+    "preview_size": 1024,
+    "chip_size": 1024,
+    "chip_overlap": 128,
+    "concurrency": 8,
+    "requests_per_minute": 60,
+    "retries": 5,
+    "dedupe_m": 10.0,
+    "cache_max_mb": 512,
+    "cache_max_days": 30,
+}
+
+
+def settings():
+    return dict(DETECT, **state.settings("detect"))
+
+
+def make_client():
+    """Gemini client, or None if no API key is configured
+
+    GEMINI_BASE_URL points the client at another endpoint, such as the local
+    stub server in bench/stub_gemini.py.
+    """
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        print("✗ GEMINI_API_KEY not found in environment variables")
+        print("Please set your Gemini API key to use anomaly detection")
+        return None
+    base_url = os.environ.get("GEMINI_BASE_URL")
+    from google import genai
+    from google.genai import types
+
+    http_options = types.HttpOptions(base_url=base_url) if base_url else None
+    return genai.Client(api_key=api_key, http_options=http_options)
 
-os.makedirs("outputs", exist_ok=True)
 
+def open_cache():
+    """Response cache sized and aged from config.yaml"""
+    cfg = settings()
+    return ResponseCache(max_bytes=cfg["cache_max_mb"] * 1024 * 1024,
+                         max_age=cfg["cache_max_days"] * 86400)
 
-def create_preview_image(dem_path, output_path, min_val=0.0, max_val=300.0):
-    """Create a normalized preview image from a GeoTIFF"""
+
+def save_anomalies(geojson_data, prompt, output_path=None, roi=None, model=None):
+    """Append detections to the anomaly store, export the current set and record the stage
+
+    With roi the new detections replace, in the store's current set, those
+    inside it, and the stage is left unsealed until the next full run.
+    output_path (default: the AOI's anomalies.geojson) is rewritten from
+    the store either way.
+    """
+    name = state.area()["name"]
+    output_path = output_path or state.paths()["anomalies"]
+    model = model or settings()["model"]
+    features = geojson_data.get("features", [])
+    if roi:
+        features = [f for f in features
+                    if roi[0] <= f["geometry"]["coordinates"][0] <= roi[2]
+                    and roi[1] <= f["geometry"]["coordinates"][1] <= roi[3]]
+    run = new_run_id(metrics.run_id())
+    db = AnomalyStore()
+    before = sum(db.counts(name).values())
+    added = db.add_run(run, name, model, features, roi=roi, prompt=state.digest(prompt))
+    num_features = db.export(output_path, name)
+    db.close()
+    print(f"✓ {added} detections stored as run {run}")
+    if roi:
+        print(f"✓ ROI: {before + added - num_features} detections replaced by {added}, "
+              f"{num_features - added} kept")
+        print(f"✅ {num_features} anomalies in {output_path} after the ROI update")
+        return
+
+    manifest = state.Manifest()
+    upstream = manifest.stage("deriv").get("digest")
+    manifest.record("detect", name, state.digest(upstream, prompt, model), [output_path])
+    manifest.finish("detect", upstream=upstream, params=state.stage_params("detect"))
+
+    print(f"✅ Detected {num_features} anomalies")
+    print(f"✅ GeoJSON saved to {output_path}")
+
+
+PREVIEW_PERCENTILES = (2, 98)
+
+
+def create_preview_image(dem_path, output_path, min_val=None, max_val=None, size=None):
+    """Create a normalized preview image from a GeoTIFF
+
+    The raster is read once, already decimated to at most size pixels on its
+    longer side (GDAL serves this from the overviews when the file has them),
+    so memory is bounded by the preview, not by the raster. Nodata is masked
+    and drawn black. Without explicit min_val/max_val the stretch is the
+    2nd-98th percentile of the valid preview pixels. size defaults to
+    detect.preview_size in config.yaml.
+    """
+    size = size or settings()["preview_size"]
     try:
         with rasterio.open(dem_path) as src:
-            arr = src.read(1)
-            
-            # Normalize to 0-255 range
-            arr_norm = np.clip((arr - min_val) / (max_val - min_val) * 255, 0, 255).astype(np.uint8)
-            
-            # Create RGB image
-            img = Image.fromarray(arr_norm, mode='L').convert('RGB')
-            img.save(output_path, 'JPEG')
-            print(f"✓ Created preview: {output_path}")
-            return True
+            scale = min(1.0, size / max(src.width, src.height))
+            shape = (max(1, round(src.height * scale)), max(1, round(src.width * scale)))
+            arr = src.read(1, out_shape=shape, masked=True,
+                           resampling=Resampling.average).astype("float32")
+
+        valid = ~np.ma.getmaskarray(arr) & np.isfinite(arr.filled(np.nan))
+        if min_val is None or max_val is None:
+            lo, hi = (np.percentile(arr.data[valid], PREVIEW_PERCENTILES)
+                      if valid.any() else (0.0, 1.0))
+            min_val = lo if min_val is None else min_val
+            max_val = hi if max_val is None else max_val
+        span = max(max_val - min_val, 1e-6)
+
+        # Normalize to 0-255 range
+        arr_norm = np.zeros(shape, dtype=np.uint8)
+        arr_norm[valid] = np.clip((arr.data[valid] - min_val) / span * 255, 0, 255)
+
+        # Create RGB image
+        img = Image.fromarray(arr_norm, mode='L').convert('RGB')
+        img.save(output_path, 'JPEG')
+        print(f"✓ Created preview: {output_path} ({shape[1]}x{shape[0]}, "
+              f"stretch {min_val:.2f}-{max_val:.2f})")
+        return True
     except Exception as e:
         print(f"✗ Error creating preview for {dem_path}: {e}")
         return False
@@ -44,36 +166,32 @@ def detect_anomalies():
     """Use Gemini AI to detect archaeological anomalies from LiDAR imagery"""
     print("Starting anomaly detection with Gemini AI...")
     
-    # Check if API key is available
-    api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
-        print("✗ GEMINI_API_KEY not found in environment variables")
-        print("Please set your Gemini API key to use anomaly detection")
+    client = make_client()
+    if client is None:
         return False
-    
-    # Create client
-    client = genai.Client(api_key=api_key)
+    aoi, paths, model = state.area(), state.paths(), settings()["model"]
     
     # Create preview images from GeoTIFFs
-    dem_preview = "outputs/dem_preview.jpg"
-    hill_preview = "outputs/hill_preview.jpg"
-    svf_preview = "outputs/svf_preview.jpg"
+    os.makedirs(paths["outputs"], exist_ok=True)
+    dem_preview = f"{paths['outputs']}/dem_preview.jpg"
+    hill_preview = f"{paths['outputs']}/hill_preview.jpg"
+    svf_preview = f"{paths['outputs']}/svf_preview.jpg"
     
-    if not os.path.exists("data/dem_velez.tif"):
+    if not os.path.exists(paths["dem"]):
         print("✗ DEM file not found. Please process LAZ files first.")
         return False
     
-    create_preview_image("data/dem_velez.tif", dem_preview, 0, 300)
+    create_preview_image(paths["dem"], dem_preview)
     
-    if os.path.exists("data/deriv/hill_45.tif"):
-        create_preview_image("data/deriv/hill_45.tif", hill_preview, 0, 255)
+    if os.path.exists(f"{paths['deriv']}/hill_45.tif"):
+        create_preview_image(f"{paths['deriv']}/hill_45.tif", hill_preview)
     
-    if os.path.exists("data/deriv/svf.tif"):
-        create_preview_image("data/deriv/svf.tif", svf_preview, 0.5, 1.0)
+    if os.path.exists(f"{paths['deriv']}/svf.tif"):
+        create_preview_image(f"{paths['deriv']}/svf.tif", svf_preview)
     
     # Prepare the prompt for archaeological analysis
     prompt = f"""
-Eres un arqueólogo experto en análisis LiDAR. Observa las imágenes del terreno de {C['aoi']['name']}.
+Eres un arqueólogo experto en análisis LiDAR. Observa las imágenes del terreno de {aoi['name']}.
 
 Imágenes proporcionadas:
 1. Modelo Digital del Terreno (DEM) - muestra la elevación
@@ -82,7 +200,7 @@ Imágenes proporcionadas:
 
 Tu tarea:
 1. Identifica hasta 10 anomalías topográficas que podrían ser estructuras arqueológicas ocultas (muros, túmulos, fosas, caminos antiguos)
-2. Para cada anomalía, estima las coordenadas aproximadas dentro del área de estudio (bbox: {C['aoi']['bbox']})
+2. Para cada anomalía, estima las coordenadas aproximadas dentro del área de estudio (bbox: {aoi['bbox']})
 
 Devuelve ÚNICAMENTE un objeto JSON válido (sin markdown, sin texto adicional) con esta estructura exacta:
 {{
@@ -104,24 +222,38 @@ Devuelve ÚNICAMENTE un objeto JSON válido (sin markdown, sin texto adicional)
 }}
 """
     
+    from google.genai import types
+
     try:
         # Prepare image parts
         content_parts = []
         content_parts.append(types.Part(text=prompt))
         
         # Add images if they exist
+        images = []
         for img_path in [dem_preview, hill_preview, svf_preview]:
             if os.path.exists(img_path):
                 with open(img_path, "rb") as f:
                     image_bytes = f.read()
+                    images.append(image_bytes)
                     content_parts.append(types.Part.from_bytes(
                         data=image_bytes,
                         mime_type="image/jpeg"
                     ))
         
+        # Same images, prompt and model as a previous run: reuse its answer
+        cache = open_cache()
+        key = cache.key(images, prompt, model)
+        geojson_data = cache.get(key)
+        if geojson_data is not None:
+            print(f"✓ Using cached response ({cache.summary()})")
+            cache.close()
+            save_anomalies(geojson_data, prompt, model=model)
+            return True
+        
         print("Analyzing imagery with Gemini AI...")
         response = client.models.generate_content(
-            model="gemini-2.5-pro",
+            model=model,
             contents=content_parts
         )
         
@@ -138,14 +270,9 @@ Devuelve ÚNICAMENTE un objeto JSON válido (sin markdown, sin texto adicional)
             # Validate JSON
             geojson_data = json.loads(geojson_str)
             
-            # Save to file
-            output_path = "outputs/anomalies.geojson"
-            with open(output_path, "w", encoding="utf-8") as f:
-                json.dump(geojson_data, f, indent=2, ensure_ascii=False)
-            
-            num_features = len(geojson_data.get("features", []))
-            print(f"✅ Detected {num_features} anomalies")
-            print(f"✅ GeoJSON saved to {output_path}")
+            cache.put(key, model, geojson_data)
+            cache.close()
+            save_anomalies(geojson_data, prompt, model=model)
             return True
         else:
             print("✗ No valid JSON found in Gemini response")
@@ -157,5 +284,318 @@ Devuelve ÚNICAMENTE un objeto JSON válido (sin markdown, sin texto adicional)
         return False
 
 
+# --- Tiled detection -------------------------------------------------------
+
+def chip_layers(paths=None):
+    """(path, low, high) of the rasters in every chip: the DEM and two derivatives"""
+    paths = paths or state.paths()
+    return (
+        (paths["dem"], None, None),    # stretched per chip
+        (f"{paths['deriv']}/hill_45.tif", 0, 255),
+        (f"{paths['deriv']}/svf.tif", 0.5, 1.0),
+    )
+
+
+Chip = namedtuple("Chip", "id window transform crs images")
+
+CHIP_PROMPT = """
+Eres un arqueólogo experto en análisis LiDAR. Las imágenes son un recorte de {size} píxeles
+({res:g} m/píxel) del terreno de {name}: 1) DEM, 2) Hillshade, 3) Sky View Factor.
+Las tres imágenes están alineadas píxel a píxel.
+
+Identifica hasta 5 anomalías topográficas que podrían ser estructuras arqueológicas ocultas
+(muros, túmulos, fosas, caminos antiguos). Para cada una da su posición en píxeles de la
+imagen: x = columna (0 a {width}), y = fila (0 a {height}), origen en la esquina superior izquierda.
+
+Devuelve ÚNICAMENTE un objeto JSON válido (sin markdown, sin texto adicional):
+{{
+  "features": [
+    {{"pixel": [x, y], "tipo": "muro|túmulo|fossa|camino", "score": 0.0-1.0,
+      "justificacion": "breve descripción"}}
+  ]
+}}
+Si no hay anomalías, devuelve {{"features": []}}.
+"""
+
+
+def _to_jpeg(arr, lo, hi, nodata=None):
+    """Stretch an array to 8 bits and encode it as an RGB JPEG"""
+    arr = arr.astype("float32")
+    valid = np.isfinite(arr) if nodata is None else np.isfinite(arr) & (arr != nodata)
+    if lo is None:
+        lo, hi = (arr[valid].min(), arr[valid].max()) if valid.any() else (0, 1)
+    scaled = np.clip((arr - lo) / max(hi - lo, 1e-6) * 255, 0, 255)
+    scaled[~valid] = 0
+    buf = io.BytesIO()
+    Image.fromarray(scaled.astype(np.uint8), mode="L").convert("RGB").save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def iter_chips(layers=None, size=None, overlap=None, window=None, windows=None):
+    """Cut the DEM and derivatives (default: chip_layers()) into overlapping, aligned chips
+
+    Each chip carries its own geotransform so pixel detections can be mapped
+    back to exact coordinates. window restricts chipping to part of the DEM;
+    windows, if given, are the chips to cut instead. size and overlap
+    default to config.yaml's.
+    """
+    paths = [(p, lo, hi) for p, lo, hi in layers or chip_layers() if os.path.exists(p)]
+    with ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(p)) for p, _, _ in paths]
+        dem = srcs[0]
+        area = window or Window(0, 0, dem.width, dem.height)
+        if windows is None:
+            cfg = settings()
+            windows = blocks.chip_windows(area, size or cfg["chip_size"],
+                                          cfg["chip_overlap"] if overlap is None else overlap)
+        for win in windows:
+            images = [_to_jpeg(src.read(1, window=win), lo, hi, src.nodata)
+                      for src, (_, lo, hi) in zip(srcs, paths)]
+            yield Chip(f"{int(win.row_off)}_{int(win.col_off)}", win, dem.window_transform(win),
+                       dem.crs, images)
+
+
+class RateLimiter:
+    """Space out request starts to at most `per_minute` per minute"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self.next = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _extract_json(text):
+    """First {...} object in a model response"""
+    start, end = text.find("{"), text.rfind("}") + 1
+    if start < 0 or end <= start:
+        raise ValueError(f"no JSON object in response: {text[:200]!r}")
+    return json.loads(text[start:end])
+
+
+def _retryable(e):
+    from google.genai import errors as genai_errors
+
+    if isinstance(e, genai_errors.ClientError):
+        return e.code == 429
+    return not isinstance(e, (ValueError, KeyError))
+
+
+async def detect_chip(client, chip, sem, limiter, cache, retries=None, model=None, name=None):
+    """Send one chip to the model and return its detections in map coordinates
+
+    Responses are cached in pixel space, so a chip whose images, prompt and
+    model are unchanged is answered from the cache without a request.
+    retries, model and the AOI name default to config.yaml's.
+    """
+    if retries is None or model is None:
+        cfg = settings()
+        retries = cfg["retries"] if retries is None else retries
+        model = model or cfg["model"]
+    w, h = int(chip.window.width), int(chip.window.height)
+    prompt = CHIP_PROMPT.format(size=f"{w}×{h}", res=chip.transform.a,
+                                name=name or state.area()["name"], width=w, height=h)
+    key = cache.key(chip.images, prompt, model)
+    t0 = time.perf_counter()
+    result = cache.get(key)
+    cached = result is not None
+
+    if result is None:
+        from google.genai import types
+
+        parts = [types.Part(text=prompt)]
+        parts += [types.Part.from_bytes(data=img, mime_type="image/jpeg") for img in chip.images]
+        async with sem:
+            for attempt in range(retries + 1):
+                await limiter.wait()
+                try:
+                    response = await client.aio.models.generate_content(model=model, contents=parts)
+                    result = _extract_json(response.text or "")
+                    break
+                except Exception as e:
+                    if attempt == retries or not _retryable(e):
+                        print(f"✗ Chip {chip.id}: {e}")
+                        metrics.item(chip.id, seconds=round(time.perf_counter() - t0, 3),
+                                     cached=False, failed=True)
+                        return []
+                    await asyncio.sleep(min(60, 2 ** attempt) * (0.5 + random.random() / 2))
+        cache.put(key, model, result)
+
+    detections = []
+    for feat in result.get("features", []):
+        try:
+            px, py = (float(v) for v in feat["pixel"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not (0 <= px <= w and 0 <= py <= h):
+            continue
+        x, y = chip.transform * (px, py)
+        detections.append({
+            "x": x, "y": y, "chip": chip.id, "pixel": [px, py],
+            "tipo": feat.get("tipo", "desconocido"),
+            "score": float(feat.get("score", 0)),
+            "justificacion": feat.get("justificacion", ""),
+        })
+    metrics.item(chip.id, seconds=round(time.perf_counter() - t0, 3), cached=cached,
+                 detections=len(detections))
+    return detections
+
+
+def dedupe(detections, dist=None):
+    """Merge detections of the same type closer than dist map units, keeping the best score
+
+    dist defaults to detect.dedupe_m in config.yaml.
+    """
+    dist = dist or settings()["dedupe_m"]
+    kept, grid = [], {}
+    for det in sorted(detections, key=lambda d: -d["score"]):
+        gx, gy = int(det["x"] // dist), int(det["y"] // dist)
+        near = (k for i in (-1, 0, 1) for j in (-1, 0, 1) for k in grid.get((gx + i, gy + j), ()))
+        if any(k["tipo"] == det["tipo"] and math.hypot(k["x"] - det["x"], k["y"] - det["y"]) < dist
+               for k in near):
+            continue
+        grid.setdefault((gx, gy), []).append(det)
+        kept.append(det)
+    return kept
+
+
+def shortlist(windows, area, top_k, overlap):
+    """The top_k chip windows (overlap pixels apart) by local pre-screen score (prescreen.py)"""
+    import prescreen
+
+    t0 = time.perf_counter()
+    chips = prescreen.screen(windows, area, overlap)
+    kept = [win for win, _, _ in prescreen.top(chips, top_k)]
+    dt = time.perf_counter() - t0
+    metrics.item("prescreen", seconds=round(dt, 3), chips=len(windows), kept=len(kept))
+    print(f"✓ Pre-screen kept {len(kept)} of {len(windows)} chips in {dt:.1f}s "
+          f"({len(windows) / dt:.1f} chips/s, {len(windows) - len(kept)} model calls avoided)")
+    return kept
+
+
+async def detect_tiled(concurrency=None, per_minute=None, window=None, roi=None, top_k=None):
+    """Detect anomalies chip by chip with bounded, rate-limited concurrent requests
+
+    roi (W, S, E, N in lon/lat) limits chipping to that box and merges the
+    result into the existing detections. With top_k (default prescreen.top_k
+    in config.yaml; 0 sends every chip) only the chips the local pre-screen
+    ranks highest go to the model. concurrency and per_minute default to
+    config.yaml's.
+    """
+    import prescreen
+
+    print("Starting tiled anomaly detection with Gemini AI...")
+    client = make_client()
+    if client is None:
+        return False
+    cfg, layers, name = settings(), chip_layers(), state.area()["name"]
+    concurrency = concurrency or cfg["concurrency"]
+    per_minute = per_minute or cfg["requests_per_minute"]
+    if not os.path.exists(layers[0][0]):
+        print("✗ DEM file not found. Please process LAZ files first.")
+        return False
+
+    sem = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(per_minute)
+    cache = open_cache()
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    detections, crs, done = [], None, 0
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
+    with rasterio.open(layers[0][0]) as dem:
+        if roi:
+            window = blocks.roi_window(dem, roi)
+            if window is None:
+                print(f"⚠ ROI {roi} does not overlap the DEM")
+                return False
+        area = window or Window(0, 0, dem.width, dem.height)
+    windows = blocks.chip_windows(area, cfg["chip_size"], cfg["chip_overlap"])
+    top_k = prescreen.settings()["top_k"] if top_k is None else top_k
+    if top_k and top_k < len(windows):
+        windows = shortlist(windows, area, top_k, cfg["chip_overlap"])
+    total = len(windows)
+
+    stop = threading.Event()
+
+    def produce():
+        # Chips are read and encoded in a thread; the bounded queue keeps at
+        # most 2 * concurrency encoded chips in memory. One None per consumer
+        # ends them, also when reading a chip fails
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        try:
+            for chip in iter_chips(layers, windows=windows):
+                if stop.is_set():
+                    break
+                put(chip)
+        finally:
+            for _ in range(concurrency):
+                put(None)
+
+    async def consume():
+        nonlocal crs, done
+        while (chip := await queue.get()) is not None:
+            crs = chip.crs
+            detections.extend(await detect_chip(client, chip, sem, limiter, cache,
+                                                cfg["retries"], cfg["model"], name))
+            done += 1
+            metrics.count(1)
+            print(f"✓ Chip {chip.id} ({done} done, {len(detections)} detections)")
+            jobs.progress(done, total, "chips")
+
+    producer = loop.run_in_executor(None, produce)
+    consumers = [asyncio.create_task(consume()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*consumers)
+    except BaseException:
+        # Stop the producer, keeping the queue drained so it is never left
+        # blocked on a full queue with nobody to take from it
+        stop.set()
+        for task in consumers:
+            task.cancel()
+        while not producer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.wait([producer], timeout=0.05)
+        raise
+    # Re-raises a chip read that failed
+    await producer
+
+    merged = dedupe(detections, cfg["dedupe_m"])
+    dt = time.perf_counter() - t0
+    print(f"✓ {done} chips in {dt:.1f}s ({done / dt:.2f} chips/s), "
+          f"{len(detections)} detections, {len(merged)} after de-duplication")
+    print(f"✓ {cache.misses} chips sent to the model, {cache.summary()}")
+    cache.close()
+    save_anomalies(prescreen.to_geojson(merged, crs), CHIP_PROMPT, roi=roi, model=cfg["model"])
+    return True
+
+
 if __name__ == "__main__":
-    detect_anomalies()
+    parser = argparse.ArgumentParser(description="Detect archaeological anomalies with Gemini AI")
+    parser.add_argument("--mode", choices=("tiled", "preview"), default="tiled",
+                        help="tiled: overlapping chips at full resolution (default); "
+                             "preview: one downscaled image of the whole AOI")
+    parser.add_argument("--concurrency", type=int,
+                        help="requests in flight (default detect.concurrency in config.yaml)")
+    parser.add_argument("--top-k", type=int,
+                        help="tiled mode only: send the K chips the local pre-screen ranks "
+                             "highest (default prescreen.top_k; 0 = all)")
+    parser.add_argument("--roi", nargs=4, type=float, metavar=("W", "S", "E", "N"),
+                        help="tiled mode only: detect in this lon/lat box and merge")
+    args = parser.parse_args()
+    with metrics.stage("detect", "chips") as run:
+        if args.mode == "preview":
+            run["ok"] = detect_anomalies()
+        else:
+            run["ok"] = asyncio.run(detect_tiled(concurrency=args.concurrency, roi=args.roi,
+                                                top_k=args.top_k))
+    raise SystemExit(0 if run["ok"] else 1)
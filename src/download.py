@@ -1,49 +1,187 @@
+import argparse
 import asyncio
 import aiohttp
 import aiofiles
-import geopandas as gpd
-from shapely.geometry import box
-import yaml
 import os
+import random
+import time
 
-with open("config.yaml") as f:
-    C = yaml.safe_load(f)
+import ingest
+import jobs
+import metrics
+import state
+import store
+import tileindex
 
-BBOX = C["aoi"]["bbox"]
-OUT = "data/laz"
-os.makedirs(OUT, exist_ok=True)
+RETRIES = 6
+# Attempts that add bytes do not count against RETRIES; these bound a link
+# that keeps dropping without ever finishing
+MAX_ATTEMPTS = 200
+DEADLINE = 6 * 3600
+# No per-request deadline: large tiles on slow links are fine as long as bytes keep flowing
+TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
 
-INDEX_URL = ("https://centrodedescargas.cnig.es/CentroDescargas/"
-             "documentos/PDT_LIDAR3_2025.zip")
 
+class IncompleteDownload(Exception):
+    pass
 
-async def download_laz(session, sem, url, path):
-    """Download a single LAZ file with semaphore for concurrency control"""
+
+class CorruptLaz(IncompleteDownload):
+    pass
+
+
+def check_laz(path, expected_size=None):
+    """Verify a downloaded file's size and LAS/LAZ header before accepting it"""
+    size = os.path.getsize(path)
+    if expected_size is not None and size != expected_size:
+        raise IncompleteDownload(f"got {size} of {expected_size} bytes")
+    with open(path, "rb") as f:
+        header = f.read(227)
+    if len(header) < 227 or header[:4] != b"LASF":
+        raise CorruptLaz("not a LAS/LAZ file (bad signature)")
+    major, minor = header[24], header[25]
+    header_size = int.from_bytes(header[94:96], "little")
+    point_offset = int.from_bytes(header[96:100], "little")
+    if major != 1 or minor > 4 or header_size < 227 or not header_size <= point_offset <= size:
+        raise CorruptLaz(f"corrupt LAS {major}.{minor} header")
+
+
+def _total_size(r, offset):
+    """Full file size from a 200, 206 or 416 response, if the server says"""
+    if r.status in (206, 416) and "Content-Range" in r.headers:
+        total = r.headers["Content-Range"].rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    if r.status != 416 and r.content_length is not None:
+        return r.content_length + (offset if r.status == 206 else 0)
+    return None
+
+
+async def _remote_size(session, url):
+    """Content-Length of a HEAD request for url, or None"""
+    async with session.head(url, timeout=TIMEOUT, allow_redirects=True) as r:
+        return r.content_length if r.status == 200 else None
+
+
+async def download_laz(session, sem, url, path, retries=RETRIES, max_attempts=MAX_ATTEMPTS,
+                       deadline=DEADLINE):
+    """Download a single LAZ file with semaphore for concurrency control
+
+    Bytes go to path + ".part", which is resumed with an HTTP Range request
+    after a dropped connection and retried with exponential backoff. The file
+    is renamed to path only once its size matches Content-Length and its LAS
+    header checks out, so a .laz on disk is always complete. Only attempts
+    that add to the .part count against retries (a server that ignores Range
+    and starts over does not), and max_attempts and deadline seconds bound
+    the whole download.
+    """
+    name = os.path.basename(path)
+    if os.path.exists(path):
+        print(f"✓ {name} already downloaded")
+        return True
+
+    part = f"{path}.part"
     async with sem:
-        try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=300)) as r:
-                if r.status == 200:
-                    async with aiofiles.open(path, "wb") as f:
-                        async for chunk in r.content.iter_chunked(1024 * 64):
-                            await f.write(chunk)
-                    print(f"✓ Downloaded {os.path.basename(path)}")
-                else:
-                    print(f"✗ Failed to download {os.path.basename(path)}: HTTP {r.status}")
-        except Exception as e:
-            print(f"✗ Error downloading {os.path.basename(path)}: {e}")
-
-
-async def main():
-    """Download LAZ tiles from CNIG for the configured bounding box"""
-    print(f"Downloading PNOA-LiDAR tiles for {C['aoi']['name']}...")
-    print(f"Bounding box: {BBOX}")
+        t0 = time.perf_counter()
+        failures = attempts = 0
+        # Largest .part so far: an attempt only counts as progress if it gets further
+        best = os.path.getsize(part) if os.path.exists(part) else 0
+        while failures < retries and attempts < max_attempts and time.perf_counter() - t0 < deadline:
+            attempts += 1
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            restarted = False
+            try:
+                async with session.get(url, headers=headers, timeout=TIMEOUT) as r:
+                    if r.status == 416:
+                        # Nothing left to fetch if the .part already holds the
+                        # whole file; anything else is a stale or foreign .part
+                        expected = _total_size(r, offset)
+                        if expected is None:
+                            expected = await _remote_size(session, url)
+                        if expected != offset:
+                            os.remove(part)
+                            raise IncompleteDownload(
+                                f"discarded {offset}-byte .part (file is {expected} bytes)")
+                    elif r.status in (200, 206):
+                        if r.status == 200:
+                            # Range ignored: the file starts over
+                            restarted = offset > 0
+                            offset = 0
+                        expected = _total_size(r, offset)
+                        async with aiofiles.open(part, "ab" if offset else "wb") as f:
+                            # Whatever has arrived, so a dropped connection keeps
+                            # every byte received (iter_chunked loses its partial chunk)
+                            async for chunk in r.content.iter_any():
+                                await f.write(chunk)
+                    elif r.status == 429 or r.status >= 500:
+                        raise IncompleteDownload(f"HTTP {r.status}")
+                    else:
+                        print(f"✗ Failed to download {name}: HTTP {r.status}")
+                        return False
+
+                check_laz(part, expected)
+                os.replace(part, path)
+                dt = time.perf_counter() - t0
+                metrics.count(1)
+                metrics.item(name, seconds=round(dt, 3), mb=round(os.path.getsize(path) / 1e6, 2))
+                print(f"✓ Downloaded {name}")
+                return True
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+                if isinstance(e, CorruptLaz):
+                    # A complete but corrupt file will not get better by resuming
+                    os.remove(part)
+                # Only attempts that took the .part further than before count as progress
+                size = os.path.getsize(part) if os.path.exists(part) else 0
+                grown = not restarted and size > best
+                best = max(best, size)
+                failures = 0 if grown else failures + 1
+                delay = min(60, 2 ** failures) * (0.5 + random.random() / 2)
+                print(f"⚠ {name}: {e or type(e).__name__}, retrying in {delay:.1f}s "
+                      f"({failures}/{retries} failed attempts)")
+                await asyncio.sleep(delay)
+
+        print(f"✗ Error downloading {name}: gave up after {attempts} attempts "
+              f"({failures} without progress) in {time.perf_counter() - t0:.0f}s")
+        return False
+
+
+def pending(tiles, manifest):
+    """(key, url, path, stored, digest) of the index rows not yet downloaded
+
+    Skips tiles already downloaded from the same URL. Files go to the
+    shared store, where tiles fetched for another AOI are found too, and
+    are linked into this AOI's directory.
+    """
+    version, laz_dir = state.area()["laz_version"], state.paths()["laz"]
+    os.makedirs(os.path.dirname(store.laz_path(version, "")), exist_ok=True)
+    os.makedirs(laz_dir, exist_ok=True)
+    todo = []
+    for _, row in tiles.iterrows():
+        d = state.digest(row.URL_DESCARGA)
+        path = f"{laz_dir}/{row.HOJA}.laz"
+        stored = store.laz_path(version, row.HOJA)
+        if os.path.exists(path) and not os.path.exists(stored):
+            store.link(path, stored)
+        if manifest.stale("download", row.HOJA, d):
+            todo.append((row.HOJA, row.URL_DESCARGA, path, stored, d))
+    return todo
+
+
+async def main(roi=None):
+    """Download LAZ tiles from CNIG for the configured bounding box
+
+    With roi (W, S, E, N) only the tiles under it are fetched, and tiles
+    outside it are left alone rather than pruned.
+    """
+    aoi = state.area()
+    print(f"Downloading PNOA-LiDAR tiles for {aoi['name']}...")
+    print(f"Bounding box: {roi or aoi['bbox']}")
     
     try:
-        # Read the index of available tiles
-        idx = gpd.read_file(INDEX_URL).to_crs(4326)
-        
-        # Filter tiles that intersect with our AOI
-        tiles = idx[idx.intersects(box(*BBOX))].head(C["aoi"]["max_downloads"])
+        # Tiles that intersect our AOI, from the local index cache
+        tiles = tileindex.tiles_for(roi or aoi["bbox"], aoi["laz_version"], aoi.get("index_url"))
+        tiles = tiles.head(aoi["max_downloads"])
         
         if len(tiles) == 0:
             print("⚠ No tiles found for the specified bounding box")
@@ -51,21 +189,48 @@ async def main():
         
         print(f"Found {len(tiles)} tiles to download")
         
+        manifest = state.Manifest()
+        todo = pending(tiles, manifest)
+        if len(todo) < len(tiles):
+            print(f"✓ {len(tiles) - len(todo)} tiles already up to date")
+
         # Download tiles with concurrency control
         sem = asyncio.Semaphore(6)
         async with aiohttp.ClientSession() as session:
-            tasks = []
-            for _, row in tiles.iterrows():
-                url = row.URL_DESCARGA
-                fname = f"{row.HOJA}.laz"
-                tasks.append(download_laz(session, sem, url, f"{OUT}/{fname}"))
-            await asyncio.gather(*tasks)
-        
-        print(f"✅ Download complete: {len(tasks)} LAZ files")
-    
+            tasks = [download_laz(session, sem, url, stored) for _, url, _, stored, _ in todo]
+            finished = 0
+
+            async def tracked(task):
+                nonlocal finished
+                ok = await task
+                finished += 1
+                jobs.progress(finished, len(tasks), "tiles")
+                return ok
+
+            results = await asyncio.gather(*map(tracked, tasks))
+
+        for (key, _, path, stored, d), ok in zip(todo, results):
+            if ok:
+                store.link(stored, path)
+                manifest.record("download", key, d, [path])
+        if roi:
+            manifest.save()
+        else:
+            manifest.prune("download", keep=set(tiles.HOJA))
+            manifest.finish("download", params=state.stage_params("download"))
+
+        print(f"✅ Download complete: {sum(results)} of {len(todo)} LAZ files")
+
+        # Header and sample statistics of every tile for the later stages
+        ingest.ingest(state.paths()["laz"], manifest=manifest)
+
     except Exception as e:
         print(f"✗ Error during download process: {e}")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Download the PNOA-LiDAR tiles of the AOI")
+    parser.add_argument("--roi", nargs=4, type=float, metavar=("W", "S", "E", "N"),
+                        help="only download the tiles under this lon/lat box")
+    with metrics.stage("download", "tiles"):
+        asyncio.run(main(parser.parse_args().roi))
@@ -0,0 +1,226 @@
+"""Per-tile metadata index of the downloaded LAZ files.
+
+Reads only each tile's LAS header and a small sample of points (a few
+evenly spaced chunks, using the LAZ chunk table to seek) and records
+bounds, CRS, point count, density, class mix and a sha256 in a SQLite
+table at data/laz_index.sqlite (one per AOI when there are several).
+Tiles are processed in parallel and only files whose size or mtime
+changed are read again, so re-indexing thousands of tiles takes seconds.
+
+Downstream stages query the index instead of opening the point clouds:
+the DEM stage takes tile bounds from it and skips tiles marked corrupt.
+"""
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import blocks
+import state
+
+SAMPLE_POINTS = 40_000
+SAMPLE_CHUNKS = 8
+# Points per LAZ chunk (the laszip default, used by PNOA): seeking to a
+# chunk boundary starts decompression there instead of decoding up to it
+LAZ_CHUNK = 50_000
+GROUND = 2
+
+COLUMNS = ("name", "path", "size", "mtime_ns", "sha256", "ok", "error", "crs",
+           "version", "point_format", "point_count", "minx", "miny", "minz",
+           "maxx", "maxy", "maxz", "density", "sampled", "ground_fraction",
+           "class_counts", "ingested")
+
+
+INSERT = (f"INSERT OR REPLACE INTO tiles ({', '.join(COLUMNS)}) "
+          f"VALUES ({', '.join('?' * len(COLUMNS))})")
+
+
+def connect(path=None):
+    """The tile index at path (default: the AOI's), created if needed"""
+    path = path or state.paths()["index"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS tiles ("
+        " name TEXT PRIMARY KEY, path TEXT, size INTEGER, mtime_ns INTEGER,"
+        " sha256 TEXT, ok INTEGER, error TEXT, crs TEXT, version TEXT,"
+        " point_format INTEGER, point_count INTEGER,"
+        " minx REAL, miny REAL, minz REAL, maxx REAL, maxy REAL, maxz REAL,"
+        " density REAL, sampled INTEGER, ground_fraction REAL,"
+        " class_counts TEXT, ingested REAL)"
+    )
+    return db
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def inspect_tile(path, sha=None, sample=SAMPLE_POINTS, chunks=SAMPLE_CHUNKS):
+    """Header fields and sampled point statistics of one LAS/LAZ file
+
+    Never raises: an unreadable file comes back with ok=0 and the error.
+    sha is the file's sha256 if already known.
+    """
+    st = os.stat(path)
+    row = {"name": os.path.splitext(os.path.basename(path))[0], "path": path,
+           "size": st.st_size, "mtime_ns": st.st_mtime_ns, "ok": 1, "error": None,
+           "ingested": time.time()}
+    import laspy
+
+    try:
+        # One decompression thread per file; the files themselves run in parallel
+        with laspy.open(path, laz_backend=laspy.LazBackend.Lazrs) as reader:
+            h = reader.header
+            crs = h.parse_crs()
+            epsg = crs.to_epsg() if crs else None
+            row.update(
+                crs=f"EPSG:{epsg}" if epsg else (crs.to_wkt() if crs else None),
+                version=str(h.version), point_format=h.point_format.id,
+                point_count=int(h.point_count),
+                minx=h.mins[0], miny=h.mins[1], minz=h.mins[2],
+                maxx=h.maxs[0], maxy=h.maxs[1], maxz=h.maxs[2],
+            )
+            area = (h.maxs[0] - h.mins[0]) * (h.maxs[1] - h.mins[1])
+            row["density"] = h.point_count / area if area > 0 else None
+
+            # Runs of points from evenly spaced chunks, first and last
+            # included, rather than the first N, which would all come from
+            # the first scan lines; reading the last chunk also catches
+            # truncated downloads
+            n = h.point_count
+            n_chunks = max(1, -(-n // LAZ_CHUNK))
+            picks = np.unique(np.linspace(0, n_chunks - 1, chunks).round().astype(int))
+            per_chunk = max(1, min(sample // chunks, LAZ_CHUNK))
+            counts = np.zeros(256, dtype=np.int64)
+            for c in picks:
+                reader.seek(int(c) * LAZ_CHUNK)
+                pts = reader.read_points(min(per_chunk, n - int(c) * LAZ_CHUNK))
+                counts += np.bincount(np.asarray(pts.classification, dtype=np.uint8),
+                                      minlength=256)
+        total = int(counts.sum())
+        row.update(
+            sampled=total,
+            ground_fraction=counts[GROUND] / total if total else None,
+            class_counts=json.dumps({int(c): int(k) for c, k in enumerate(counts) if k}),
+        )
+        if total == 0 and n:
+            raise ValueError("no points could be read")
+    except Exception as e:
+        row.update(ok=0, error=f"{type(e).__name__}: {e}")
+    row["sha256"] = sha or _sha256(path)
+    return row
+
+
+def ingest(laz_dir=None, db_path=None, workers=None, manifest=None):
+    """Index new or changed tiles in laz_dir and drop rows for deleted ones
+
+    laz_dir and db_path default to the AOI's. Returns (indexed, total) tile
+    counts.
+    """
+    laz_dir = laz_dir or state.paths()["laz"]
+    paths = sorted(glob.glob(f"{laz_dir}/*.laz") + glob.glob(f"{laz_dir}/*.las"))
+    manifest = manifest or state.Manifest()
+    db = connect(db_path)
+    known = {r["path"]: (r["size"], r["mtime_ns"]) for r in db.execute(
+        "SELECT path, size, mtime_ns FROM tiles")}
+
+    todo = []
+    for path in paths:
+        st = os.stat(path)
+        if known.get(path) != (st.st_size, st.st_mtime_ns):
+            # Reuse the manifest's cached hash instead of re-reading the file
+            cached = manifest.data["files"].get(path)
+            sha = cached[2] if cached and cached[:2] == [st.st_size, st.st_mtime_ns] else None
+            todo.append((path, sha))
+
+    with db:
+        db.executemany("DELETE FROM tiles WHERE path = ?",
+                       [(p,) for p in set(known) - set(paths)])
+    if todo:
+        print(f"Indexing {len(todo)} of {len(paths)} LAZ tiles...")
+    t0 = time.perf_counter()
+    for (path, _), row in blocks.map_blocks(inspect_tile, todo, workers):
+        with db:
+            db.execute(INSERT, [row.get(c) for c in COLUMNS])
+        manifest.data["files"][path] = [row["size"], row["mtime_ns"], row["sha256"]]
+        if not row["ok"]:
+            print(f"✗ {row['name']}: {row['error']}")
+    manifest.save()
+    db.close()
+    if todo:
+        dt = time.perf_counter() - t0
+        print(f"✓ Indexed {len(todo)} tiles in {dt:.1f}s ({len(todo) / dt:.1f} tiles/s)")
+    return len(todo), len(paths)
+
+
+def index_tile(path, db_path=None):
+    """Index one tile as soon as it is on disk; returns its row"""
+    row = inspect_tile(path)
+    db = connect(db_path)
+    try:
+        with db:
+            db.execute(INSERT, [row.get(c) for c in COLUMNS])
+    finally:
+        db.close()
+    return row
+
+
+def tiles(where="1", params=(), db_path=None):
+    """Index rows as dicts, e.g. tiles("ok AND density > ?", (5,))"""
+    db_path = db_path or state.paths()["index"]
+    if not os.path.exists(db_path):
+        return []
+    db = connect(db_path)
+    try:
+        return [dict(r) for r in db.execute(f"SELECT * FROM tiles WHERE {where} ORDER BY name",
+                                            params)]
+    finally:
+        db.close()
+
+
+def lookup(path, db_path=None):
+    """Index row of path if it is current (same size and mtime), else None"""
+    st = os.stat(path)
+    rows = tiles("path = ? AND size = ? AND mtime_ns = ?",
+                 (path, st.st_size, st.st_mtime_ns), db_path)
+    return rows[0] if rows else None
+
+
+def summary(db_path=None):
+    rows = tiles(db_path=db_path)
+    good = [r for r in rows if r["ok"]]
+    points = sum(r["point_count"] for r in good)
+    densities = [r["density"] for r in good if r["density"]]
+    ground = [r["ground_fraction"] for r in good if r["ground_fraction"] is not None]
+    return {
+        "tiles": len(rows),
+        "corrupt": [r["name"] for r in rows if not r["ok"]],
+        "points": points,
+        "density": float(np.median(densities)) if densities else None,
+        "ground_fraction": float(np.median(ground)) if ground else None,
+        "crs": sorted({r["crs"] for r in good if r["crs"]}),
+    }
+
+
+if __name__ == "__main__":
+    ingest()
+    for r in tiles():
+        if r["ok"]:
+            print(f"  {r['name']:<28} {r['point_count']:>12,} pts  "
+                  f"{r['density'] or 0:6.1f} pts/m²  ground {r['ground_fraction'] or 0:5.1%}  "
+                  f"{r['crs'] or 'no CRS'}")
+        else:
+            print(f"  {r['name']:<28} ✗ {r['error']}")
+    s = summary()
+    print(f"✅ {s['tiles']} tiles, {s['points']:,} points, median density "
+          f"{s['density'] or 0:.1f} pts/m², {len(s['corrupt'])} corrupt")
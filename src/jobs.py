@@ -0,0 +1,262 @@
+"""Background jobs for the pipeline stages.
+
+Jobs live in a SQLite table so the Streamlit page can lose its session (a
+rerun, a browser refresh) without losing track of them. Each job runs its
+command under a detached runner process (`python src/jobs.py run <id>`)
+that captures the output to data/jobs/<id>.log and records progress and
+throughput in the table. Jobs run one at a time in submission order,
+because every stage reads what the previous one wrote; when a runner
+finishes it starts the next queued job.
+
+Pipeline commands run in the warm worker (worker.py) when it is up,
+without starting a new interpreter. Stage scripts report progress with
+progress(done, total, unit), which is a no-op unless the script runs
+under a job runner.
+"""
+import json
+import os
+import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+
+JOBS_DB = "data/jobs/jobs.sqlite"
+LOG_DIR = "data/jobs"
+ACTIVE = ("queued", "running", "cancelling")
+PROGRESS_PREFIX = "@progress"
+
+_PROGRESS = re.compile(rf"^{PROGRESS_PREFIX} (\d+) (\d+) ?(.*)$")
+
+
+def progress(done, total, unit=""):
+    """Report progress of the current job; silent outside a job runner"""
+    if os.environ.get("LIDAR_JOB_ID"):
+        print(f"{PROGRESS_PREFIX} {done} {total} {unit}".rstrip(), flush=True)
+
+
+def _connect(path=JOBS_DB):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, stage TEXT, cmd TEXT,"
+        " status TEXT, pid INTEGER, returncode INTEGER,"
+        " done INTEGER DEFAULT 0, total INTEGER DEFAULT 0, unit TEXT DEFAULT '',"
+        " created REAL, started REAL, updated REAL, finished REAL, env TEXT)"
+    )
+    if "env" not in {row[1] for row in db.execute("PRAGMA table_info(jobs)")}:
+        db.execute("ALTER TABLE jobs ADD COLUMN env TEXT")
+    return db
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def log_path(job_id):
+    return f"{LOG_DIR}/{job_id}.log"
+
+
+def submit(stage, cmd, path=JOBS_DB, env=None):
+    """Queue cmd for stage and start it if nothing else is running
+
+    env holds extra environment variables for the command. Returns the job
+    id, or the id of the job already queued or running for the same stage.
+    """
+    db = _connect(path)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute(
+            f"SELECT id FROM jobs WHERE stage = ? AND status IN ({','.join('?' * len(ACTIVE))})",
+            (stage, *ACTIVE),
+        ).fetchone()
+        if row:
+            db.execute("COMMIT")
+            return row["id"]
+        job_id = db.execute(
+            "INSERT INTO jobs (stage, cmd, env, status, created) VALUES (?, ?, ?, 'queued', ?)",
+            (stage, json.dumps(cmd), json.dumps(env or {}), time.time()),
+        ).lastrowid
+        db.execute("COMMIT")
+    finally:
+        db.close()
+    start_next(path)
+    return job_id
+
+
+def start_next(path=JOBS_DB):
+    """Spawn a runner for the oldest queued job unless one is already running"""
+    db = _connect(path)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        _reap(db)
+        busy = db.execute(
+            "SELECT 1 FROM jobs WHERE status IN ('running', 'cancelling')"
+        ).fetchone()
+        row = None if busy else db.execute(
+            "SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            db.execute("COMMIT")
+            return None
+        # start_new_session detaches the runner from Streamlit, and makes it
+        # the leader of a process group that cancel() can signal as a whole
+        runner = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "run", str(row["id"]), path],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, start_new_session=True,
+        )
+        db.execute(
+            "UPDATE jobs SET status = 'running', pid = ?, started = ?, updated = ?"
+            " WHERE id = ?", (runner.pid, time.time(), time.time(), row["id"]),
+        )
+        db.execute("COMMIT")
+        return row["id"]
+    finally:
+        db.close()
+
+
+def _reap(db):
+    """Mark jobs whose runner died without recording an outcome as failed
+
+    A runner killed while it was being cancelled (e.g. by a SIGTERM that
+    came before it could install its handler) counts as cancelled.
+    """
+    for row in db.execute(
+        "SELECT id, pid, status FROM jobs WHERE status IN ('running', 'cancelling')"
+    ).fetchall():
+        if row["pid"] and not _alive(row["pid"]):
+            db.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ?",
+                ("cancelled" if row["status"] == "cancelling" else "failed",
+                 time.time(), row["id"]),
+            )
+
+
+def cancel(job_id, path=JOBS_DB):
+    """Cancel a queued job, or stop a running one and everything it started"""
+    db = _connect(path)
+    try:
+        row = db.execute("SELECT status, pid FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row["status"] not in ACTIVE:
+            return False
+        if row["status"] == "queued":
+            db.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?",
+                       (time.time(), job_id))
+            return True
+        db.execute("UPDATE jobs SET status = 'cancelling' WHERE id = ?", (job_id,))
+        try:
+            os.killpg(row["pid"], signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        return True
+    finally:
+        db.close()
+
+
+def get(job_id, path=JOBS_DB):
+    db = _connect(path)
+    try:
+        _reap(db)
+        row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        db.close()
+
+
+def latest(stage=None, path=JOBS_DB):
+    """Most recent job per stage, as {stage: job}"""
+    db = _connect(path)
+    try:
+        _reap(db)
+        rows = db.execute(
+            "SELECT * FROM jobs WHERE id IN (SELECT MAX(id) FROM jobs GROUP BY stage)"
+        ).fetchall()
+        jobs = {row["stage"]: dict(row) for row in rows}
+        return jobs.get(stage) if stage else jobs
+    finally:
+        db.close()
+
+
+def rate(job):
+    """Throughput of a job in units per second, or None before any progress"""
+    if not job or not job["done"] or not job["started"]:
+        return None
+    end = job["finished"] or job["updated"] or time.time()
+    return job["done"] / max(end - job["started"], 1e-6)
+
+
+def tail(job_id, lines=20):
+    try:
+        with open(log_path(job_id), encoding="utf-8", errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+    except FileNotFoundError:
+        return ""
+
+
+def run(job_id, path=JOBS_DB):
+    """Runner body: execute the job's command, streaming its output into the log and table"""
+    db = _connect(path)
+    job = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    env = dict(os.environ, **json.loads(job["env"] or "{}"),
+               LIDAR_JOB_ID=str(job_id), PYTHONUNBUFFERED="1")
+    cmd = json.loads(job["cmd"])
+    # Installed before the command starts, so a cancel that arrives meanwhile
+    # is not lost: the command is stopped as soon as it exists
+    child = None
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        if child is not None:
+            child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    # In the warm worker (worker.py) if it is up: no interpreter start or imports
+    import worker
+    child = worker.spawn(cmd, env) or subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+    if stopping:
+        child.terminate()
+
+    last = 0.0
+    with open(log_path(job_id), "w", encoding="utf-8") as log:
+        for line in child.stdout:
+            m = _PROGRESS.match(line)
+            if not m:
+                log.write(line)
+                log.flush()
+                continue
+            now = time.time()
+            # Throttle table writes; the page polls every couple of seconds anyway
+            if now - last >= 0.5 or m[1] == m[2]:
+                db.execute("UPDATE jobs SET done = ?, total = ?, unit = ?, updated = ?"
+                           " WHERE id = ?", (int(m[1]), int(m[2]), m[3], now, job_id))
+                last = now
+    code = child.wait()
+
+    status = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+    outcome = "cancelled" if status == "cancelling" else "done" if code == 0 else "failed"
+    db.execute("UPDATE jobs SET status = ?, returncode = ?, finished = ? WHERE id = ?",
+               (outcome, code, time.time(), job_id))
+    db.close()
+    start_next(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "run":
+        run(int(sys.argv[2]), *sys.argv[3:4])
+    else:
+        for stage, job in latest().items():
+            print(f"{job['id']:>4} {stage:<10} {job['status']:<10} "
+                  f"{job['done']}/{job['total']} {job['unit']}")
@@ -0,0 +1,157 @@
+"""Folium map and anomaly summaries for the Streamlit app.
+
+Everything here is a pure function of its arguments, so app.py can cache
+the parsed GeoJSON and the rendered map HTML keyed on the file's
+mtime and size: a widget click reuses both instead of re-reading the file
+and redrawing every marker.
+"""
+import html
+import json
+import os
+
+import folium
+from folium import plugins
+
+COLOR_MAP = {
+    "muro": "red",
+    "túmulo": "orange",
+    "fossa": "purple",
+    "camino": "green",
+}
+DEFAULT_COLOR = "blue"
+
+# Above this many points, markers go through one clustered layer built in
+# the browser from a compact array instead of one folium object each
+CLUSTER_THRESHOLD = 500
+
+# Clustered markers keep the per-type colour; row = [lat, lon, colour, popup]
+_CLUSTER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 8, color: row[2], fill: true, fillColor: row[2], fillOpacity: 0.6
+    });
+    marker.bindPopup(row[3], {maxWidth: 300});
+    return marker;
+}
+"""
+
+
+def file_key(path):
+    """(mtime_ns, size) of path, or None if it does not exist; a cache key for its contents"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def load_anomalies(path):
+    """Parse the anomalies GeoJSON once into what both app columns need
+
+    Returns a dict with the features, the count per type and the raw file
+    bytes for the download button.
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    features = json.loads(raw).get("features", [])
+    counts = {}
+    for feature in features:
+        tipo = feature["properties"].get("tipo", "desconocido")
+        counts[tipo] = counts.get(tipo, 0) + 1
+    return {"features": features, "counts": counts, "raw": raw}
+
+
+def _popup(props):
+    return (f"<b>Tipo:</b> {html.escape(str(props.get('tipo', 'N/A')))}<br>"
+            f"<b>Confianza:</b> {props.get('score', 0):.2f}<br>"
+            f"<b>Justificación:</b> {html.escape(str(props.get('justificacion', 'N/A')))}")
+
+
+def anomaly_layer(features, threshold=CLUSTER_THRESHOLD):
+    """Anomaly markers coloured by type, clustered when there are many"""
+    if len(features) > threshold:
+        rows = []
+        for feature in features:
+            lon, lat = feature["geometry"]["coordinates"][:2]
+            props = feature["properties"]
+            rows.append([lat, lon, COLOR_MAP.get(props.get("tipo", ""), DEFAULT_COLOR),
+                         _popup(props)])
+        return plugins.FastMarkerCluster(rows, callback=_CLUSTER_CALLBACK, name="Anomalías")
+
+    layer = folium.FeatureGroup(name="Anomalías")
+    for feature in features:
+        lon, lat = feature["geometry"]["coordinates"][:2]
+        props = feature["properties"]
+        color = COLOR_MAP.get(props.get("tipo", ""), DEFAULT_COLOR)
+        folium.CircleMarker(
+            location=[lat, lon],
+            radius=8,
+            color=color,
+            fill=True,
+            fillColor=color,
+            fillOpacity=0.6,
+            popup=folium.Popup(_popup(props), max_width=300)
+        ).add_to(layer)
+    return layer
+
+
+def change_layer(changes):
+    """Changed regions from change.py: red where ground was lowered, blue where it was raised"""
+    def style(feature):
+        color = "red" if feature["properties"].get("dz_medio_m", 0) < 0 else "blue"
+        return {"color": color, "weight": 2, "fillColor": color, "fillOpacity": 0.3}
+
+    return folium.GeoJson(
+        {"type": "FeatureCollection", "features": list(changes)},
+        name="Cambios entre coberturas",
+        style_function=style,
+        tooltip=folium.GeoJsonTooltip(
+            fields=["tipo", "area_m2", "volumen_m3", "dz_medio_m", "dz_max_m"],
+            aliases=["Tipo", "Área (m²)", "Volumen (m³)", "Cambio medio (m)", "Cambio máximo (m)"]),
+    )
+
+
+def build_map(bbox, features=(), tile_layers=(), threshold=CLUSTER_THRESHOLD, roi=None,
+              changes=()):
+    """Full map HTML: base map, study area, raster tile layers, anomalies and changes
+
+    tile_layers is a sequence of (url_template, name, show) tuples; roi, if
+    given, is outlined as well. changes are the features of changes.geojson.
+    """
+    m = folium.Map(
+        location=[(bbox[1] + bbox[3]) / 2, (bbox[0] + bbox[2]) / 2],
+        zoom_start=12,
+        tiles="OpenStreetMap"
+    )
+    folium.Rectangle(
+        bounds=[[bbox[1], bbox[0]], [bbox[3], bbox[2]]],
+        color="blue",
+        fill=False,
+        weight=2,
+        popup="Área de Estudio"
+    ).add_to(m)
+    if roi:
+        folium.Rectangle(
+            bounds=[[roi[1], roi[0]], [roi[3], roi[2]]],
+            color="red",
+            fill=False,
+            weight=2,
+            dash_array="6",
+            popup="ROI"
+        ).add_to(m)
+    for url, name, show in tile_layers:
+        folium.raster_layers.TileLayer(
+            tiles=url,
+            name=name,
+            attr="PNOA-LiDAR CNIG",
+            overlay=True,
+            show=show,
+            opacity=0.8,
+            max_zoom=20
+        ).add_to(m)
+    if changes:
+        change_layer(changes).add_to(m)
+    if features:
+        anomaly_layer(list(features), threshold).add_to(m)
+    folium.LayerControl().add_to(m)
+    return m._repr_html_()
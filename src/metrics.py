@@ -0,0 +1,227 @@
+"""Run metrics for the pipeline stages.
+
+Stage scripts wrap their work in `with metrics.stage(name, unit):`, which
+appends one JSON line per stage run to data/metrics/runs.jsonl with wall
+and CPU time, peak RSS, bytes read and written (the process and the
+children it waited for, such as PDAL and the block workers) and
+throughput in the stage's unit. Code inside the stage reports the units
+it processed with count() and per-tile or per-layer figures with item(),
+which are written as "item" lines of the same run; both are no-ops
+outside a stage, like jobs.progress().
+
+Set LIDAR_PROFILE=cprofile (or pyinstrument, if installed) to profile a
+stage: the profile goes to data/metrics/profiles/ and the hottest
+functions are printed at the end.
+
+    python src/metrics.py        # last runs per stage, with regressions
+"""
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+RUN_LOG = "data/metrics/runs.jsonl"
+PROFILE_DIR = "data/metrics/profiles"
+REGRESSION = 0.2    # flag stages more than 20% slower than their recent median
+
+_current = None
+
+
+def _io_bytes():
+    """(read, written) storage bytes of this process and its reaped children"""
+    child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read, written = child.ru_inblock * 512, child.ru_oublock * 512
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return read + int(fields["read_bytes"]), written + int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        return read + own.ru_inblock * 512, written + own.ru_oublock * 512
+
+
+def _cpu():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + child.ru_utime + child.ru_stime
+
+
+def _peak_rss_mb():
+    """Largest resident set of this process or any reaped child, in MB"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _write(records, path=RUN_LOG):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def count(units):
+    """Add units (tiles, megapixels, chips) processed by the current stage"""
+    if _current is not None:
+        _current["units"] += units
+
+
+def run_id():
+    """Run id of the current stage, so other records can refer to the run; None outside a stage"""
+    return _current["run"] if _current is not None else None
+
+
+def item(key, **values):
+    """Record per-item figures (one tile, one layer, one chip) for the current stage"""
+    if _current is not None:
+        _current["items"].append(dict(values, key=key))
+
+
+@contextmanager
+def _profiler(name, run_id):
+    kind = os.environ.get("LIDAR_PROFILE", "").lower()
+    if kind not in ("cprofile", "pyinstrument"):
+        yield
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = f"{PROFILE_DIR}/{run_id}-{name}"
+    if kind == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("⚠ pyinstrument is not installed, profiling with cProfile")
+        else:
+            profiler = Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                with open(f"{base}.html", "w", encoding="utf-8") as f:
+                    f.write(profiler.output_html())
+                print(profiler.output_text(unicode=True, color=False))
+                print(f"✓ Profile written to {base}.html")
+            return
+
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(f"{base}.prof")
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(15)
+        print(out.getvalue())
+        print(f"✓ Profile written to {base}.prof (open with snakeviz or pstats)")
+
+
+@contextmanager
+def stage(name, unit="", path=RUN_LOG):
+    """Measure the enclosed work as one run of stage name and append it to the run log
+
+    Yields the run record; set its "ok" to False to record a failure that
+    did not raise.
+    """
+    global _current
+    run_id = os.environ.get("LIDAR_RUN_ID") or f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    record = {"kind": "stage", "run": run_id, "stage": name, "aoi": os.environ.get("LIDAR_AOI"),
+              "started": time.time(), "unit": unit, "units": 0, "items": [], "ok": True,
+              "commit": _commit(), "argv": sys.argv[1:]}
+    outer, _current = _current, record
+    t0, cpu0, (read0, written0) = time.perf_counter(), _cpu(), _io_bytes()
+    try:
+        with _profiler(name, run_id):
+            yield record
+    except BaseException as e:
+        record["ok"] = isinstance(e, SystemExit) and e.code in (0, None)
+        raise
+    finally:
+        _current = outer
+        wall = time.perf_counter() - t0
+        read, written = _io_bytes()
+        items = record.pop("items")
+        record.update(
+            wall=round(wall, 3), cpu=round(_cpu() - cpu0, 3), rss_mb=round(_peak_rss_mb(), 1),
+            read_mb=round((read - read0) / 1e6, 2), written_mb=round((written - written0) / 1e6, 2),
+            rate=round(record["units"] / wall, 4) if wall > 0 and record["units"] else None,
+            n_items=len(items),
+        )
+        _write([record] + [dict(i, kind="item", run=run_id, stage=name) for i in items], path)
+        print(f"⏱ {name}: {wall:.1f}s wall, {record['cpu']:.1f}s CPU, "
+              f"{record['rss_mb']:.0f} MB peak, {record['read_mb']:.1f} MB read, "
+              f"{record['written_mb']:.1f} MB written"
+              + (f", {record['rate']:.2f} {unit}/s" if record["rate"] else ""))
+
+
+def load(path=RUN_LOG):
+    """All records of the run log, oldest first; unreadable lines are skipped"""
+    records = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def stage_runs(records):
+    return [r for r in records if r.get("kind") == "stage"]
+
+
+def regressions(records, window=5, threshold=REGRESSION):
+    """Latest run of each stage (and AOI) against the median of the runs before it
+
+    Runs are compared in seconds per unit (tile, Mpx, chip), so an
+    incremental run that had little to do is not mistaken for a fast one;
+    failed runs and runs that processed nothing are left out. Returns
+    {(stage, aoi): (latest, median, relative change, slower than threshold)}
+    for the stages with enough history.
+    """
+    history = {}
+    for r in stage_runs(records):
+        if r.get("ok") and r.get("units"):
+            history.setdefault((r["stage"], r.get("aoi")), []).append(r["wall"] / r["units"])
+    result = {}
+    for key, costs in history.items():
+        if len(costs) < 2:
+            continue
+        previous = sorted(costs[-window - 1:-1])
+        median = previous[len(previous) // 2]
+        change = (costs[-1] - median) / median if median > 0 else 0.0
+        result[key] = (costs[-1], median, change, change > threshold)
+    return result
+
+
+if __name__ == "__main__":
+    runs = stage_runs(load())
+    for r in runs[-20:]:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(r["started"]))
+        rate = f"{r['rate']:.2f} {r['unit']}/s" if r.get("rate") else ""
+        print(f"  {when} {r['stage']:<9} {r.get('aoi') or '':<14} {'✓' if r['ok'] else '✗'} "
+              f"{r['wall']:8.1f}s {r['cpu']:8.1f}s CPU {r['rss_mb']:7.0f} MB  {rate}")
+    units = {(r["stage"], r.get("aoi")): r["unit"] for r in runs}
+    for (name, aoi), (cost, median, change, slow) in regressions(runs).items():
+        if slow:
+            print(f"⚠ {name}{f' ({aoi})' if aoi else ''}: {cost:.3g} s/{units[name, aoi]} "
+                  f"vs median {median:.3g} ({change:+.0%})")
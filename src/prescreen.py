@@ -0,0 +1,285 @@
+"""Local, deterministic pre-screening of the DEM for anomaly candidates.
+
+Scores every detection chip on the CPU, without the model. A local
+relief residual, the elevation minus its mean within residual_radius_m
+(the matching tpi band of relief.tif, or computed from the DEM when
+relief() has not produced it), is thresholded into raised and sunken
+regions and their connected components are labelled. The radius is kept
+near the size of the features: the 20 m LRM leaves hill crests and valley
+floors of ordinary terrain a few decimetres proud, enough for mounds on
+them to merge into one large region. Each component is described by
+its area, mean relief, and length, width and elongation from its second
+moments. Compact raised blobs are mound candidates (túmulo), long narrow
+raised ones walls (muro), and sunken ones ditches or pits (fossa); with
+svf.tif, sunken regions must also be enclosed (low SVF). A chip scores the
+sum of its best candidates.
+
+detect.py sends only the prescreen.top_k best chips to the model. Run on
+its own, this writes the candidates to outputs/candidates.geojson.
+
+    python src/prescreen.py              # candidates for the whole DEM
+    python src/prescreen.py --top-k 20   # and the 20 chips the model would see
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import rasterio
+from rasterio.warp import transform as transform_coords
+from rasterio.windows import Window
+from scipy import ndimage
+
+import blocks
+import jobs
+import metrics
+import state
+
+# Thresholds and shape limits; config.yaml's `prescreen:` section overrides them
+PRESCREEN = {
+    "residual_radius_m": 10.0,     # elevation minus its mean within this radius
+    "threshold_m": 0.2,            # |residual| above this is raised / sunken ground
+    "svf_max": 0.97,               # sunken regions must have a lower SVF (if svf.tif exists)
+    "min_area_m2": 6.0,
+    "max_mound_area_m2": 700.0,    # a 30 m wide mound
+    "max_mound_elongation": 2.0,   # length / width of compact candidates
+    "min_linear_elongation": 3.0,  # length / width of walls and ditches
+    "min_length_m": 10.0,
+    "max_width_m": 6.0,
+    "min_score": 0.3,
+    "per_chip": 5,                 # candidates that count towards a chip's score
+    "top_k": 0,                    # chips sent to the model by detect.py; 0 = all
+}
+
+
+def settings():
+    return dict(PRESCREEN, **state.settings("prescreen"))
+
+
+def _band(path, name):
+    """1-based index of the band described as name, or None"""
+    if not os.path.exists(path):
+        return None
+    with rasterio.open(path) as src:
+        return src.descriptions.index(name) + 1 if name in src.descriptions else None
+
+
+def _residual(dem, relief_path, band, win, radius_m):
+    """Relief residual for a window: read from relief.tif, or computed from a padded DEM read"""
+    if band:
+        with rasterio.open(relief_path) as src:
+            return src.read(band, window=win).astype("float32")
+    with rasterio.open(dem) as src:
+        r = max(1, int(round(radius_m / src.res[0])))
+        arr = blocks.read_padded(src, win, r)
+    return arr[r:-r, r:-r] - blocks.box_mean(arr, r)[r:-r, r:-r]
+
+
+def components(mask, residual, res):
+    """Area, mean |relief|, centroid and second-moment shape of each 8-connected region
+
+    Returns a dict of equal-length arrays, one entry per component.
+    """
+    labels, n = ndimage.label(mask, structure=np.ones((3, 3)))
+    flat = labels.ravel()
+    pixels = np.flatnonzero(flat)
+    lab = flat[pixels]
+    rows, cols = np.divmod(pixels, mask.shape[1])
+    rows, cols = rows.astype("float64"), cols.astype("float64")
+    count = np.bincount(lab, minlength=n + 1)[1:].astype("float64")
+
+    def mean(values):
+        return np.bincount(lab, values, minlength=n + 1)[1:] / np.maximum(count, 1)
+
+    r, c = mean(rows), mean(cols)
+    rr = mean(rows * rows) - r * r
+    cc = mean(cols * cols) - c * c
+    rc = mean(rows * cols) - r * c
+    # Eigenvalues of the covariance; a line one pixel wide still has 1/12
+    # of a pixel² of variance across it
+    half, det = (rr + cc) / 2, rr * cc - rc * rc
+    disc = np.sqrt(np.maximum(half * half - det, 0))
+    major = np.maximum(half + disc, 1 / 12)
+    minor = np.maximum(half - disc, 1 / 12)
+    return {
+        "row": r, "col": c,
+        "area": count * res * res,
+        "relief": mean(np.abs(residual.ravel()[pixels]).astype("float64")),
+        # A uniform segment of length L has variance L²/12 along it
+        "length": np.sqrt(12 * major) * res,
+        "width": np.sqrt(12 * minor) * res,
+        "elongation": np.sqrt(major / minor),
+    }
+
+
+def classify(comp, raised, cfg):
+    """Type, score and keep mask of each component; type is "" where it fits no shape"""
+    big = comp["area"] >= cfg["min_area_m2"]
+    compact = (big & (comp["elongation"] <= cfg["max_mound_elongation"])
+               & (comp["area"] <= cfg["max_mound_area_m2"]))
+    linear = (big & (comp["elongation"] >= cfg["min_linear_elongation"])
+              & (comp["length"] >= cfg["min_length_m"]) & (comp["width"] <= cfg["max_width_m"]))
+    if raised:
+        tipo = np.where(compact, "túmulo", np.where(linear, "muro", ""))
+    else:
+        tipo = np.where(compact | linear, "fossa", "")
+    # Relief above the threshold times linear size, squashed to 0-1
+    strength = comp["relief"] / cfg["threshold_m"] * np.sqrt(comp["area"])
+    score = 1 - np.exp(-strength / 10)
+    keep = (tipo != "") & (score >= cfg["min_score"])
+    return tipo, score, keep
+
+
+def screen_array(residual, svf, res, cfg):
+    """Candidates in one array: list of dicts with pixel row/col, tipo, score and shape"""
+    valid = np.isfinite(residual)
+    t = cfg["threshold_m"]
+    masks = [(True, valid & (residual > t))]
+    sunken = valid & (residual < -t)
+    if svf is not None and cfg.get("svf_max") is not None:
+        sunken &= np.isfinite(svf) & (svf < cfg["svf_max"])
+    masks.append((False, sunken))
+
+    found = []
+    for raised, mask in masks:
+        comp = components(mask, residual, res)
+        tipo, score, keep = classify(comp, raised, cfg)
+        for i in np.flatnonzero(keep):
+            found.append({"row": comp["row"][i], "col": comp["col"][i], "tipo": str(tipo[i]),
+                          "score": round(float(score[i]), 3),
+                          "area_m2": round(float(comp["area"][i]), 1),
+                          "relief_m": round(float(comp["relief"][i]), 3),
+                          "length_m": round(float(comp["length"][i]), 1),
+                          "width_m": round(float(comp["width"][i]), 1),
+                          "elongation": round(float(comp["elongation"][i]), 2)})
+    return found
+
+
+def _screen_chip(dem, relief_path, band, svf_path, win, core, cfg):
+    """Worker: candidates whose centre lies in the chip's core, and the chip's score"""
+    residual = _residual(dem, relief_path, band, win, cfg["residual_radius_m"])
+    svf = None
+    if svf_path:
+        with rasterio.open(svf_path) as src:
+            svf = src.read(1, window=win, masked=True).filled(np.nan).astype("float32")
+    with rasterio.open(dem) as src:
+        res, transform = src.res[0], src.window_transform(win)
+    found = screen_array(residual, svf, res, cfg)
+    scores = sorted((f["score"] for f in found), reverse=True)
+    row0, col0, row1, col1 = core
+    owned = []
+    for f in found:
+        r, c = win.row_off + f["row"], win.col_off + f["col"]
+        if row0 <= r < row1 and col0 <= c < col1:
+            x, y = transform * (f.pop("col") + 0.5, f.pop("row") + 0.5)
+            owned.append(dict(f, x=x, y=y))
+    return float(sum(scores[:cfg["per_chip"]])), owned
+
+
+def screen(windows, area, overlap, dem=None, deriv=None, cfg=None, workers=None):
+    """Score each chip window of area across a process pool
+
+    dem and deriv default to the AOI's. Returns [(window, score,
+    candidates)] in window order; candidates are dicts in the DEM's CRS,
+    each reported by one chip only.
+    """
+    paths = state.paths()
+    dem, deriv = dem or paths["dem"], deriv or paths["deriv"]
+    cfg = cfg or settings()
+    relief_path, svf_path = f"{deriv}/relief.tif", f"{deriv}/svf.tif"
+    band = _band(relief_path, f"tpi_{cfg['residual_radius_m']:g}m")
+    svf_path = svf_path if os.path.exists(svf_path) else None
+    work = [(dem, relief_path, band, svf_path, win, blocks.chip_core(win, area, overlap), cfg)
+            for win in windows]
+    chips = []
+    for i, (job, (score, found)) in enumerate(blocks.map_blocks(_screen_chip, work, workers), 1):
+        chips.append((job[4], score, found))
+        jobs.progress(i, len(work), "chips")
+    return chips
+
+
+def top(chips, k):
+    """The k best-scoring chips with any candidate, best first (ties in window order)"""
+    ranked = sorted((c for c in chips if c[1] > 0), key=lambda c: -c[1])
+    return ranked[:k] if k else ranked
+
+
+def to_geojson(detections, crs):
+    """Detections in the raster CRS as a lon/lat GeoJSON FeatureCollection"""
+    if not detections:
+        return {"type": "FeatureCollection", "features": []}
+    lons, lats = transform_coords(crs, "EPSG:4326",
+                                  [d["x"] for d in detections], [d["y"] for d in detections])
+    features = []
+    for det, lon, lat in zip(detections, lons, lats):
+        props = {k: v for k, v in det.items() if k not in ("x", "y")}
+        features.append({"type": "Feature",
+                         "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                         "properties": props})
+    return {"type": "FeatureCollection", "features": features}
+
+
+def candidates(roi=None, top_k=None, size=1024, overlap=128, output=None, workers=None):
+    """Screen the DEM (or the ROI) and write every candidate to output as GeoJSON
+
+    output defaults to the AOI's candidates.geojson. Returns the screened
+    chips, or None without a DEM.
+    """
+    paths = state.paths()
+    dem, output = paths["dem"], output or paths["candidates"]
+    if not os.path.exists(dem):
+        print(f"✗ DEM file not found: {dem}")
+        return None
+    cfg = settings()
+    top_k = cfg["top_k"] if top_k is None else top_k
+    with rasterio.open(dem) as src:
+        area = blocks.roi_window(src, roi) if roi else Window(0, 0, src.width, src.height)
+        crs = src.crs
+    if area is None:
+        print(f"⚠ ROI {roi} does not overlap the DEM")
+        return None
+
+    windows = blocks.chip_windows(area, size, overlap)
+    band = f"tpi_{cfg['residual_radius_m']:g}m"
+    source = "relief.tif" if _band(f"{paths['deriv']}/relief.tif", band) else "the DEM"
+    print(f"Pre-screening {len(windows)} chips ({band} residual from {source})...")
+    t0 = time.perf_counter()
+    chips = screen(windows, area, overlap, dem, paths["deriv"], cfg=cfg, workers=workers)
+    dt = time.perf_counter() - t0
+    metrics.count(len(chips))
+
+    found = sorted((f for _, _, cands in chips for f in cands), key=lambda f: -f["score"])
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(to_geojson(found, crs), f, indent=2, ensure_ascii=False)
+
+    mpx = area.width * area.height / 1e6
+    kinds = {}
+    for f in found:
+        kinds[f["tipo"]] = kinds.get(f["tipo"], 0) + 1
+    kept = top(chips, top_k)
+    print(f"✓ {len(chips)} chips in {dt:.1f}s ({len(chips) / dt:.1f} chips/s, "
+          f"{mpx / dt:.1f} Mpx/s)")
+    print(f"✓ {len(found)} candidates: "
+          + (", ".join(f"{n} {k}" for k, n in sorted(kinds.items())) or "none"))
+    print(f"✓ {len(kept)} of {len(chips)} chips would go to the model "
+          f"({len(chips) - len(kept)} model calls avoided)")
+    print(f"✅ Candidates saved to {output}")
+    return chips
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score chips and find candidates without the model")
+    parser.add_argument("--top-k", type=int, help="chips the model would see (default prescreen.top_k)")
+    parser.add_argument("--roi", nargs=4, type=float, metavar=("W", "S", "E", "N"),
+                        help="only screen this lon/lat box")
+    args = parser.parse_args()
+    detect_cfg = state.settings("detect")
+    with metrics.stage("prescreen", "chips") as run:
+        chips = candidates(args.roi, args.top_k, detect_cfg.get("chip_size", 1024),
+                           detect_cfg.get("chip_overlap", 128))
+        run["ok"] = chips is not None
+        for win, score, _ in top(chips or [], args.top_k or 0)[:args.top_k or 10]:
+            print(f"  chip {int(win.row_off)}_{int(win.col_off)}  score {score:.2f}")
+    raise SystemExit(0 if run["ok"] else 1)
@@ -1,66 +1,707 @@
-import subprocess
+import argparse
+import hashlib
 import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack
+from functools import lru_cache
 import rasterio
-from scipy.ndimage import maximum_filter
+import rasterio.windows
 import numpy as np
+from rasterio.windows import Window
 
-os.makedirs("data/deriv", exist_ok=True)
+import blocks
+import jobs
+import metrics
+import state
 
 
-def hill_multi(dem):
-    """Generate multiple hillshade images from different azimuth angles"""
+def _same_grid(path, profile):
+    """True if the raster at path can be updated in place for profile"""
+    if not os.path.exists(path):
+        return False
+    with rasterio.open(path) as ds:
+        return (ds.width, ds.height, ds.count, ds.dtypes[0], ds.transform) == (
+            profile["width"], profile["height"], profile["count"], profile["dtype"],
+            profile["transform"])
+
+
+def _has_overviews(path):
+    with rasterio.open(path) as ds:
+        return bool(ds.overviews(1))
+
+
+def _block_digests(manifest, dem, transform, windows, halo, params):
+    """Digest of what each block reads: the DEM tiles under its halo, or its halo window's pixels"""
+    tiles = manifest.items("dem") if manifest.stage("dem").get("mosaic") == dem else {}
+    if not tiles:
+        # A DEM from outside the dem stage: hash the pixels each block reads,
+        # so an edit only invalidates the blocks whose halo it touches
+        with rasterio.open(dem) as src:
+            for win in windows:
+                arr = blocks.read_padded(src, win, halo)
+                yield state.digest(params, hashlib.sha256(arr.tobytes()).hexdigest())
+        return
+    res = transform.a
+    for win in windows:
+        x0, y1 = transform * (win.col_off, win.row_off)
+        x1, y0 = transform * (win.col_off + win.width, win.row_off + win.height)
+        x0, y0, x1, y1 = x0 - halo * res, y0 - halo * res, x1 + halo * res, y1 + halo * res
+        deps = sorted(item["digest"] for item in tiles.values()
+                      if item["bounds"][0] < x1 and item["bounds"][2] > x0
+                      and item["bounds"][1] < y1 and item["bounds"][3] > y0)
+        yield state.digest(params, deps)
+
+
+# One derivative for _run_kernels(): fn(arr, transform, *args) maps a DEM block
+# padded with halo pixels to a (bands, rows, cols) array. With a single path
+# all bands go to it (described by bands, if given), otherwise band i goes to
+# paths[i]. params are what, besides the DEM, invalidates its blocks.
+Kernel = namedtuple("Kernel", "name paths profile fn args halo params bands")
+
+
+def _prepare(kernel, dem, transform, windows, manifest, roi_win, stack, moved):
+    """Open kernel's outputs and pick its stale blocks
+
+    Blocks are keyed in the state manifest by their map position, so when the
+    DEM grows the blocks that did not change are copied from the previous
+    outputs instead of being recomputed. With roi_win only the blocks under
+    it count as stale; the rest are left as they are. Outputs renamed to
+    .old to make way for new ones go to moved as (name, path, old path).
+    """
+    name, paths, profile = kernel.name, kernel.paths, kernel.profile
+    keys = []
+    for win in windows:
+        x, y = transform * (win.col_off, win.row_off)
+        keys.append(f"{name}:{x:g},{y:g}")
+    digests = _block_digests(manifest, dem, transform, windows, kernel.halo, kernel.params)
+    manifest.prune("deriv", keep=set(keys) | {k for k in manifest.items("deriv")
+                                               if not k.startswith(f"{name}:")})
+
+    count = profile["count"] if len(paths) == 1 else 1
+    in_place = all(_same_grid(p, dict(profile, count=count)) for p in paths)
+    olds, previous = [], {}
+    if not in_place:
+        for path in paths:
+            if os.path.exists(path):
+                os.replace(path, f"{path}.old")
+                olds.append(f"{path}.old")
+                moved.append((name, path, f"{path}.old"))
+        # The outputs start over: no block may be on record until it is written
+        # again, or a run that fails halfway leaves holes the next one skips
+        entries = manifest.items("deriv")
+        previous = {k: entries.pop(k) for k in keys if k in entries}
+        manifest.save()
+
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    mode = "r+" if in_place else "w"
+    dsts = [stack.enter_context(rasterio.open(p, mode, **dict(profile, count=count)))
+            for p in paths]
+    old_dsts = [stack.enter_context(rasterio.open(p)) for p in olds]
+
+    stale = {}
+    for i, (win, key, d) in enumerate(zip(windows, keys, digests)):
+        outside = roi_win is not None and not blocks.overlaps(win, roi_win)
+        if in_place:
+            fresh = not manifest.stale("deriv", key, d)
+        else:
+            fresh = previous.get(key, {}).get("digest") == d
+        if fresh or outside:
+            if in_place:
+                continue
+            if len(old_dsts) == len(dsts) and _copy_block(old_dsts, dsts, transform, win):
+                if fresh:
+                    manifest.record("deriv", key, d, paths)
+                continue
+            if outside:
+                # Not written this run, and off the record: the next full run computes it
+                continue
+        stale[i] = (key, d)
+    if kernel.bands:
+        for i, band in enumerate(kernel.bands, 1):
+            dsts[0].set_band_description(i, band)
+    return {"kernel": kernel, "dsts": dsts, "olds": olds, "stale": stale,
+            "compute": 0.0, "write": 0.0}
+
+
+def _run_kernels(dem, kernels, block=None, workers=None, manifest=None, roi=None):
+    """Bring the outputs of several derivative kernels up to date in one pass over the DEM
+
+    Each DEM block that any kernel needs is read and decoded once, with the
+    widest halo among those kernels, and saved uncompressed to RAM-backed
+    scratch (blocks.scratch_dir). The jobs of every kernel on it go to one
+    process pool, whose workers map the block and cut it down to the halo
+    they need, and the main process is the only writer of each output file.
+    With roi (W, S, E, N in lon/lat) only the blocks under it are brought up
+    to date. Returns {name: (computed, total)} block counts; the time each
+    kernel spent computing, writing and building overviews goes to
+    metrics.item() and is printed.
+    """
+    manifest = manifest or state.Manifest()
+    workers = workers or os.cpu_count() or 1
+    t0 = time.perf_counter()
+    with rasterio.open(dem) as src:
+        size = block or blocks.block_size(src)
+        transform = src.transform
+        windows = list(blocks.grid_windows(transform, src.width, src.height, size))
+        roi_win = blocks.roi_window(src, roi) if roi else None
+    if roi and roi_win is None:
+        print(f"⚠ ROI {roi} does not overlap the DEM")
+        return {kernel.name: (0, 0) for kernel in kernels}
+
+    unit = f"{'/'.join(kernel.name for kernel in kernels)} blocks"
+    read = 0.0
+    moved = []      # (kernel name, output, previous output renamed to .old)
+    try:
+        with ExitStack() as stack:
+            runs = [_prepare(kernel, dem, transform, windows, manifest, roi_win, stack, moved)
+                    for kernel in kernels]
+            todo = [(i, [run for run in runs if i in run["stale"]]) for i in range(len(windows))]
+            todo = iter([(i, todo_runs) for i, todo_runs in todo if todo_runs])
+            total = sum(len(run["stale"]) for run in runs)
+            src = stack.enter_context(rasterio.open(dem))
+            tmp = stack.enter_context(blocks.scratch_dir())
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+
+            running = {}    # future -> (block index, run)
+            left = {}       # block index -> jobs on its scratch file still running
+            done = 0
+            while True:
+                # Keep about 2 * workers jobs in flight, so the scratch holds a
+                # few blocks at a time and not the whole DEM
+                while len(running) < 2 * workers:
+                    i, block_runs = next(todo, (None, None))
+                    if i is None:
+                        break
+                    pad = max(run["kernel"].halo for run in block_runs)
+                    t = time.perf_counter()
+                    path = os.path.join(tmp, f"{i}.npy")
+                    np.save(path, blocks.read_padded(src, windows[i], pad))
+                    read += time.perf_counter() - t
+                    left[i] = len(block_runs)
+                    for run in block_runs:
+                        kernel = run["kernel"]
+                        fut = pool.submit(blocks.run_scratch, kernel.fn, path, pad, kernel.halo,
+                                          transform, *kernel.args)
+                        running[fut] = (i, run)
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    i, run = running.pop(fut)
+                    arr, seconds = fut.result()
+                    t = time.perf_counter()
+                    win, dsts = windows[i], run["dsts"]
+                    if len(dsts) == 1:
+                        dsts[0].write(arr, window=win)
+                    else:
+                        for dst, band in zip(dsts, arr):
+                            dst.write(band, 1, window=win)
+                    run["compute"] += seconds
+                    run["write"] += time.perf_counter() - t
+                    manifest.record("deriv", *run["stale"][i], run["kernel"].paths)
+                    left[i] -= 1
+                    if not left[i]:
+                        os.remove(os.path.join(tmp, f"{i}.npy"))
+                        del left[i]
+                    done += 1
+                    jobs.progress(done, total, unit)
+    except BaseException:
+        # Put the previous outputs back rather than leave a half-written file
+        # beside them; their kernels stay off the record, so the next run redoes them
+        for name, path, old in moved:
+            os.replace(old, path)
+        replaced = {name for name, _, _ in moved}
+        entries = manifest.items("deriv")
+        for key in [k for k in entries if k.partition(":")[0] in replaced]:
+            del entries[key]
+        manifest.save()
+        raise
+    wall = time.perf_counter() - t0
+
+    counts, parts = {}, []
+    pending = manifest.stage("deriv").setdefault("stale_overviews", [])
+    for run in runs:
+        name, paths = run["kernel"].name, run["kernel"].paths
+        stale, olds = run["stale"], run["olds"]
+        for path in olds:
+            os.remove(path)
+        t = time.perf_counter()
+        # Rebuilding the pyramid reads the whole raster, so an ROI run leaves it
+        # for the next full run instead of spending most of its time there
+        if roi:
+            if (stale or olds) and name not in pending:
+                pending.append(name)
+        else:
+            for path in paths:
+                if stale or olds or name in pending or not _has_overviews(path):
+                    blocks.build_overviews(path)
+            if name in pending:
+                pending.remove(name)
+        overviews = time.perf_counter() - t
+        mpx = sum(windows[i].width * windows[i].height for i in stale) / 1e6
+        metrics.count(mpx)
+        metrics.item(name, seconds=round(run["compute"] + run["write"] + overviews, 3),
+                     compute=round(run["compute"], 3), write=round(run["write"], 3),
+                     overviews=round(overviews, 3), blocks=len(stale), total=len(windows),
+                     mpx=round(mpx, 3))
+        counts[name] = (len(stale), len(windows))
+        if stale:
+            parts.append(f"{name} {run['compute']:.1f}s + {run['write']:.1f}s write"
+                         f" + {overviews:.1f}s overviews")
+    manifest.save()
+    if parts:
+        metrics.item("dem_read", seconds=round(read, 3), workers=workers)
+        print(f"⏱ DEM blocks read once in {read:.1f}s; worker time {', '.join(parts)}; "
+              f"{wall:.1f}s wall on {workers} workers")
+    return counts
+
+
+def _copy_block(srcs, dsts, transform, win):
+    """Copy one block from previous outputs on another grid, if they cover it"""
+    bounds = rasterio.windows.bounds(win, transform)
+    for src, dst in zip(srcs, dsts):
+        old_win = rasterio.windows.from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+        if (old_win.col_off < 0 or old_win.row_off < 0
+                or old_win.col_off + old_win.width > src.width
+                or old_win.row_off + old_win.height > src.height):
+            return False
+        dst.write(src.read(window=old_win), window=win)
+    return True
+
+
+AZIMUTHS = (45, 90, 135, 180, 225, 270, 315, 360)
+
+
+def _horn(arr, ewres, nsres):
+    """Horn x and y gradients of the core of a 1-pixel NaN-padded array
+
+    Like gdaldem -compute_edges, a missing neighbour is extrapolated as
+    2 * centre - opposite, or the centre if that is missing too.
+    """
+    h, w = arr.shape[0] - 2, arr.shape[1] - 2
+    win = [arr[r:r + h, c:c + w] for r in range(3) for c in range(3)]
+    centre = win[4]
+    with np.errstate(invalid="ignore"):
+        for k in (0, 1, 2, 3, 5, 6, 7, 8):
+            missing = np.isnan(win[k])
+            if missing.any():
+                fill = 2 * centre - win[8 - k]
+                fill = np.where(np.isnan(fill), centre, fill)
+                win[k] = np.where(missing, fill, win[k])
+
+    x = ((win[0] + 2 * win[3] + win[6]) - (win[2] + 2 * win[5] + win[8])) / (8 * ewres)
+    y = ((win[6] + 2 * win[7] + win[8]) - (win[0] + 2 * win[1] + win[2])) / (8 * nsres)
+    return x, y
+
+
+def _hillshade_array(arr, ewres, nsres, azimuths, altitude, combined):
+    """Shade the core of a 1-pixel NaN-padded array for every azimuth at once
+
+    Follows gdaldem's Horn algorithm with -compute_edges (see _horn): slope
+    and aspect terms are computed once, and each azimuth is a cheap linear
+    combination of them. Returns uint8 bands with 0 as nodata and
+    1-255 as shade, in the order of azimuths plus the combined band if asked.
+    """
+    h, w = arr.shape[0] - 2, arr.shape[1] - 2
+    x, y = _horn(arr, ewres, nsres)
+    centre = arr[1:1 + h, 1:1 + w]
+    inv_norm = 1 / np.sqrt(1 + x * x + y * y)
+
+    alt = np.radians(altitude)
+    nodata = np.isnan(centre)
+    shades = []
+    for az in azimuths:
+        a = np.radians(az)
+        cang = (np.sin(alt) - (y * np.cos(a) - x * np.sin(a)) * np.cos(alt)) * inv_norm
+        shades.append(np.clip(cang, 0, None))
+    if combined:
+        shades.append(sum(shades) / len(azimuths))
+
+    out = np.empty((len(shades), h, w), dtype="uint8")
+    for i, cang in enumerate(shades):
+        band = np.where(cang <= 0, 1, np.floor(1.5 + 254 * cang))
+        band[nodata] = 0
+        out[i] = band
+    return out
+
+
+def _hill_block(arr, transform, azimuths, altitude, combined):
+    """Kernel: shade one DEM block read with a 1-pixel halo"""
+    return _hillshade_array(arr, transform.a, transform.e, azimuths, altitude, combined)
+
+
+def hill_kernel(dem, azimuths=AZIMUTHS, altitude=45, combined=True, multiband=False,
+                out_dir=None):
+    """The hillshade Kernel for dem (see hill_multi)"""
+    out_dir = out_dir or state.paths()["deriv"]
+    with rasterio.open(dem) as src:
+        profile = blocks.tiled_profile(src.profile, dtype="uint8", nodata=0)
+
+    names = [str(az) for az in azimuths] + (["multi"] if combined else [])
+    if multiband:
+        paths = [f"{out_dir}/hillshade.tif"]
+        profile.update(count=len(names))
+    else:
+        paths = [f"{out_dir}/hill_{name}.tif" for name in names]
+    args = (tuple(azimuths), altitude, combined)
+    bands = [f"hillshade {name}" for name in names] if multiband else None
+    return Kernel("hillshade", paths, profile, _hill_block, args, 1, [args, paths], bands)
+
+
+def hill_multi(dem, azimuths=AZIMUTHS, altitude=45, combined=True, multiband=False,
+               out_dir=None, block=None, workers=None, manifest=None, roi=None):
+    """Generate hillshades for several azimuths in a single pass over the DEM
+
+    Each DEM block is read once, slope and aspect are computed once, and all
+    azimuths are shaded from them. Output matches `gdaldem hillshade
+    -compute_edges` within 1 DN (rounding of the float shade to Byte).
+    With multiband=False each azimuth goes to hill_<az>.tif and the combined
+    band (mean illumination over all azimuths, not gdaldem's
+    -multidirectional weighting) to hill_multi.tif; with multiband=True
+    everything goes to one band per azimuth in hillshade.tif. The files go
+    to out_dir (default: the AOI's deriv directory). Only blocks whose DEM
+    input changed since the last run are recomputed, and with roi (W, S, E,
+    N in lon/lat) only those under it.
+    """
     print("Generating hillshade derivatives...")
-    for az in (45, 90, 135, 180, 225, 270, 315, 360):
-        out = f"data/deriv/hill_{az}.tif"
-        try:
-            subprocess.run(
-                ["gdaldem", "hillshade", "-az", str(az), "-alt", "45", 
-                 "-compute_edges", dem, out],
-                check=True,
-                capture_output=True
-            )
-            print(f"✓ Generated hillshade azimuth {az}°")
-        except subprocess.CalledProcessError as e:
-            print(f"✗ Error generating hillshade {az}°: {e.stderr.decode()}")
-        except FileNotFoundError:
-            print("✗ Error: gdaldem command not found. Make sure GDAL is installed.")
-            break
-
-
-def svf(dem):
-    """Calculate Sky View Factor (SVF) from DEM"""
+    try:
+        kernel = hill_kernel(dem, azimuths, altitude, combined, multiband, out_dir)
+        done, total = _run_kernels(dem, [kernel], block=block, workers=workers,
+                                   manifest=manifest, roi=roi)["hillshade"]
+        print(f"✓ Generated hillshade azimuths {', '.join(f'{az}°' for az in azimuths)} "
+              f"({done}/{total} blocks recomputed)")
+
+    except Exception as e:
+        print(f"✗ Error generating hillshades: {e}")
+
+
+SVF_DIRECTIONS = 16
+SVF_RADIUS_M = 10.0
+
+
+@lru_cache(maxsize=None)
+def _horizon_offsets(directions, radius_px):
+    """Per-direction (dy, dx) pixel offsets along each search ray, nearest first"""
+    table = []
+    for k in range(directions):
+        az = 2 * np.pi * k / directions
+        seen, offsets = set(), []
+        for r in range(1, radius_px + 1):
+            off = (int(round(-r * np.cos(az))), int(round(r * np.sin(az))))
+            if off != (0, 0) and off not in seen:
+                seen.add(off)
+                offsets.append(off)
+        table.append(tuple(offsets))
+    return tuple(table)
+
+
+def _svf_array(arr, res, directions, radius_px):
+    """Horizon-based sky view factor for the core of a NaN-padded array
+
+    arr carries radius_px pixels of halo on every side. For each direction the
+    steepest horizon tangent along the ray is found with whole-array shifts,
+    and SVF = 1 - mean(sin(horizon angle)) with negative horizons clipped to 0.
+    """
+    pad = radius_px
+    h, w = arr.shape[0] - 2 * pad, arr.shape[1] - 2 * pad
+    center = arr[pad:pad + h, pad:pad + w]
+    total = np.zeros((h, w), dtype="float32")
+    tan_max = np.empty((h, w), dtype="float32")
+    with np.errstate(invalid="ignore"):
+        for offsets in _horizon_offsets(directions, radius_px):
+            tan_max.fill(0)
+            for dy, dx in offsets:
+                shifted = arr[pad + dy:pad + dy + h, pad + dx:pad + dx + w]
+                np.fmax(tan_max, (shifted - center) / (np.hypot(dy, dx) * res), out=tan_max)
+            total += tan_max / np.sqrt(1 + tan_max * tan_max)
+    out = 1 - total / directions
+    out[np.isnan(center)] = np.nan
+    return out
+
+
+def _svf_block(arr, transform, directions, radius_px):
+    """Kernel: SVF of one DEM block read with a radius_px halo"""
+    return _svf_array(arr, transform.a, directions, radius_px)[None]
+
+
+def svf_kernel(dem, out=None, directions=SVF_DIRECTIONS, radius=SVF_RADIUS_M):
+    """The SVF Kernel for dem (see svf)"""
+    out = out or f"{state.paths()['deriv']}/svf.tif"
+    with rasterio.open(dem) as src:
+        radius_px = max(1, int(round(radius / src.res[0])))
+        profile = blocks.tiled_profile(src.profile, dtype="float32", nodata=np.nan)
+    args = (directions, radius_px)
+    return Kernel("svf", [out], profile, _svf_block, args, radius_px, [args, out], None)
+
+
+def svf(dem, out=None, directions=SVF_DIRECTIONS, radius=SVF_RADIUS_M,
+        stream=True, block=None, workers=None, manifest=None, roi=None):
+    """Calculate Sky View Factor (SVF) from DEM
+
+    The horizon angle is searched along `directions` rays (8, 16 or 32) up to
+    `radius` metres. With stream=True the DEM is split into blocks, each read
+    with a halo of the search radius so the result matches the whole-array
+    computation exactly, and the blocks are computed across a process pool and
+    written to a tiled GeoTIFF as they complete. Peak memory depends on the
+    block size, not on the raster size, and only blocks whose DEM input changed
+    since the last run are recomputed, or with roi only those under it.
+    out defaults to svf.tif in the AOI's deriv directory.
+    """
     print("Calculating Sky View Factor...")
     try:
-        with rasterio.open(dem) as src:
-            arr = src.read(1)
-            meta = src.meta.copy()
-        
-        # Apply maximum filter to simulate sky visibility
-        rad = 25
-        maxf = maximum_filter(arr, size=rad)
-        
-        # Calculate SVF
-        svf_arr = 1 - (maxf - arr) / (arr + 30)
-        
-        # Update metadata for output
-        meta.update(dtype="float32")
-        
-        with rasterio.open("data/deriv/svf.tif", "w", **meta) as dst:
-            dst.write(svf_arr.astype("float32"), 1)
-        
-        print("✓ Sky View Factor calculated")
-    
+        kernel = svf_kernel(dem, out, directions, radius)
+        out = kernel.paths[0]
+        if not stream:
+            os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+            with rasterio.open(dem) as src, rasterio.open(out, "w", **kernel.profile) as dst:
+                arr = blocks.read_padded(src, Window(0, 0, src.width, src.height), kernel.halo)
+                dst.write(_svf_block(arr, src.transform, *kernel.args))
+            blocks.build_overviews(out)
+            print(f"✓ Sky View Factor calculated ({directions} directions, {radius:g} m)")
+            return
+
+        done, total = _run_kernels(dem, [kernel], block=block, workers=workers,
+                                   manifest=manifest, roi=roi)["svf"]
+        print(f"✓ Sky View Factor calculated ({directions} directions, {radius:g} m, "
+              f"{done}/{total} blocks recomputed)")
+
     except Exception as e:
         print(f"✗ Error calculating SVF: {e}")
 
 
+# Relief visualisation layers computed together by relief(); config.yaml's
+# `relief:` section picks the layers and their radii
+RELIEF = {
+    "layers": ["lrm", "openness_pos", "openness_neg", "slope", "tpi", "dominance"],
+    "lrm_radius_m": 20.0,
+    "tpi_radii_m": [5.0, 15.0, 50.0],
+    "openness_radius_m": 25.0,
+    "dominance_radii_m": [10.0, 20.0],
+    "observer_height_m": 1.7,
+    "directions": 16,
+}
+
+
+def relief_settings():
+    return dict(RELIEF, **state.settings("relief"))
+
+
+def relief_bands(cfg):
+    """Output band names, in order: one per layer, one per scale for tpi"""
+    names = []
+    for layer in cfg["layers"]:
+        if layer == "tpi":
+            names += [f"tpi_{r:g}m" for r in cfg["tpi_radii_m"]]
+        elif layer in ("lrm", "openness_pos", "openness_neg", "slope", "dominance"):
+            names.append(layer)
+        else:
+            raise ValueError(f"unknown relief layer {layer!r}")
+    return names
+
+
+def _relief_radii(cfg, res):
+    """Radii in pixels, and the halo that covers all of the selected layers"""
+    def px(m):
+        return max(1, int(round(m / res)))
+
+    radii = {"lrm": px(cfg["lrm_radius_m"]), "tpi": [px(r) for r in cfg["tpi_radii_m"]],
+             "open": px(cfg["openness_radius_m"]),
+             "dom": [px(r) for r in cfg["dominance_radii_m"]]}
+    layers = set(cfg["layers"])
+    need = [1] if "slope" in layers else []
+    if "lrm" in layers:
+        need.append(3 * radii["lrm"])
+    if "tpi" in layers:
+        need += radii["tpi"]
+    if layers & {"openness_pos", "openness_neg"}:
+        need.append(radii["open"])
+    if "dominance" in layers:
+        need.append(radii["dom"][1])
+    return radii, max(need)
+
+
+def _relief_array(arr, res, cfg, radii, halo):
+    """All selected relief layers for the core of a NaN-padded array
+
+    arr carries halo pixels on every side. Neighbourhood statistics are
+    shared: one pair of summed-area tables of the elevations and of the
+    valid mask serves every TPI scale and the first LRM pass, and one walk
+    along the horizon rays gives both openness layers and local dominance.
+    """
+    layers = cfg["layers"]
+    h, w = arr.shape[0] - 2 * halo, arr.shape[1] - 2 * halo
+    core = (slice(halo, halo + h), slice(halo, halo + w))
+    centre = arr[core]
+    tables = None
+    if {"lrm", "tpi"} & set(layers):
+        valid = ~np.isnan(arr)
+        tables = (blocks.summed_area(np.where(valid, arr, 0)), blocks.summed_area(valid))
+    out = {}
+
+    if "tpi" in layers:
+        for r_m, r in zip(cfg["tpi_radii_m"], radii["tpi"]):
+            out[f"tpi_{r_m:g}m"] = centre - blocks.box_mean(arr, r, tables)[core]
+
+    if "lrm" in layers:
+        # Local relief model: elevation minus a low-pass trend surface, the
+        # trend being three box passes (close to a Gaussian)
+        trend = blocks.box_mean(arr, radii["lrm"], tables)
+        for _ in range(2):
+            trend = blocks.box_mean(np.where(valid, trend, np.nan), radii["lrm"])
+        out["lrm"] = centre - trend[core]
+
+    if "slope" in layers:
+        x, y = _horn(arr[halo - 1:halo + h + 1, halo - 1:halo + w + 1], res, -res)
+        out["slope"] = np.degrees(np.arctan(np.hypot(x, y)))
+
+    want_open = {"openness_pos", "openness_neg"} & set(layers)
+    if want_open or "dominance" in layers:
+        r_open, (d_min, d_max) = radii["open"], radii["dom"]
+        eye = cfg["observer_height_m"]
+        reach = max(r_open if want_open else 0, d_max if "dominance" in layers else 0)
+        pos = np.zeros((h, w), dtype="float32")
+        neg = np.zeros((h, w), dtype="float32")
+        dom = np.zeros((h, w), dtype="float32")
+        dom_n = np.zeros((h, w), dtype="float32")
+        dirs = np.zeros((h, w), dtype="float32")
+        t_max = np.empty((h, w), dtype="float32")
+        t_min = np.empty((h, w), dtype="float32")
+        with np.errstate(invalid="ignore"):
+            for offsets in _horizon_offsets(cfg["directions"], reach):
+                t_max.fill(-np.inf)
+                t_min.fill(np.inf)
+                for dy, dx in offsets:
+                    dist = np.hypot(dy, dx)
+                    shifted = arr[halo + dy:halo + dy + h, halo + dx:halo + dx + w]
+                    dz = shifted - centre
+                    if dist <= r_open:
+                        tan = dz / (dist * res)
+                        np.fmax(t_max, tan, out=t_max)
+                        np.fmin(t_min, tan, out=t_min)
+                    if d_min <= dist <= d_max and "dominance" in layers:
+                        # Angle at which an observer eye-height above the
+                        # centre looks down on this point
+                        angle = np.arctan((eye - dz) / (dist * res))
+                        ok = ~np.isnan(angle)
+                        np.add(dom, angle, out=dom, where=ok)
+                        dom_n += ok
+                # Rays that leave the data (raster edge, nodata) do not count
+                seen = np.isfinite(t_max)
+                pos += np.where(seen, 90 - np.degrees(np.arctan(t_max)), 0)
+                neg += np.where(seen, 90 + np.degrees(np.arctan(t_min)), 0)
+                dirs += seen
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out["openness_pos"] = pos / dirs
+            out["openness_neg"] = neg / dirs
+            out["dominance"] = np.degrees(dom / dom_n)
+
+    names = relief_bands(cfg)
+    result = np.empty((len(names), h, w), dtype="float32")
+    nodata = np.isnan(centre)
+    for i, name in enumerate(names):
+        result[i] = out[name]
+        result[i][nodata] = np.nan
+    return result
+
+
+def _relief_block(arr, transform, cfg, radii, halo):
+    """Kernel: every relief layer of one DEM block read with the widest layer's halo"""
+    return _relief_array(arr, transform.a, cfg, radii, halo)
+
+
+def relief_kernel(dem, out=None, cfg=None):
+    """The relief Kernel for dem (see relief), or None if no layer is selected"""
+    cfg = cfg or relief_settings()
+    if not cfg["layers"]:
+        return None
+    out = out or f"{state.paths()['deriv']}/relief.tif"
+    names = relief_bands(cfg)
+    with rasterio.open(dem) as src:
+        radii, halo = _relief_radii(cfg, src.res[0])
+        profile = blocks.tiled_profile(src.profile, dtype="float32", nodata=np.nan)
+        profile.update(count=len(names))
+    return Kernel("relief", [out], profile, _relief_block, (cfg, radii, halo), halo,
+                  [cfg, out], names)
+
+
+def relief(dem, out=None, cfg=None, block=None, workers=None,
+           manifest=None, roi=None):
+    """Compute the configured relief layers in one fused, block-wise pass
+
+    Layers (config.yaml `relief.layers`): local relief model, positive and
+    negative openness, slope, topographic position index at several scales
+    and local dominance. Each block is read once with a halo wide enough
+    for the largest kernel, all layers are computed from that read, and the
+    blocks run across a process pool. Output is one float32 band per layer
+    in a tiled GeoTIFF with overviews (default: relief.tif in the AOI's
+    deriv directory), band descriptions naming the layers.
+    """
+    cfg = cfg or relief_settings()
+    if not cfg["layers"]:
+        return
+    print("Calculating relief layers...")
+    try:
+        kernel = relief_kernel(dem, out, cfg)
+        done, total = _run_kernels(dem, [kernel], block=block, workers=workers,
+                                   manifest=manifest, roi=roi)["relief"]
+        print(f"✓ Relief layers calculated ({', '.join(kernel.bands)}; "
+              f"{done}/{total} blocks recomputed)")
+
+    except Exception as e:
+        print(f"✗ Error calculating relief layers: {e}")
+
+
+DERIVATIVES = ("hillshade", "svf", "relief")
+
+
+def derivatives(dem, manifest=None, roi=None, only=DERIVATIVES, block=None, workers=None):
+    """Hillshades, SVF and relief layers of dem in one scheduled pass (see _run_kernels)
+
+    Every DEM block is read once for all of them and their blocks share one
+    process pool. Seals the deriv stage when all of them ran over the whole DEM.
+    """
+    manifest = manifest or state.Manifest()
+    print(f"Calculating derivatives: {', '.join(only)}...")
+    try:
+        build = {"hillshade": hill_kernel, "svf": svf_kernel, "relief": relief_kernel}
+        kernels = [kernel for kernel in (build[name](dem) for name in only) if kernel]
+        counts = _run_kernels(dem, kernels, block=block, workers=workers,
+                              manifest=manifest, roi=roi)
+        params = state.stage_params("deriv")
+    except Exception as e:
+        print(f"✗ Error calculating derivatives: {e}")
+        return
+    for name, (done, total) in counts.items():
+        print(f"✓ {name}: {done}/{total} blocks recomputed")
+
+    if roi:
+        # Blocks outside the ROI may still be out of date
+        print(f"✅ Processing complete for ROI {roi}")
+    elif set(only) >= set(DERIVATIVES):
+        manifest.finish("deriv", upstream=manifest.stage("dem").get("digest"),
+                        params=params)
+        print("✅ Processing complete")
+    else:
+        print(f"✅ Processing complete for {', '.join(only)}")
+
+
 if __name__ == "__main__":
-    dem_path = "data/dem_velez.tif"
+    parser = argparse.ArgumentParser(description="Compute hillshades, SVF and relief layers from the DEM")
+    parser.add_argument("--roi", nargs=4, type=float, metavar=("W", "S", "E", "N"),
+                        help="only update the blocks under this lon/lat box")
+    parser.add_argument("--only", nargs="+", choices=DERIVATIVES, default=DERIVATIVES,
+                        help="derivatives to compute (default: all)")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    args = parser.parse_args()
+    dem_path = state.paths()["dem"]
     
     if not os.path.exists(dem_path):
         print(f"✗ DEM file not found: {dem_path}")
         print("Please run the PDAL pipeline first to generate the DEM.")
     else:
-        hill_multi(dem_path)
-        svf(dem_path)
-        print("✅ Processing complete")
+        with metrics.stage("deriv", "Mpx"):
+            derivatives(dem_path, roi=args.roi, only=args.only, workers=args.workers)
@@ -0,0 +1,253 @@
+"""Content-hashed pipeline state.
+
+The manifest records, for every stage (download → dem → deriv → detect),
+a digest of the inputs and parameters each item was built from, plus the
+outputs it produced. A stage re-runs only the items whose digest changed,
+so adding one LAZ tile rebuilds that tile's DEM (and its neighbours', whose
+buffer now sees new points) and only the derivative blocks over it.
+
+File hashes are cached by (size, mtime) so unchanged files are never
+re-read.
+
+config.yaml describes one area of interest under `aoi:` or several under
+`aois:`. A single `aoi:` keeps the original layout (data/laz,
+data/dem_velez.tif, outputs/); with `aois:` each area gets its own
+data/aoi/<name>/ and outputs/<name>/, including its own manifest. Stage
+scripts work on the area named by the LIDAR_AOI environment variable,
+or the first one. LIDAR_EPOCH=<laz_version> points them at another
+coverage of that area (for change.py), with its own LAZ tiles, DEM and
+manifest under epochs/<laz_version>/.
+"""
+import glob
+import hashlib
+import json
+import os
+
+import yaml
+
+CONFIG = "config.yaml"
+STAGES = ("download", "dem", "deriv", "detect")
+
+
+def _config(config=CONFIG):
+    # Benchmarks run the stage code in a scratch directory without a config:
+    # they get the single-AOI layout
+    if not os.path.exists(config):
+        return {}
+    with open(config) as f:
+        return yaml.safe_load(f)
+
+
+def settings(section, config=CONFIG):
+    """One top-level section of config.yaml, e.g. settings("relief")"""
+    return _config(config).get(section) or {}
+
+
+def areas(config=CONFIG):
+    """AOI blocks from config.yaml: the `aois:` list, or the single `aoi:` block
+
+    Without a config or an `aoi:` block there is one unnamed area with the
+    single-AOI layout and no laz_version.
+    """
+    cfg = _config(config)
+    if "aois" in cfg:
+        return cfg["aois"]
+    return [cfg.get("aoi") or {"name": None, "laz_version": None}]
+
+
+def _block(name=None, config=CONFIG):
+    blocks = areas(config)
+    name = name or os.environ.get("LIDAR_AOI")
+    if name is None:
+        return blocks[0]
+    for block in blocks:
+        if block["name"] == name:
+            return block
+    raise KeyError(f"no AOI named {name!r} in {config}")
+
+
+def _epoch(block, epoch=None):
+    """laz_version to work on ($LIDAR_EPOCH), or None for the AOI's own"""
+    epoch = epoch or os.environ.get("LIDAR_EPOCH")
+    return epoch if epoch and epoch != block["laz_version"] else None
+
+
+def area(name=None, config=CONFIG, epoch=None):
+    """AOI block called name (default: $LIDAR_AOI, else the first one)
+
+    With an epoch (default: $LIDAR_EPOCH) other than its laz_version, the
+    block describes that coverage of the same area instead.
+    """
+    block = _block(name, config)
+    version = _epoch(block, epoch) or block["laz_version"]
+    # Tile indexes that tileindex.INDEX_URLS does not know, by laz_version
+    urls = settings("index_urls", config)
+    if version == block["laz_version"] and version not in urls:
+        return block
+    return dict(block, laz_version=version, index_url=urls.get(version))
+
+
+def paths(name=None, config=CONFIG, epoch=None):
+    """Where the files of one AOI live
+
+    Another coverage of the area (see area()) keeps its LAZ tiles, DEM and
+    manifest under epochs/<laz_version>/ next to the AOI's own.
+    """
+    if "aois" not in _config(config):
+        result = {"laz": "data/laz", "index": "data/laz_index.sqlite",
+                  "vrt": "data/dem/dem_velez.vrt", "dem": "data/dem_velez.tif",
+                  "deriv": "data/deriv", "outputs": "outputs",
+                  "anomalies": "outputs/anomalies.geojson",
+                  "candidates": "outputs/candidates.geojson",
+                  "changes": "outputs/changes.geojson", "manifest": "data/manifest.json"}
+        root = "data"
+        block = areas(config)[0]
+    else:
+        block = _block(name, config)
+        root, out = f"data/aoi/{block['name']}", f"outputs/{block['name']}"
+        result = {"laz": f"{root}/laz", "index": f"{root}/laz_index.sqlite",
+                  "vrt": f"{root}/dem.vrt", "dem": f"{root}/dem.tif",
+                  "deriv": f"{root}/deriv", "outputs": out,
+                  "anomalies": f"{out}/anomalies.geojson",
+                  "candidates": f"{out}/candidates.geojson",
+                  "changes": f"{out}/changes.geojson", "manifest": f"{root}/manifest.json"}
+    version = _epoch(block, epoch)
+    if version:
+        base = f"{root}/epochs/{version}"
+        result.update(laz=f"{base}/laz", index=f"{base}/laz_index.sqlite",
+                      vrt=f"{base}/dem.vrt", dem=f"{base}/dem.tif", deriv=f"{base}/deriv",
+                      manifest=f"{base}/manifest.json")
+    return result
+
+
+def __getattr__(name):
+    # PATHS and MANIFEST are resolved on every use rather than frozen at
+    # import, so a process that outlives a change to config.yaml, LIDAR_AOI
+    # or LIDAR_EPOCH (the app, the warm worker) never hands out stale paths
+    if name == "PATHS":
+        return paths()
+    if name == "MANIFEST":
+        return paths()["manifest"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def digest(*parts):
+    """Stable sha256 of JSON-serialisable parts"""
+    blob = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(blob).hexdigest()
+
+
+def stage_params(stage, config=CONFIG, pipeline="pipelines/laz2dem.json", name=None,
+                 epoch=None):
+    """Configuration that affects a stage's outputs, from config.yaml and laz2dem.json"""
+    cfg = _config(config)
+    aoi = area(name, config, epoch)
+    if stage == "download":
+        return {k: aoi.get(k) for k in ("bbox", "max_downloads", "laz_version")}
+    if stage == "dem":
+        with open(pipeline) as f:
+            return {"pipeline": json.load(f)}
+    if stage == "deriv":
+        return {"relief": cfg.get("relief")}
+    if stage == "detect":
+        return dict({k: aoi.get(k) for k in ("name", "bbox")}, detect=cfg.get("detect"),
+                    prescreen=cfg.get("prescreen"))
+    return {}
+
+
+class Manifest:
+    """Per-stage, per-item record of input digests and outputs"""
+
+    def __init__(self, path=None):
+        self.path = path or paths()["manifest"]
+        self.data = {"files": {}, "stages": {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.data = json.load(f)
+
+    def file_hash(self, path):
+        """sha256 of a file, reused while its size and mtime are unchanged"""
+        st = os.stat(path)
+        cached = self.data["files"].get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        self.data["files"][path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+        return h.hexdigest()
+
+    def stage(self, stage):
+        return self.data["stages"].setdefault(stage, {"items": {}})
+
+    def items(self, stage):
+        return self.stage(stage)["items"]
+
+    def stale(self, stage, key, item_digest):
+        """True if key was never built, was built from other inputs, or lost an output"""
+        item = self.items(stage).get(key)
+        if item is None or item["digest"] != item_digest:
+            return True
+        return not all(os.path.exists(p) for p in item.get("outputs", []))
+
+    def record(self, stage, key, item_digest, outputs=(), **extra):
+        self.items(stage)[key] = dict(extra, digest=item_digest, outputs=list(outputs))
+
+    def prune(self, stage, keep):
+        """Drop items not in keep and return their records"""
+        items = self.items(stage)
+        return {k: items.pop(k) for k in list(items) if k not in keep}
+
+    def finish(self, stage, upstream=None, params=None):
+        """Seal a stage: summary digest of its items plus what it was built from"""
+        s = self.stage(stage)
+        s["digest"] = digest(sorted((k, v["digest"]) for k, v in s["items"].items()))
+        s["upstream"] = upstream
+        s["params"] = digest(params)
+        self.save()
+        return s["digest"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+
+def laz_digest(manifest, laz_dir=None):
+    """Digest of the current LAZ tile set, the upstream of the DEM stage"""
+    laz_dir = laz_dir or paths()["laz"]
+    return digest(sorted((os.path.basename(p), manifest.file_hash(p))
+                         for p in glob.glob(f"{laz_dir}/*.laz")))
+
+
+def upstream_digest(manifest, stage, laz_dir=None):
+    """What a stage would be built from right now"""
+    if stage == "dem":
+        return laz_digest(manifest, laz_dir)
+    if stage in ("deriv", "detect"):
+        prev = STAGES[STAGES.index(stage) - 1]
+        return manifest.stage(prev).get("digest")
+    return None
+
+
+def status(manifest=None, name=None, epoch=None):
+    """'fresh', 'stale' or 'missing' for every stage of an AOI, without running anything"""
+    manifest = manifest or Manifest(paths(name, epoch=epoch)["manifest"])
+    laz_dir = paths(name, epoch=epoch)["laz"]
+    result = {}
+    for stage in STAGES:
+        s = manifest.stage(stage)
+        outputs = [p for item in s["items"].values() for p in item.get("outputs", [])]
+        if "digest" not in s or not s["items"] or not all(os.path.exists(p) for p in outputs):
+            result[stage] = "missing"
+        elif (s.get("upstream") != upstream_digest(manifest, stage, laz_dir)
+              or s.get("params") != digest(stage_params(stage, name=name, epoch=epoch))
+              or (stage in ("deriv", "detect")
+                  and result[STAGES[STAGES.index(stage) - 1]] != "fresh")):
+            result[stage] = "stale"
+        else:
+            result[stage] = "fresh"
+    return result
@@ -0,0 +1,95 @@
+"""Content-addressed file store shared by all areas of interest.
+
+LAZ tiles are downloaded once into data/store/laz/<laz_version>/ and
+hard-linked into the laz directory of every AOI that covers them. DEM
+tiles are written to data/store/dem/<digest>.tif, where the digest covers
+the PDAL pipeline, the tile bounds and the sha256 of every LAZ file the
+tile reads, so AOIs that share a tile (and its neighbours) classify and
+rasterise it once. Files are written under a temporary name and renamed
+into place, so a path in the store is always complete.
+
+Nothing is deleted from the store when an AOI drops a tile; gc() removes
+the files that no AOI refers to any more.
+"""
+import glob
+import os
+import re
+import shutil
+import time
+
+STORE = "data/store"
+LAZ_STORE = f"{STORE}/laz"
+DEM_STORE = f"{STORE}/dem"
+# Partial files (partial(), download .part files) younger than this may still
+# be written or resumed, so gc() leaves them alone
+PARTIAL_AGE = 24 * 3600
+
+_PARTIAL = re.compile(r"\.(part|tmp)(\.[^./]+)?$")
+
+
+def laz_path(version, name):
+    return f"{LAZ_STORE}/{version}/{name}.laz"
+
+
+def dem_tile(digest):
+    return f"{DEM_STORE}/{digest}.tif"
+
+
+def partial(path):
+    """Temporary name to write path under before publish()"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid()}.part{ext}"
+
+
+def publish(tmp, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp, path)
+
+
+def contains(path):
+    return os.path.abspath(path).startswith(os.path.abspath(STORE) + os.sep)
+
+
+def link(src, dst):
+    """Make dst refer to the file at src: a hard link, else a symlink, else a copy"""
+    if os.path.exists(dst):
+        return dst
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    return dst
+
+
+def gc(referenced):
+    """Delete store files not among referenced paths (or their links)
+
+    Partial files are only deleted once older than PARTIAL_AGE, so a
+    download or DEM tile being written meanwhile is not pulled from under
+    it. Returns (files, bytes) removed.
+    """
+    keep = set()
+    for path in referenced:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        keep.add((st.st_dev, st.st_ino))
+    files = size = 0
+    for path in glob.glob(f"{STORE}/**/*.*", recursive=True):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            # Renamed into place (or away) since the glob
+            continue
+        if _PARTIAL.search(path) and time.time() - st.st_mtime < PARTIAL_AGE:
+            continue
+        if (st.st_dev, st.st_ino) not in keep:
+            os.remove(path)
+            files += 1
+            size += st.st_size
+    return files, size
@@ -0,0 +1,235 @@
+"""Stream LAZ tiles from the download straight into the DEM stage.
+
+download.py fetches every tile before dem.py starts, so on a large AOI the
+CPU idles while the network works and the other way round. Here tiles are
+downloaded in scan order (north to south, west to east) and each one is
+indexed as soon as it is verified on disk. A PDAL worker rasterises a tile
+as soon as it and every neighbour its buffer reads from are on disk (or
+failed), into the same store path dem.py would use. dem.build_dem() then
+finds every tile in the store and only records and mosaics them, and the
+derivatives run block-wise on the mosaic as in process.py (their blocks
+read a halo across tile edges, so they start once the mosaic exists).
+
+At most `ahead` tiles are downloading or downloaded but not yet
+rasterised: a slow PDAL holds the downloader back instead of letting
+unprocessed tiles pile up. `ahead` is raised if needed to one more than
+the scan-order distance from a tile to its last neighbour, the smallest
+value that can never stall.
+
+    python src/stream.py                          # download, DEM and derivatives
+    python src/stream.py --ahead 24 --workers 4 --no-deriv
+    python src/stream.py --roi W S E N
+"""
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+import dem
+import download
+import ingest
+import jobs
+import metrics
+import process
+import state
+import store
+import tileindex
+
+AHEAD = 12
+CONNECTIONS = 6
+
+
+def scan_order(tiles):
+    """(projected bounds, row) of the index rows, north to south and west to east
+
+    Neighbours end up close together, so a tile's neighbourhood is complete
+    soon after the tile itself arrives.
+    """
+    projected = tiles.to_crs(tiles.estimate_utm_crs())
+    rows = [(tuple(b), row) for b, (_, row)
+            in zip(projected.bounds.itertuples(index=False), tiles.iterrows())]
+    height = sorted(b[3] - b[1] for b, _ in rows)[len(rows) // 2]
+    return sorted(rows, key=lambda r: (-round((r[0][1] + r[0][3]) / 2 / height), r[0][0]))
+
+
+def neighbourhoods(order, buffer=dem.BUFFER + 5):
+    """Tiles each tile must wait for, itself included
+
+    From the index footprints with a few metres to spare, so it covers
+    every tile dem.neighbours() will find from the LAZ headers.
+    """
+    bounds = {row.HOJA: b for b, row in order}
+    return {key: set(dem.neighbours(b, bounds, buffer)) for key, b in bounds.items()}
+
+
+def _indexed(path):
+    """Index row of a LAZ tile, read from its header and a point sample if not current"""
+    return ingest.lookup(path) or ingest.index_tile(path)
+
+
+async def stream(roi=None, workers=None, ahead=AHEAD, manifest=None):
+    """Download the AOI's tiles and rasterise each as soon as its neighbourhood is on disk
+
+    Returns (tiles, download seconds, PDAL seconds, tiles not downloaded or corrupt).
+    """
+    aoi, laz_dir = state.area(), state.paths()["laz"]
+    tiles = tileindex.tiles_for(roi or aoi["bbox"], aoi["laz_version"], aoi.get("index_url"))
+    tiles = tiles.head(aoi["max_downloads"])
+    if len(tiles) == 0:
+        print("⚠ No tiles found for the specified bounding box")
+        return [], 0.0, 0.0, []
+
+    order = scan_order(tiles)
+    keys = [row.HOJA for _, row in order]
+    waits = neighbourhoods(order)
+    pos = {key: i for i, key in enumerate(keys)}
+    reach = max(max(pos[n] for n in waits[key]) - pos[key] for key in keys)
+    if ahead < reach + 1:
+        print(f"⚠ ahead raised from {ahead} to {reach + 1}: a tile's neighbours are up to "
+              f"{reach} tiles later in scan order")
+        ahead = reach + 1
+
+    manifest = manifest or state.Manifest()
+    todo = {t[0]: t for t in download.pending(tiles, manifest)}
+    params = state.stage_params("dem")
+    filters, writer = dem.load_template()
+    res = writer["resolution"]
+    workers = workers or os.cpu_count() or 1
+    print(f"Streaming {len(tiles)} tiles for {aoi['name']} ({len(todo)} to download, "
+          f"{workers} PDAL workers, up to {ahead} tiles ahead of them)")
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(ahead)
+    conns = asyncio.Semaphore(CONNECTIONS)
+    arrived = {}      # key -> (laz path, bounds), or None if it failed
+    started, builds, failed = set(), [], []
+    done = 0
+    timing = {"download": [None, None], "dem": 0.0}
+    pool = ThreadPoolExecutor(max_workers=workers)
+
+    def finished(key):
+        nonlocal done
+        slots.release()
+        done += 1
+        jobs.progress(done, len(keys), "tiles")
+
+    def build(*args):
+        # Timed in the worker: queueing for a free worker is not PDAL time
+        t0 = time.perf_counter()
+        try:
+            dem.build_tile(*args)
+        finally:
+            timing["dem"] += time.perf_counter() - t0
+
+    async def rasterise(key, laz, bounds, sources, d):
+        try:
+            await loop.run_in_executor(pool, build, laz, bounds, sources, filters,
+                                       writer, store.dem_tile(d))
+            print(f"✓ DEM tile {key} ({done + 1}/{len(keys)})")
+        except Exception as e:
+            # Not in the store, so dem.build_dem() tries it again and reports it
+            print(f"✗ Error building DEM tile {key}: {e}")
+        finished(key)
+
+    def ready(key):
+        """Start the DEM of every tile whose neighbourhood the arrival of key completed"""
+        for k in sorted(waits[key], key=pos.get):
+            if k in started or not arrived.get(k) or not all(n in arrived for n in waits[k]):
+                continue
+            started.add(k)
+            laz, bounds = arrived[k]
+            have = {arrived[n][0]: arrived[n][1] for n in waits[k] if arrived[n]}
+            sources = sorted(dem.neighbours(bounds, have))
+            # The digest dem.build_dem() computes, so it finds this tile in the store
+            d = state.digest(params, dem.BUFFER, bounds,
+                             sorted(manifest.file_hash(s) for s in sources))
+            if manifest.stale("dem", dem.tile_name(laz), d):
+                builds.append(asyncio.create_task(rasterise(k, laz, bounds, sources, d)))
+            else:
+                finished(k)
+
+    async def fetch(session, key):
+        await slots.acquire()
+        path = f"{laz_dir}/{key}.laz"
+        t0 = time.perf_counter()
+        timing["download"][0] = timing["download"][0] or t0
+        if key in todo:
+            _, url, path, stored, d = todo[key]
+            ok = await download.download_laz(session, conns, url, stored)
+            if ok:
+                store.link(stored, path)
+                manifest.record("download", key, d, [path])
+        else:
+            ok = os.path.exists(path)
+        if ok:
+            row = await loop.run_in_executor(None, _indexed, path)
+            ok = bool(row["ok"])
+            if ok:
+                manifest.data["files"][path] = [row["size"], row["mtime_ns"], row["sha256"]]
+                arrived[key] = (path, dem.snap_bounds(row, res))
+            else:
+                print(f"✗ Skipping corrupt tile {key}: {row['error']}")
+        timing["download"][1] = time.perf_counter()
+        if not ok:
+            arrived[key] = None
+            failed.append(key)
+            finished(key)
+        ready(key)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(fetch(session, key) for key in keys))
+        await asyncio.gather(*builds)
+    finally:
+        pool.shutdown()
+
+    if roi:
+        manifest.save()
+    else:
+        manifest.prune("download", keep=set(tiles.HOJA))
+        manifest.finish("download", params=state.stage_params("download"))
+    start, end = timing["download"]
+    return keys, (end - start) if start else 0.0, timing["dem"], failed
+
+
+def run(roi=None, workers=None, ahead=AHEAD, deriv=True):
+    """Streamed download and DEM tiles, then the mosaic and (with deriv) the derivatives"""
+    manifest = state.Manifest()
+    t0 = time.perf_counter()
+    keys, fetching, rasterising, failed = asyncio.run(stream(roi, workers, ahead, manifest))
+    if not keys:
+        return False, 0
+    streamed = time.perf_counter() - t0
+    workers = workers or os.cpu_count() or 1
+    print(f"⏱ Streamed {len(keys)} tiles in {streamed:.1f}s: downloads took {fetching:.1f}s "
+          f"and PDAL {rasterising / workers:.1f}s per worker, {fetching + rasterising / workers:.1f}s "
+          f"one after the other")
+    if failed:
+        print(f"⚠ {len(failed)} tiles could not be downloaded: {', '.join(failed)}")
+
+    # Every up-to-date tile is in the store now: this records and mosaics them
+    ok = dem.build_dem(workers=workers, manifest=manifest, roi=roi)
+    if ok and deriv:
+        with metrics.stage("deriv", "Mpx"):
+            process.derivatives(state.paths()["dem"], manifest=manifest, roi=roi)
+    return ok and not failed, len(keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the LAZ tiles and build the DEM "
+                                                 "as they arrive")
+    parser.add_argument("--roi", nargs=4, type=float, metavar=("W", "S", "E", "N"),
+                        help="only the tiles under this lon/lat box")
+    parser.add_argument("--workers", type=int, help="PDAL workers (default: one per core)")
+    parser.add_argument("--ahead", type=int, default=AHEAD,
+                        help="tiles downloaded ahead of the PDAL workers at most")
+    parser.add_argument("--no-deriv", action="store_true", help="stop after the DEM mosaic")
+    args = parser.parse_args()
+    with metrics.stage("stream", "tiles") as record:
+        record["ok"], tiles = run(args.roi, args.workers, args.ahead, not args.no_deriv)
+        # Downloads and DEM tiles both count themselves; report each tile once
+        record["units"] = tiles
+    raise SystemExit(0 if record["ok"] else 1)
@@ -0,0 +1,116 @@
+"""Local cache of the CNIG PNOA-LiDAR tile index.
+
+The remote index is a zipped shapefile covering all of Spain. It is
+downloaded once per laz_version, reprojected to EPSG:4326 and stored as
+GeoParquet under data/cache/. Later runs revalidate it with an
+ETag/Last-Modified conditional request at most once every MAX_AGE seconds.
+An AOI query reads only the Parquet row groups whose bbox overlaps it and
+refines the hits with the STRtree instead of a full intersects() scan.
+geopandas is imported on first use, so importing this module is cheap.
+"""
+import json
+import os
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+CACHE_DIR = "data/cache"
+MAX_AGE = 24 * 3600
+
+INDEX_URLS = {
+    "3c2025": ("https://centrodedescargas.cnig.es/CentroDescargas/"
+               "documentos/PDT_LIDAR3_2025.zip"),
+}
+
+_loaded = {}
+
+
+def _paths(version):
+    base = f"{CACHE_DIR}/index_{version}"
+    return f"{base}.parquet", f"{base}.json"
+
+
+def refresh(version, url=None, max_age=MAX_AGE):
+    """Make sure the cached index for version is current; return its path"""
+    url = url or INDEX_URLS.get(version)
+    if url is None:
+        raise KeyError(f"no tile index URL for laz_version {version!r}; "
+                       f"add it to index_urls in config.yaml")
+    parquet, meta_path = _paths(version)
+    meta = {}
+    if os.path.exists(meta_path) and os.path.exists(parquet):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("url") == url and time.time() - meta.get("checked", 0) < max_age:
+            return parquet
+
+    request = urllib.request.Request(url)
+    if meta.get("url") == url:
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    try:
+        # The zip lives in a scratch directory that goes away however the
+        # download or the read ends
+        with tempfile.TemporaryDirectory(dir=CACHE_DIR) as scratch:
+            zip_path = os.path.join(scratch, "index.zip")
+            with urllib.request.urlopen(request, timeout=120) as r, open(zip_path, "wb") as f:
+                while chunk := r.read(1 << 20):
+                    f.write(chunk)
+                headers = r.headers
+            import geopandas as gpd
+
+            idx = gpd.read_file(zip_path).to_crs(4326)
+        # Hilbert-sorted small row groups with a bbox covering column let
+        # read_parquet(bbox=...) skip almost the whole file for an AOI
+        idx["_row"] = range(len(idx))
+        idx = idx.iloc[idx.hilbert_distance().argsort()]
+        idx.to_parquet(f"{parquet}.tmp", write_covering_bbox=True, row_group_size=4096)
+        os.replace(f"{parquet}.tmp", parquet)
+        meta = {"url": url, "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified")}
+        print(f"✓ Tile index {version} cached ({len(idx)} tiles)")
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+    except urllib.error.URLError as e:
+        if not os.path.exists(parquet):
+            raise
+        print(f"⚠ Could not revalidate tile index ({e.reason}), using cached copy")
+
+    meta["checked"] = time.time()
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    _loaded.pop(version, None)
+    return parquet
+
+
+def load(version, url=None, max_age=MAX_AGE):
+    """Tile index for version as a GeoDataFrame in EPSG:4326"""
+    import geopandas as gpd
+
+    parquet = refresh(version, url, max_age)
+    mtime = os.path.getmtime(parquet)
+    if version not in _loaded or _loaded[version][0] != mtime:
+        _loaded[version] = (mtime, gpd.read_parquet(parquet))
+    return _loaded[version][1]
+
+
+def query(idx, bbox):
+    """Tiles intersecting bbox (W, S, E, N), in index order, via the STRtree"""
+    from shapely.geometry import box
+
+    hits = idx.iloc[idx.sindex.query(box(*bbox), predicate="intersects")]
+    return hits.sort_values("_row").drop(columns="_row")
+
+
+def tiles_for(bbox, version, url=None, max_age=MAX_AGE):
+    """Tiles intersecting bbox, reading only the matching row groups of the cache"""
+    import geopandas as gpd
+
+    parquet = refresh(version, url, max_age)
+    return query(gpd.read_parquet(parquet, bbox=tuple(bbox)), bbox)
@@ -0,0 +1,184 @@
+"""Local XYZ tile server for the DEM and its derivatives.
+
+Serves /<layer>/<z>/<x>/<y>.png in Web Mercator so the Streamlit map can
+show the rasters as folium tile layers. Each tile reads only the window it
+covers, from the overview level closest to its resolution, so panning and
+zooming stay cheap on province-sized rasters.
+
+Run standalone with `python src/tiles.py [port]`, or start it in a
+background thread with serve().
+"""
+import io
+import math
+import os
+import re
+import sys
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import from_bounds as window_from_bounds
+
+PORT = int(os.environ.get("LIDAR_TILE_PORT", 8765))
+TILE = 256
+MERCATOR = "EPSG:3857"
+HALF_WORLD = math.pi * 6378137
+
+
+def area_layers(dem="data/dem_velez.tif", deriv="data/deriv", prefix=""):
+    """layer name -> (path, stretch range or None for a percentile stretch)"""
+    return {
+        f"{prefix}dem": (dem, None),
+        f"{prefix}hillshade": (f"{deriv}/hill_315.tif", (0, 255)),
+        f"{prefix}hillshade_multi": (f"{deriv}/hill_multi.tif", (0, 255)),
+        f"{prefix}svf": (f"{deriv}/svf.tif", None),
+        # Elevation change against an earlier coverage (change.py), -1 m black to +1 m white
+        f"{prefix}dod": (f"{deriv}/dod.tif", (-1, 1)),
+    }
+
+
+LAYERS = area_layers()
+
+_local = threading.local()
+
+
+def mercator_bounds(z, x, y):
+    size = 2 * HALF_WORLD / 2 ** z
+    minx = -HALF_WORLD + x * size
+    maxy = HALF_WORLD - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def _dataset(path, level=None):
+    """Per-thread dataset handle, optionally opened at an overview level"""
+    handles = _local.__dict__.setdefault("handles", {})
+    key = (path, level, os.path.getmtime(path))
+    if key not in handles:
+        for old in [k for k in handles if k[:2] == (path, level)]:
+            handles.pop(old).close()
+        kwargs = {"overview_level": level} if level is not None else {}
+        handles[key] = rasterio.open(path, **kwargs)
+    return handles[key]
+
+
+@lru_cache(maxsize=32)
+def _stretch(path, mtime):
+    """2nd-98th percentile range from the coarsest overview"""
+    src = _dataset(path)
+    levels = src.overviews(1)
+    ds = _dataset(path, len(levels) - 1) if levels else src
+    arr = ds.read(1, masked=True).astype("float32")
+    data = arr.compressed() if np.ma.isMaskedArray(arr) else arr.ravel()
+    data = data[np.isfinite(data)]
+    if data.size == 0:
+        return 0.0, 1.0
+    lo, hi = np.percentile(data, [2, 98])
+    return float(lo), float(hi) if hi > lo else float(lo) + 1
+
+
+def _blank():
+    buf = io.BytesIO()
+    Image.new("LA", (TILE, TILE)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+@lru_cache(maxsize=2048)
+def _render(path, stretch, mtime, z, x, y):
+    src = _dataset(path)
+    tile_bounds = mercator_bounds(z, x, y)
+    try:
+        left, bottom, right, top = transform_bounds(MERCATOR, src.crs, *tile_bounds)
+    except Exception:
+        return _blank()
+    if right <= src.bounds.left or left >= src.bounds.right \
+            or top <= src.bounds.bottom or bottom >= src.bounds.top:
+        return _blank()
+
+    # Coarsest overview that still has at least one source pixel per tile pixel
+    factor = (right - left) / TILE / src.res[0]
+    levels = [f for f in src.overviews(1) if f <= factor]
+    ds = _dataset(path, len(levels) - 1) if levels else src
+
+    win = window_from_bounds(left, bottom, right, top, ds.transform)
+    # A couple of pixels of margin for the resampling kernel, clipped to the
+    # raster: at low zooms a tile is much larger than the whole extent
+    pad = 2
+    col0 = max(0, math.floor(win.col_off) - pad)
+    row0 = max(0, math.floor(win.row_off) - pad)
+    col1 = min(ds.width, math.ceil(win.col_off + win.width) + pad)
+    row1 = min(ds.height, math.ceil(win.row_off + win.height) + pad)
+    win = rasterio.windows.Window(col0, row0, col1 - col0, row1 - row0)
+    nodata = ds.nodata if ds.nodata is not None else np.nan
+    data = ds.read(1, window=win).astype("float32")
+    if not np.isnan(nodata):
+        data[data == nodata] = np.nan
+
+    out = np.full((TILE, TILE), np.nan, dtype="float32")
+    reproject(data, out, src_transform=ds.window_transform(win), src_crs=ds.crs,
+              src_nodata=np.nan, dst_transform=from_bounds(*tile_bounds, TILE, TILE),
+              dst_crs=MERCATOR, dst_nodata=np.nan, resampling=Resampling.bilinear)
+
+    lo, hi = stretch or _stretch(path, mtime)
+    valid = np.isfinite(out)
+    gray = np.zeros((TILE, TILE), dtype="uint8")
+    gray[valid] = np.clip((out[valid] - lo) / (hi - lo) * 255, 0, 255)
+    alpha = np.where(valid, 255, 0).astype("uint8")
+    buf = io.BytesIO()
+    Image.fromarray(np.dstack([gray, alpha]), mode="LA").save(buf, "PNG")
+    return buf.getvalue()
+
+
+def render_tile(layer, z, x, y, layers=LAYERS):
+    """PNG bytes of one XYZ tile of layer, or None if the layer is unknown or missing"""
+    if layer not in layers:
+        return None
+    path, stretch = layers[layer]
+    if not os.path.exists(path):
+        return None
+    return _render(path, stretch, os.path.getmtime(path), z, x, y)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    layers = LAYERS
+
+    def do_GET(self):
+        m = re.fullmatch(r"/([\w.-]+)/(\d+)/(\d+)/(\d+)\.png", self.path)
+        png = render_tile(m[1], int(m[2]), int(m[3]), int(m[4]), self.layers) if m else None
+        if png is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(png)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(png)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=PORT, layers=LAYERS):
+    """Start the tile server in a daemon thread and return it"""
+    handler = type("Handler", (_Handler,), {"layers": layers})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def available_layers(layers=LAYERS):
+    return [name for name, (path, _) in layers.items() if os.path.exists(path)]
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    print(f"Serving {', '.join(available_layers()) or 'no layers yet'} on "
+          f"http://127.0.0.1:{port}/<layer>/<z>/<x>/<y>.png")
+    ThreadingHTTPServer(("127.0.0.1", port), _Handler).serve_forever()
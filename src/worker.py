@@ -0,0 +1,273 @@
+"""Warm worker: runs pipeline commands without a fresh interpreter each time.
+
+Every job used to start a new `python`, which imports rasterio, geopandas,
+scipy and google.genai again before doing any work. The worker imports
+them once and listens on a Unix socket (data/jobs/worker.sock). For each
+command it forks a child that inherits the loaded libraries, becomes a
+process group leader (so cancelling a job still stops PDAL and the block
+workers), takes the caller's environment and working directory, sends its
+output back over the connection and runs the command with cli.run_script().
+Stage modules are imported in the children, and read config.yaml,
+LIDAR_AOI and LIDAR_EPOCH when they use them rather than at import, so
+each job sees them as a new process would.
+
+The job runner (jobs.py) and batch.py use the worker when it is up and a
+subprocess otherwise; app.py starts it.
+
+    python -m src worker                # serve in the foreground
+"""
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+# cli is imported where it is used: app.py imports this module as src.worker
+# to start the worker, where the flat import would fail
+
+SOCKET = "data/jobs/worker.sock"
+PID_PREFIX = "@pid"
+EXIT_PREFIX = "@exit"
+
+# Imported once in the worker; every job's child starts with them loaded
+WARM = ("numpy", "yaml", "rasterio", "rasterio.vrt", "rasterio.warp", "rasterio.features",
+        "pyproj", "shapely", "geopandas", "scipy.ndimage", "laspy", "aiohttp", "aiofiles",
+        "PIL.Image", "google.genai")
+
+
+def preload(modules=WARM):
+    """Import modules, skipping missing ones; returns the seconds it took"""
+    t0 = time.perf_counter()
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"⚠ Not preloading {name}: {e}")
+    return time.perf_counter() - t0
+
+
+def _child(conn, others, request):
+    """Forked child: run one command with its output on conn; never returns"""
+    import cli
+
+    code = 1
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for other in others:
+            other.close()
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        conn.close()
+        sys.stdout = open(1, "w", buffering=1, encoding="utf-8", closefd=False)
+        sys.stderr = open(2, "w", buffering=1, encoding="utf-8", closefd=False)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        print(f"{PID_PREFIX} {os.getpid()}", flush=True)
+        path, args = cli.resolve(request["cmd"], request["cwd"])
+        try:
+            cli.run_script(path, args)
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+        except BaseException as e:
+            # From the script's frame down, as python src/<script>.py would print it
+            tb = e.__traceback__
+            while tb and tb.tb_frame.f_code.co_filename != path:
+                tb = tb.tb_next
+            traceback.print_exception(type(e), e, tb or e.__traceback__)
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def serve(path=SOCKET):
+    """Preload the libraries and run commands sent to path until terminated"""
+    import cli
+
+    if ping(path):
+        print(f"✗ A worker is already listening on {path}")
+        return 1
+    print(f"✓ Preloaded libraries in {preload():.1f}s")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # A child exiting wakes select() through this pipe, so its exit code goes out at once
+    wake, wakeup = os.pipe()
+    os.set_blocking(wake, False)
+    os.set_blocking(wakeup, False)
+    signal.set_wakeup_fd(wakeup)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    running = {}    # child pid -> connection its exit code goes to
+    print(f"✅ Worker {os.getpid()} listening on {path}", flush=True)
+    try:
+        while True:
+            ready, _, _ = select.select([server, wake], [], [])
+            if wake in ready:
+                os.read(wake, 4096)
+            if server in ready:
+                conn, _ = server.accept()
+                with conn.makefile("rb") as f:
+                    request = json.loads(f.readline() or "{}")
+                if "cmd" not in request:
+                    conn.sendall(f"{PID_PREFIX} {os.getpid()}\n".encode())
+                    conn.close()
+                elif cli.resolve(request["cmd"], request["cwd"]) is None:
+                    conn.sendall(f"✗ Not a pipeline command: {request['cmd']}\n"
+                                 f"{EXIT_PREFIX} 2\n".encode())
+                    conn.close()
+                else:
+                    pid = os.fork()
+                    if pid == 0:
+                        _child(conn, [server, *running.values()], request)
+                    running[pid] = conn
+            while running:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                conn = running.pop(pid, None)
+                if conn is not None:
+                    try:
+                        conn.sendall(f"\n{EXIT_PREFIX} {os.waitstatus_to_exitcode(status)}\n"
+                                     .encode())
+                    except OSError:
+                        pass
+                    conn.close()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def ping(path=SOCKET):
+    """Pid of the worker listening on path, or None"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(5)
+            s.connect(path)
+            s.sendall(b"{}\n")
+            reply = s.makefile("r").readline().split()
+        return int(reply[1]) if len(reply) == 2 and reply[0] == PID_PREFIX else None
+    except (OSError, ValueError):
+        return None
+
+
+def start(path=SOCKET, wait=30.0):
+    """Start a detached worker unless one is up; returns its pid, or None if it did not come up"""
+    pid = ping(path)
+    if pid:
+        return pid
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{os.path.splitext(path)[0]}.log", "a") as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), path],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(0.2)
+        pid = ping(path)
+        if pid:
+            return pid
+    return None
+
+
+class Remote:
+    """A command running in a worker child, with the parts of Popen the job runner uses"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.returncode = None
+        self._lines = conn.makefile("r", encoding="utf-8", errors="replace")
+        first = self._lines.readline()
+        words = first.split()
+        self.pid = int(words[1]) if len(words) == 2 and words[0] == PID_PREFIX else None
+        self.stdout = self._output(None if self.pid else first)
+
+    def _output(self, first=None):
+        held = None
+        lines = self._lines if first is None else [first, *self._lines]
+        for line in lines:
+            if line.startswith(EXIT_PREFIX):
+                # The worker writes a newline before the exit code: drop it
+                self.returncode = int(line.split()[1])
+                held = None
+                break
+            if held is not None:
+                yield held
+                held = None
+            if line == "\n":
+                held = line
+            else:
+                yield line
+        if held is not None:
+            yield held
+        self._lines.close()
+        self.conn.close()
+
+    def terminate(self):
+        if self.pid:
+            try:
+                os.killpg(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def wait(self):
+        for _ in self.stdout:
+            pass
+        if self.returncode is None:
+            # Connection lost without an exit code: the worker died
+            self.returncode = 1
+        return self.returncode
+
+
+def spawn(cmd, env=None, cwd=None, path=SOCKET):
+    """Run cmd in the worker if it is up and cmd is a pipeline command; Remote or None"""
+    import cli
+
+    if cli.resolve(cmd, cwd) is None:
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        request = {"cmd": list(cmd), "env": dict(os.environ if env is None else env),
+                   "cwd": os.path.abspath(cwd or os.getcwd())}
+        conn.sendall((json.dumps(request) + "\n").encode())
+        return Remote(conn)
+    except OSError:
+        conn.close()
+        return None
+
+
+def call(cmd, env=None, path=SOCKET):
+    """Run cmd to completion with its output on ours, in the worker if possible; the exit code"""
+    remote = spawn(cmd, env, path=path)
+    if remote is None:
+        return subprocess.run(cmd, env=env).returncode
+    for line in remote.stdout:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    return remote.wait()
+
+
+if __name__ == "__main__":
+    raise SystemExit(serve(*sys.argv[1:2]))
@@ -0,0 +1,46 @@
+"""A small DEM edit must only invalidate the derivative blocks whose halo it touches."""
+import os
+import sys
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import blocks  # noqa: E402
+import process  # noqa: E402
+import state  # noqa: E402
+
+
+def _digests(dem, manifest, halo):
+    with rasterio.open(dem) as src:
+        transform = src.transform
+        windows = list(blocks.grid_windows(transform, src.width, src.height, 256))
+    return windows, list(process._block_digests(manifest, dem, transform, windows, halo, {}))
+
+
+def test_edit_invalidates_only_blocks_under_it(tmp_path):
+    dem = str(tmp_path / "dem.tif")
+    rng = np.random.default_rng(0)
+    profile = dict(driver="GTiff", width=1280, height=1280, count=1, dtype="float32",
+                   crs="EPSG:25830", transform=from_origin(399872, 4079872, 1, 1),
+                   nodata=-9999, tiled=True, blockxsize=256, blockysize=256)
+    with rasterio.open(dem, "w", **profile) as dst:
+        dst.write(rng.normal(100, 5, (1280, 1280)).astype("float32"), 1)
+    # No dem-stage tiles on record: digests come from the pixels
+    manifest = state.Manifest(str(tmp_path / "manifest.json"))
+    windows, before = _digests(dem, manifest, halo=8)
+
+    # Origin on the 256 px map grid, so blocks start at multiples of 256. One
+    # 10 x 10 px edit inside a block, one also within the halo of its left neighbour
+    with rasterio.open(dem, "r+") as dst:
+        for col, row in ((300, 300), (1028, 600)):
+            win = Window(col, row, 10, 10)
+            dst.write(dst.read(1, window=win) + 1, 1, window=win)
+    _, after = _digests(dem, manifest, halo=8)
+
+    changed = [(w.col_off, w.row_off) for w, a, b in zip(windows, before, after) if a != b]
+    assert len(windows) == 25
+    assert changed == [(256, 256), (768, 512), (1024, 512)]
@@ -0,0 +1,73 @@
+"""download_laz() against the fixture server standing in for a bad link."""
+import asyncio
+import hashlib
+import os
+import socket
+import sys
+
+import aiohttp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import download  # noqa: E402
+import fixtures  # noqa: E402
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _fetch(directory, name, dest, retries=download.RETRIES, **server):
+    async def go():
+        port = _free_port()
+        runner = await fixtures.serve(directory, port, **server)
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await download.download_laz(
+                    session, asyncio.Semaphore(1), f"http://127.0.0.1:{port}/{name}", dest,
+                    retries=retries)
+        finally:
+            await runner.cleanup()
+    return asyncio.run(go())
+
+
+def _tile(tmp_path):
+    laz, _ = fixtures.write_laz_tiles(str(tmp_path / "src"), nx=1, ny=1, density=8.0)
+    return os.path.dirname(laz[0]), os.path.basename(laz[0])
+
+
+def test_resumes_dropped_connections(tmp_path):
+    directory, name = _tile(tmp_path)
+    size = os.path.getsize(os.path.join(directory, name))
+    dest = str(tmp_path / name)
+    # Throttled so the client reads as bytes arrive: aiohttp drops what is
+    # still unread in its buffer when the connection breaks
+    assert _fetch(directory, name, dest, drop_after=size // 4, mb_per_s=20)
+    assert _sha256(dest) == _sha256(os.path.join(directory, name))
+    assert not os.path.exists(f"{dest}.part")
+
+
+def test_discards_oversized_part(tmp_path):
+    directory, name = _tile(tmp_path)
+    dest = str(tmp_path / name)
+    with open(f"{dest}.part", "wb") as f:
+        f.write(os.urandom(os.path.getsize(os.path.join(directory, name)) + 100))
+    assert _fetch(directory, name, dest, mb_per_s=1000)
+    assert _sha256(dest) == _sha256(os.path.join(directory, name))
+
+
+def test_gives_up_when_server_restarts_every_time(tmp_path):
+    directory, name = _tile(tmp_path)
+    size = os.path.getsize(os.path.join(directory, name))
+    dest = str(tmp_path / name)
+    assert not _fetch(directory, name, dest, retries=2, drop_after=size // 4, ranges=False)
+    assert not os.path.exists(dest)